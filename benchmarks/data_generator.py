@@ -0,0 +1,96 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+class DataGenerator:
+    """
+    Generates synthetic train, ideal and test CSV files shaped like the
+    bundled data set, at any scale.
+
+    Every ideal function is a random sine wave on a linear trend. The train
+    columns are noisy copies of randomly chosen ideal functions, and most
+    test points lie close to one of those, while the rest are spread over
+    the whole y range and stay unmapped.
+    """
+
+    def __init__(self, samples=400, ideal_functions=50, train_columns=4,
+                 test_points=100, noise=0.3, outlier_share=0.2, seed=0):
+        """
+        Constructs all the attributes for the DataGenerator object.
+
+        :param samples: Number of x values of the train and ideal tables
+        :param ideal_functions: Number of ideal function columns
+        :param train_columns: Number of train function columns
+        :param test_points: Number of test points
+        :param noise: Standard deviation of the noise of train and test y
+        :param outlier_share: Share of test points not near any function
+        :param seed: Seed of the random number generator
+        """
+        if train_columns > ideal_functions:
+            raise ValueError("Every train column needs its own ideal "
+                             "function.")
+        self.samples = samples
+        self.ideal_functions = ideal_functions
+        self.train_columns = train_columns
+        self.test_points = test_points
+        self.noise = noise
+        self.outlier_share = outlier_share
+        self.seed = seed
+
+    def generate(self):
+        """
+        Generates the three data sets.
+
+        :return: The train, ideal and test DataFrames.
+        """
+        rng = np.random.default_rng(self.seed)
+        # Equally spaced x values from -20 like the bundled data
+        x_values = -20 + 40 * np.arange(self.samples) / self.samples
+
+        # Random sine waves on linear trends
+        amplitude, frequency, phase, slope, offset = rng.uniform(
+            [0.5, 0.1, 0, -2, -50], [20, 2, 2 * np.pi, 2, 50],
+            (self.ideal_functions, 5)).T
+        ideal_values = amplitude * np.sin(np.outer(x_values, frequency)
+                                          + phase) \
+            + np.outer(x_values, slope) + offset
+        ideal_data = pd.DataFrame(
+            ideal_values,
+            columns=[f'y{i + 1}' for i in range(self.ideal_functions)])
+        ideal_data.insert(0, 'x', x_values)
+
+        # Train columns are noisy copies of distinct ideal functions
+        chosen = rng.choice(self.ideal_functions, self.train_columns,
+                            replace=False)
+        train_data = pd.DataFrame(
+            ideal_values[:, chosen]
+            + rng.normal(0, self.noise, (self.samples, self.train_columns)),
+            columns=[f'y{i + 1}' for i in range(self.train_columns)])
+        train_data.insert(0, 'x', x_values)
+
+        # Test points near a chosen function, outliers anywhere in y
+        rows = rng.integers(0, self.samples, self.test_points)
+        test_y = ideal_values[rows, rng.choice(chosen, self.test_points)] \
+            + rng.normal(0, self.noise, self.test_points)
+        outliers = rng.random(self.test_points) < self.outlier_share
+        test_y[outliers] = rng.uniform(ideal_values.min(), ideal_values.max(),
+                                       outliers.sum())
+        test_data = pd.DataFrame({'x': x_values[rows], 'y': test_y})
+        return train_data, ideal_data, test_data
+
+    def write(self, directory):
+        """
+        Writes the generated data sets as CSV files.
+
+        :param directory: Folder the train, ideal and test CSV files are
+        written to
+        :return: A dictionary with the paths of the train, ideal and test
+        files.
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = {}
+        for name, data in zip(('train', 'ideal', 'test'), self.generate()):
+            paths[name] = os.path.join(directory, f'{name}.csv')
+            data.to_csv(paths[name], index=False)
+        return paths
@@ -0,0 +1,161 @@
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from ops_viz.data_processing import MathUtils
+
+
+class KernelBenchmark:
+    """
+    Times the MathUtils block kernels against the per-pair calculations
+    they replace, on random data with a share of missing values.
+
+    Every case runs the old and the new calculation on the same data, checks
+    that both agree and keeps the best of several timings of either.
+    """
+
+    def __init__(self, rows=10_000, train_columns=4, ideal_functions=50,
+                 nan_share=0.01, repeat=3, seed=0):
+        """
+        Constructs all the attributes for the KernelBenchmark object.
+
+        :param rows: Number of x values
+        :param train_columns: Number of train columns
+        :param ideal_functions: Number of ideal functions
+        :param nan_share: Share of missing values in the skipna case
+        :param repeat: Number of timings per calculation, the best is kept
+        :param seed: Seed of the random data
+        """
+        rng = np.random.default_rng(seed)
+        self.train = rng.normal(size=(rows, train_columns))
+        self.ideal = rng.normal(size=(rows, ideal_functions))
+        self.missing = rng.random(self.train.shape) < nan_share
+        self.repeat = repeat
+        self.math = MathUtils()
+
+    def best_time(self, function):
+        """
+        Runs a calculation `repeat` times.
+
+        :return: Its result and the best time in seconds.
+        """
+        seconds = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            result = function()
+            seconds.append(time.perf_counter() - start)
+        return result, min(seconds)
+
+    def pairwise(self, train, ideal, sqd_dev_sum, max_deviation):
+        """
+        Scores every pair of train and ideal columns one pair at a time.
+
+        :return: The squared deviation sums and maximum deviations of shape
+        (train columns, ideal functions).
+        """
+        return (np.array([[sqd_dev_sum(train[i], ideal[j])
+                           for j in ideal] for i in train]),
+                np.array([[max_deviation(train[i], ideal[j])
+                           for j in ideal] for i in train]))
+
+    def cases(self):
+        """
+        :return: A dictionary mapping case names to the old and the new
+        calculation.
+        """
+        train = pd.DataFrame(self.train)
+        ideal = pd.DataFrame(self.ideal)
+        train_nan = train.mask(self.missing)
+        y_values = self.train[:, 0]
+        sqd_dev_matrix = self.math.sqd_dev_matrix
+        # Output buffers of the mapping case, reused by every timing run
+        buffer = np.empty((len(y_values), self.ideal.shape[1] + 1))
+        buffer[:, -1] = np.inf
+
+        def buffered_deviations():
+            self.math.abs_deviations(y_values, self.ideal,
+                                     out=buffer[:, :-1])
+            return buffer
+
+        return {
+            # Builtin sum and max over Series, as MathUtils once scored
+            'sse_max': (
+                lambda: self.pairwise(
+                    train, ideal,
+                    lambda column1, column2: sum((column1 - column2) ** 2),
+                    lambda column1, column2: max(abs(column1 - column2))),
+                lambda: sqd_dev_matrix(self.train, self.ideal)),
+            # Pandas reductions skipping the missing rows of every pair
+            'sse_max_skipna': (
+                lambda: self.pairwise(
+                    train_nan, ideal,
+                    lambda column1, column2: ((column1 - column2) ** 2).sum(),
+                    lambda column1, column2: (column1 - column2).abs().max()),
+                lambda: sqd_dev_matrix(train_nan.to_numpy(), self.ideal,
+                                       skipna=True)),
+            # Test point deviations with and without a reused buffer
+            'abs_deviations': (
+                lambda: np.column_stack([
+                    np.abs(y_values[:, np.newaxis] - self.ideal),
+                    np.full(len(y_values), np.inf)]),
+                buffered_deviations),
+        }
+
+    def run(self):
+        """
+        Times every case.
+
+        :return: A list of dictionaries with the case name, the seconds of
+        the old and the new calculation, the speedup and whether both
+        results agree.
+        """
+        results = []
+        for name, (old, new) in self.cases().items():
+            old_result, old_seconds = self.best_time(old)
+            new_result, new_seconds = self.best_time(new)
+            agree = all(np.allclose(old_values, new_values, equal_nan=True)
+                        for old_values, new_values in zip(
+                            old_result if isinstance(old_result, tuple)
+                            else (old_result,),
+                            new_result if isinstance(new_result, tuple)
+                            else (new_result,)))
+            results.append({'case': name, 'old_seconds': old_seconds,
+                            'new_seconds': new_seconds,
+                            'speedup': old_seconds / max(new_seconds, 1e-9),
+                            'agree': bool(agree)})
+        return results
+
+
+def main(argv=None):
+    """
+    Runs the kernel microbenchmarks from the command line and prints the
+    timings.
+    """
+    parser = argparse.ArgumentParser(
+        description='Times the MathUtils kernels against per-pair scoring.')
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--train-columns', type=int, default=4)
+    parser.add_argument('--ideal-functions', type=int, default=50)
+    parser.add_argument('--nan-share', type=float, default=0.01)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='path of an optional JSON report')
+    args = parser.parse_args(argv)
+
+    results = KernelBenchmark(args.rows, args.train_columns,
+                              args.ideal_functions, args.nan_share,
+                              args.repeat, args.seed).run()
+    for result in results:
+        print(f"{result['case']:<20}{result['old_seconds']:>10.4f}s"
+              f"{result['new_seconds']:>10.4f}s"
+              f"{result['speedup']:>10.1f}x"
+              f"{'' if result['agree'] else '  MISMATCH':>10}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
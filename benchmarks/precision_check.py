@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from database import models
+from ops_viz.data_processing import ProcessData
+from benchmarks.data_generator import DataGenerator
+
+
+class PrecisionCheck:
+    """
+    Checks the accuracy of the compact representation against full
+    precision.
+
+    The same train, ideal and test tables are selected and mapped once from
+    float64 and once from float32 columns, and the selections, maximum
+    deviations, test point assignments and deviations are compared, along
+    with the memory the tables take in either representation.
+    """
+
+    def __init__(self, train_data, ideal_data, test_data):
+        """
+        Constructs all the attributes for the PrecisionCheck object.
+
+        :param train_data: DataFrame with x and the train columns
+        :param ideal_data: DataFrame with x and the ideal functions
+        :param test_data: DataFrame with the x and y test points
+        """
+        self.train_data = train_data
+        self.ideal_data = ideal_data
+        self.test_data = test_data
+
+    def run_mode(self, url, compact):
+        """
+        Selects and maps the data in one representation.
+
+        :param url: Database URL holding the three tables
+        :param compact: Uses the compact representation
+        :return: A dictionary with the selection, the full length deviations
+        and ideal function names of the test points and the memory of the
+        loaded and mapped tables in MB.
+        """
+        session = models.create_session(url=url)
+        try:
+            processor = ProcessData(session, compact=compact)
+            selection = processor.select_functions(use_cache=False, top_k=1)
+            test_data = processor.get_data('test_data')
+            mapped, delta_y, ideal_functions = processor.map_test_points(
+                test_data['x'], test_data['y'], processor.get_ideal_data(
+                    [ideal_func for ideal_func, _ in selection.values()]))
+
+            all_delta_y = np.full(len(test_data), np.nan)
+            all_delta_y[mapped] = delta_y
+            all_functions = np.full(len(test_data), None, dtype=object)
+            all_functions[mapped] = ideal_functions
+            # Mapped test table as insert_test_data holds it
+            test_data['delta_y'] = all_delta_y
+            test_data['ideal_function'] = all_functions
+            if compact:
+                test_data = processor.compact_frame(test_data)
+            tables = [processor.get_data('train_data'),
+                      processor.get_ideal_data(), test_data]
+            memory = sum(table.memory_usage(deep=True).sum()
+                         for table in tables) / 2 ** 20
+        finally:
+            session.close()
+        return {'selection': selection, 'delta_y': all_delta_y,
+                'ideal_functions': all_functions, 'memory_mb': memory}
+
+    def run(self):
+        """
+        Runs both representations on a temporary database and compares
+        them.
+
+        :return: A dictionary with the comparison of both runs.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            url = f"sqlite:///{os.path.join(tmp_dir, 'precision.db')}"
+            engine = models.get_engine(url)
+            self.train_data.to_sql('train_data', engine, index=False)
+            self.ideal_data.to_sql('ideal_functions', engine, index=False)
+            test_data = self.test_data[['x', 'y']].assign(
+                delta_y=np.nan, ideal_function=None)
+            test_data.index = pd.RangeIndex(1, len(test_data) + 1,
+                                            name='id')
+            test_data.to_sql('test_data', engine)
+            try:
+                full = self.run_mode(url, compact=False)
+                compact = self.run_mode(url, compact=True)
+            finally:
+                models.dispose_engines()
+        return self.compare(full, compact)
+
+    def compare(self, full, compact):
+        """
+        Compares the results of the full precision and the compact run.
+
+        :return: A dictionary with the share of equal selections, the
+        largest relative error of the maximum deviations, the number and
+        share of test points assigned alike, the largest deviation error of
+        those points and the memory of both representations.
+        """
+        train_columns = list(full['selection'])
+        equal_selection = [full['selection'][column][0] ==
+                           compact['selection'].get(column, [None])[0]
+                           for column in train_columns]
+        max_dev_errors = [
+            abs(compact['selection'][column][1] - max_dev)
+            / max(max_dev, 1e-300)
+            for column, (_, max_dev) in full['selection'].items()
+            if column in compact['selection']]
+
+        same = full['ideal_functions'] == compact['ideal_functions']
+        both_mapped = same & pd.notna(full['ideal_functions'])
+        delta_y_errors = np.abs(full['delta_y'][both_mapped]
+                                - compact['delta_y'][both_mapped])
+        return {
+            'train_columns': len(train_columns),
+            'equal_selections': int(sum(equal_selection)),
+            'max_deviation_max_rel_error': float(max(max_dev_errors,
+                                                     default=0)),
+            'test_points': int(len(same)),
+            'equal_assignments': int(same.sum()),
+            'assignment_agreement': float(same.mean()) if len(same) else 1.0,
+            'delta_y_max_abs_error': float(delta_y_errors.max(initial=0)),
+            'float64_memory_mb': full['memory_mb'],
+            'compact_memory_mb': compact['memory_mb'],
+            'memory_ratio': compact['memory_mb'] / max(full['memory_mb'],
+                                                       1e-9)}
+
+
+def main(argv=None):
+    """
+    Runs the precision check from the command line on the bundled CSV files
+    or a synthetic data set and prints the comparison.
+    """
+    parser = argparse.ArgumentParser(
+        description='Compares compact float32 results with float64.')
+    parser.add_argument('--data', default='data',
+                        help='folder with train.csv, ideal.csv and test.csv')
+    parser.add_argument('--samples', type=int,
+                        help='checks a synthetic data set with this many x '
+                             'values instead')
+    parser.add_argument('--ideal-functions', type=int, default=50)
+    parser.add_argument('--test-points', type=int, default=1_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='path of an optional JSON report')
+    args = parser.parse_args(argv)
+
+    if args.samples:
+        tables = DataGenerator(samples=args.samples,
+                               ideal_functions=args.ideal_functions,
+                               test_points=args.test_points,
+                               seed=args.seed).generate()
+    else:
+        tables = [pd.read_csv(os.path.join(args.data, f'{name}.csv'))
+                  for name in ('train', 'ideal', 'test')]
+    report = PrecisionCheck(*tables).run()
+    for name, value in report.items():
+        print(f"{name:<32}{value}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
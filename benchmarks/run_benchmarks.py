@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime, timezone
+import matplotlib.pyplot as plt
+from database import models
+from database.database_setup import InsertData
+from ops_viz.data_processing import ProcessData
+from ops_viz.visualizations import VisualizeData
+from monitoring.instrumentation import peak_rss_mb
+from benchmarks.data_generator import DataGenerator
+
+# Data set sizes benchmarked by name, the small scale matches the bundled data
+SCALES = {
+    'small': {'samples': 400, 'ideal_functions': 50, 'train_columns': 4,
+              'test_points': 100},
+    'medium': {'samples': 40_000, 'ideal_functions': 50, 'train_columns': 4,
+               'test_points': 10_000},
+    'large': {'samples': 400_000, 'ideal_functions': 50, 'train_columns': 4,
+              'test_points': 100_000},
+}
+
+
+class BenchmarkRunner:
+    """
+    Times the ingestion, selection, mapping and plotting stages of the
+    workflow on synthetic data sets and records their peak memory.
+
+    Every scale runs twice in a fresh temporary folder with its own
+    database: once for the timings and once under tracemalloc for the peak
+    memory, as tracing slows down the measured code.
+    """
+
+    def __init__(self, scales, ideal_layout='wide', trace_memory=True):
+        """
+        Constructs all the attributes for the BenchmarkRunner object.
+
+        :param scales: Dictionary mapping scale names to DataGenerator
+        arguments
+        :param ideal_layout: Storage layout of the ideal functions
+        :param trace_memory: Runs every scale a second time to record the
+        peak memory of each stage
+        """
+        for name, scale in scales.items():
+            if scale['train_columns'] != 4:
+                raise ValueError(f"Scale {name}: the train_data table holds "
+                                 f"exactly 4 train columns.")
+            if ideal_layout == 'wide' and scale['ideal_functions'] != 50:
+                raise ValueError(f"Scale {name}: the wide ideal_functions "
+                                 f"table holds exactly 50 functions, use "
+                                 f"the long layout.")
+        self.scales = scales
+        self.ideal_layout = ideal_layout
+        self.trace_memory = trace_memory
+
+    def measure(self, stage, function, trace_memory):
+        """
+        Runs one stage and measures it.
+
+        :param stage: Name of the stage
+        :param function: Callable running the stage
+        :param trace_memory: Records the peak traced memory of the stage
+        :return: The result of the function and a dictionary with the stage
+        measurement.
+        """
+        if trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = function()
+        record = {'stage': stage, 'seconds': time.perf_counter() - start}
+        if trace_memory:
+            record['peak_memory_mb'] = \
+                tracemalloc.get_traced_memory()[1] / 2 ** 20
+        return result, record
+
+    def run_stages(self, paths, output_dir, trace_memory):
+        """
+        Runs all stages on the generated CSV files, against the database of
+        the current working directory.
+
+        :return: A list of stage measurements.
+        """
+        records = []
+        models.create_session(database_reset=True)
+        data_loader = InsertData(paths['train'], paths['ideal'],
+                                 paths['test'],
+                                 ideal_layout=self.ideal_layout)
+        records.append(self.measure('bulk_insert', data_loader.bulk_insert,
+                                    trace_memory)[1])
+
+        session = models.create_session()
+        data_processor = ProcessData(session, self.ideal_layout)
+        functions, record = self.measure(
+            'select_functions',
+            lambda: data_processor.select_functions(use_cache=False),
+            trace_memory)
+        records.append(record)
+        records.append(self.measure('insert_test_data',
+                                    data_processor.insert_test_data,
+                                    trace_memory)[1])
+
+        data_visualizer = VisualizeData(functions, session,
+                                        self.ideal_layout,
+                                        output_dir=output_dir)
+        data_visualizer.show = False
+        for method in ('plot_train_vs_ideal', 'plot_test_vs_ideal',
+                       'plot_test_over_ideal',
+                       'plot_test_vs_ideal_individual'):
+            records.append(self.measure(
+                method, getattr(data_visualizer, method), trace_memory)[1])
+        session.close()
+        return records
+
+    def run_scale(self, name, scale, trace_memory):
+        """
+        Generates the data of one scale in a temporary folder and runs all
+        stages against a fresh database there.
+
+        :return: A list of stage measurements tagged with the scale name.
+        """
+        working_dir = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = DataGenerator(**scale).write(os.path.join(tmp_dir,
+                                                              'data'))
+            os.makedirs(os.path.join(tmp_dir, 'Output'))
+            # The database URL is relative, so it resolves in the folder
+            models.dispose_engines()
+            os.chdir(tmp_dir)
+            if trace_memory:
+                tracemalloc.start()
+            try:
+                records = self.run_stages(paths,
+                                          os.path.join(tmp_dir, 'Output'),
+                                          trace_memory)
+            finally:
+                if trace_memory:
+                    tracemalloc.stop()
+                models.dispose_engines()
+                os.chdir(working_dir)
+        for record in records:
+            record['scale'] = name
+        return records
+
+    def run(self):
+        """
+        Benchmarks every scale.
+
+        :return: A dictionary with the environment, the scales and one
+        result per scale and stage.
+        """
+        plt.switch_backend('Agg')
+        results = []
+        for name, scale in self.scales.items():
+            print(f"Benchmarking scale {name}: {scale}")
+            records = self.run_scale(name, scale, trace_memory=False)
+            if self.trace_memory:
+                peaks = self.run_scale(name, scale, trace_memory=True)
+                for record, peak in zip(records, peaks):
+                    record['peak_memory_mb'] = peak['peak_memory_mb']
+            for record in records:
+                print(f"  {record['stage']:<32}{record['seconds']:>10.3f}s"
+                      + (f"{record['peak_memory_mb']:>10.1f} MB"
+                         if 'peak_memory_mb' in record else ''))
+            results.extend(records)
+
+        return {'created': datetime.now(timezone.utc).isoformat(),
+                'commit': self.git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'ideal_layout': self.ideal_layout,
+                'peak_rss_mb': peak_rss_mb(),
+                'scales': self.scales,
+                'results': results}
+
+    def git_commit(self):
+        """
+        :return: The current git commit of the repository, None outside of
+        a git checkout.
+        """
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                  capture_output=True, text=True, check=True,
+                                  cwd=os.path.dirname(__file__)).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+
+def compare(baseline, current):
+    """
+    Compares the stage timings and peak memory of two benchmark reports.
+
+    :param baseline: Benchmark report of the reference version
+    :param current: Benchmark report of the new version
+    :return: A list of dictionaries with the ratio of current to baseline
+    per scale and stage found in both reports.
+    """
+    reference = {(record['scale'], record['stage']): record
+                 for record in baseline['results']}
+    comparison = []
+    for record in current['results']:
+        old = reference.get((record['scale'], record['stage']))
+        if old is None:
+            continue
+        row = {'scale': record['scale'], 'stage': record['stage'],
+               'seconds_ratio': record['seconds'] / max(old['seconds'],
+                                                        1e-9)}
+        if 'peak_memory_mb' in record and 'peak_memory_mb' in old:
+            row['memory_ratio'] = record['peak_memory_mb'] / \
+                max(old['peak_memory_mb'], 1e-9)
+        comparison.append(row)
+    return comparison
+
+
+def main(argv=None):
+    """
+    Runs the benchmarks from the command line and writes the JSON report.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmarks ingestion, selection, mapping and plotting.')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'],
+                        choices=sorted(SCALES),
+                        help='named data set sizes to benchmark')
+    parser.add_argument('--samples', type=int,
+                        help='adds a custom scale with this many x values')
+    parser.add_argument('--ideal-functions', type=int, default=50)
+    parser.add_argument('--train-columns', type=int, default=4)
+    parser.add_argument('--test-points', type=int, default=1_000)
+    parser.add_argument('--ideal-layout', default='wide',
+                        choices=['wide', 'long'])
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the second run recording peak memory')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='path of the JSON report')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON report to compare the results with')
+    args = parser.parse_args(argv)
+
+    scales = {name: SCALES[name] for name in args.scales}
+    if args.samples:
+        scales['custom'] = {'samples': args.samples,
+                            'ideal_functions': args.ideal_functions,
+                            'train_columns': args.train_columns,
+                            'test_points': args.test_points}
+    report = BenchmarkRunner(scales, args.ideal_layout,
+                             not args.no_memory).run()
+    with open(args.output, 'w', encoding='utf-8') as output:
+        json.dump(report, output, indent=2)
+    print(f"Benchmark results were written to {args.output}.")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline:
+            comparison = compare(json.load(baseline), report)
+        for row in comparison:
+            print(f"{row['scale']:<8}{row['stage']:<32}"
+                  f"time x{row['seconds_ratio']:.2f}"
+                  + (f"  memory x{row['memory_ratio']:.2f}"
+                     if 'memory_ratio' in row else ''))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+class ColumnarCache:
+    """
+    Stores input tables as one raw float64 file per column, which are memory
+    mapped on load instead of parsing the source CSV file again.
+
+    Every table directory holds a manifest with the column names, the row
+    count and the signature of the source file the table was read from.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Constructs all the attributes for the ColumnarCache object.
+        """
+        self.cache_dir = cache_dir
+
+    def table_dir(self, table):
+        """
+        :return: The directory holding the column files of a table.
+        """
+        return os.path.join(self.cache_dir, table)
+
+    def source_signature(self, source_path, with_hash=True):
+        """
+        Describes the current state of a source file.
+
+        :param with_hash: Includes the SHA-256 digest of the file content
+        :return: A dictionary with the path, mtime, size and optional hash.
+        """
+        stat = os.stat(source_path)
+        signature = {'path': os.path.abspath(source_path),
+                     'mtime_ns': stat.st_mtime_ns,
+                     'size': stat.st_size}
+        if with_hash:
+            digest = hashlib.sha256()
+            with open(source_path, 'rb') as source:
+                for block in iter(lambda: source.read(1 << 20), b''):
+                    digest.update(block)
+            signature['sha256'] = digest.hexdigest()
+        return signature
+
+    def read_manifest(self, table):
+        """
+        :return: The manifest of a cached table, None if there is none.
+        """
+        try:
+            with open(os.path.join(self.table_dir(table), 'manifest.json'),
+                      encoding='utf-8') as manifest:
+                return json.load(manifest)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def is_valid(self, table, source_path=None):
+        """
+        Checks that a cached table still matches its source file. An
+        unchanged mtime and size are trusted, otherwise the content hash of
+        the source decides.
+
+        :param source_path: Source file the table must have been read from,
+        any if None
+        :return: True if the cached table can be used.
+        """
+        manifest = self.read_manifest(table)
+        if manifest is None:
+            return False
+        source = manifest['source']
+        # The table name alone does not tell which source file was cached
+        if source_path is not None and \
+                source['path'] != os.path.abspath(source_path):
+            return False
+        try:
+            current = self.source_signature(source['path'], with_hash=False)
+        except OSError:
+            return False
+        if (current['mtime_ns'], current['size']) == \
+                (source['mtime_ns'], source['size']):
+            return True
+        return current['size'] == source['size'] and \
+            self.source_signature(source['path'])['sha256'] == source['sha256']
+
+    def fingerprint(self, table):
+        """
+        :return: The SHA-256 digest of the source file of a valid cached
+        table, None if the table is not cached or its source changed.
+        """
+        if not self.is_valid(table):
+            return None
+        return self.read_manifest(table)['source']['sha256']
+
+    def write(self, table, chunks, source_path):
+        """
+        Writes the DataFrame chunks of a table column by column. The manifest
+        is written last, so an interrupted write leaves no valid cache.
+
+        :param chunks: Iterable of DataFrames with identical columns
+        :param source_path: Path of the CSV file the chunks were read from
+        """
+        table_dir = self.table_dir(table)
+        os.makedirs(table_dir, exist_ok=True)
+        manifest_path = os.path.join(table_dir, 'manifest.json')
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        columns = None
+        files = []
+        rows = 0
+        try:
+            for chunk in chunks:
+                if columns is None:
+                    columns = list(chunk.columns)
+                    files = [open(os.path.join(table_dir, f'{i}.f64'), 'wb')
+                             for i in range(len(columns))]
+                for i, name in enumerate(columns):
+                    chunk[name].to_numpy(dtype=np.float64).tofile(files[i])
+                rows += len(chunk)
+        finally:
+            for column_file in files:
+                column_file.close()
+
+        manifest = {'table': table,
+                    'columns': columns or [],
+                    'rows': rows,
+                    'source': self.source_signature(source_path)}
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as output:
+            json.dump(manifest, output)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def load(self, table, columns=None, source_path=None):
+        """
+        Memory maps the columns of a valid cached table without copying.
+
+        :param columns: Names of the columns to load, all if None
+        :param source_path: Source file the table must have been read from,
+        any if None
+        :return: A DataFrame backed by the column files, None if the table is
+        not cached, was read from another file or its source file changed.
+        """
+        if not self.is_valid(table, source_path):
+            return None
+        manifest = self.read_manifest(table)
+        names = manifest['columns']
+        columns = names if columns is None else list(columns)
+
+        arrays = {}
+        for name in columns:
+            path = os.path.join(self.table_dir(table),
+                                f'{names.index(name)}.f64')
+            arrays[name] = np.memmap(path, dtype=np.float64, mode='r',
+                                     shape=(manifest['rows'],)) \
+                if manifest['rows'] else np.empty(0, dtype=np.float64)
+        return pd.DataFrame(arrays, copy=False)
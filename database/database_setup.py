@@ -1,40 +1,75 @@
+import logging
 import pandas as pd
-from sqlalchemy import insert
-from .models import create_session, TrainData, IdealFunctions, TestData
+from sqlalchemy import delete, insert
+from monitoring.instrumentation import instrumentation
+from .columnar_cache import ColumnarCache
+from .models import (create_session, CacheState, TrainData, IdealFunctions,
+                     IdealPoints, TestData)
+
+logger = logging.getLogger(__name__)
 
 
 class InsertData:
     """
     Handles the insertion of data from CSV files into the database.
+
+    Inserts run on the 'bulk_load' SQLite profile, which skips fsyncs, as a
+    failed load is simply repeated from the CSV files.
     """
 
-    def __init__(self, train_path, ideal_path, test_path):
+    def __init__(self, train_path, ideal_path, test_path, ideal_layout='wide',
+                 cache_dir=None):
         """
         Constructs all the attributes for the InsertData object.
+
+        :param ideal_layout: 'wide' stores the ideal functions as columns of
+        ideal_functions, 'long' as (function_id, x, y) rows of ideal_points
+        :param cache_dir: Optional directory of the columnar cache of the
+        train and ideal CSV files
         """
+        if ideal_layout not in ('wide', 'long'):
+            raise ValueError(f"Unknown ideal layout: {ideal_layout}")
         self.train_path = train_path
         self.ideal_path = ideal_path
         self.test_path = test_path
+        self.ideal_layout = ideal_layout
+        self.ideal_table = IdealFunctions if ideal_layout == 'wide' \
+            else IdealPoints
+        self.columnar_cache = ColumnarCache(cache_dir) if cache_dir else None
 
     def bulk_insert(self):
         """
         Reads data from the entered CSV files and inserts it into the database.
         """
+        with instrumentation.stage('bulk_insert') as record:
+            self.insert_datasets(record)
+
+    def insert_datasets(self, record):
+        """
+        Reads the CSV files and inserts them in a single transaction.
+
+        :param record: Instrumentation record of the bulk_insert stage
+        """
         try:
             # Reads CSV data as Pandas DataFrame
-            self.train_dataset = pd.read_csv(self.train_path)
-            self.ideal_dataset = pd.read_csv(self.ideal_path)
+            self.train_dataset = self.read_source('train_data',
+                                                  self.train_path)
+            self.ideal_dataset = self.read_source('ideal_functions',
+                                                  self.ideal_path)
             self.test_dataset = pd.read_csv(self.test_path)
-            print("All CSV files were loaded successfully.")
+            logger.info("All CSV files were loaded successfully.")
         except FileNotFoundError as e:
-            print(f"CSV file not found: {e.filename}")
+            logger.error("CSV file not found: %s", e.filename)
             exit()
 
-        session = create_session()
+        # Inserts on the shared engine of the bulk load pragma profile
+        session = create_session(profile='bulk_load')
         # Prepares data for bulk insertion
         datasets = {
             TrainData: self.train_dataset.to_dict(orient='records'),
-            IdealFunctions: self.ideal_dataset.to_dict(orient='records'),
+            self.ideal_table: self.prepare_chunk(
+                self.ideal_table,
+                self.ideal_dataset).to_dict(orient='records'),
             TestData: self.test_dataset.to_dict(orient='records')
         }
 
@@ -43,9 +78,145 @@ class InsertData:
             try:
                 for table, dataset in datasets.items():
                     local_session.execute(insert(table), dataset)
+                self.record_cache_state(local_session, cached=True)
                 local_session.commit()
-                print("Data was successfully inserted into the database.")
+                record['rows'] = sum(map(len, datasets.values()))
+                logger.info("Data was successfully inserted into the "
+                            "database.")
             except Exception as e:
                 # Rollback in case of error
                 local_session.rollback()
-                print(f"Data bulk insert failed. Error occurred: {e}")
+                record['status'] = 'error'
+                logger.error("Data bulk insert failed. Error occurred: %s", e)
+
+    def stream_insert(self, chunk_size=50_000, transaction='chunk'):
+        """
+        Reads the CSV files in chunks of `chunk_size` rows and inserts every
+        chunk as its own batch, so memory stays bounded for very large files.
+
+        :param chunk_size: Number of rows read and inserted per batch
+        :param transaction: 'chunk' commits after every batch, 'single'
+        commits once after all files and rolls everything back on error
+        :return: A dictionary with the number of rows inserted per table.
+        """
+        if transaction not in ('chunk', 'single'):
+            raise ValueError(f"Unknown transaction strategy: {transaction}")
+
+        sources = {
+            TrainData: self.train_path,
+            self.ideal_table: self.ideal_path,
+            TestData: self.test_path
+        }
+        row_counts = {}
+
+        session = create_session(profile='bulk_load')
+        with session as local_session:
+            try:
+                for table, path in sources.items():
+                    with instrumentation.stage(
+                            'stream_insert',
+                            table=table.__tablename__) as record:
+                        self.stream_table(local_session, table, path,
+                                          chunk_size, transaction, record)
+                    row_counts[table.__tablename__] = record['rows']
+                    logger.info("%d rows streamed into %s in %.2fs "
+                                "(%.0f rows/sec).", record['rows'],
+                                table.__tablename__, record['seconds'],
+                                record['rows_per_sec'] or 0)
+                # Streamed rows are read from the CSV files, not the cache
+                self.record_cache_state(local_session, cached=False)
+                local_session.commit()
+                logger.info("Data was successfully streamed into the "
+                            "database.")
+            except FileNotFoundError as e:
+                local_session.rollback()
+                logger.error("CSV file not found: %s", e.filename)
+                exit()
+            except Exception as e:
+                # Rollback the uncommitted chunks in case of error
+                local_session.rollback()
+                logger.error("Data stream insert failed. Error occurred: %s",
+                             e)
+        return row_counts
+
+    def stream_table(self, session, table, path, chunk_size, transaction,
+                     record):
+        """
+        Streams one CSV file into its table in chunks of `chunk_size` rows.
+
+        :param record: Instrumentation record counting the inserted rows
+        """
+        record['rows'] = 0
+        for chunk in pd.read_csv(path, chunksize=chunk_size):
+            # Inserts the chunk rows as plain tuples, no dicts
+            chunk = self.prepare_chunk(table, chunk)
+            statement = self.insert_statement(table, chunk.columns)
+            rows = list(chunk.itertuples(index=False, name=None))
+            session.connection().exec_driver_sql(statement, rows)
+            record['rows'] += len(rows)
+            if transaction == 'chunk':
+                session.commit()
+
+    def read_source(self, table, path):
+        """
+        Reads a CSV file, from the memory-mapped columnar cache when it still
+        matches the file, writing the cache otherwise.
+
+        :param table: Name of the table the CSV file is cached as
+        :return: A Pandas DataFrame with the CSV data.
+        """
+        if self.columnar_cache is None:
+            return pd.read_csv(path)
+        dataset = self.columnar_cache.load(table, source_path=path)
+        if dataset is None:
+            dataset = pd.read_csv(path)
+            self.columnar_cache.write(table, [dataset], path)
+        return dataset
+
+    def record_cache_state(self, session, cached):
+        """
+        Records the source file hash of the cached train and ideal tables
+        along with the inserted rows, so readers only use a columnar cache
+        that holds the rows of the database.
+
+        :param cached: The rows were read through the columnar cache, else
+        any recorded hash is cleared
+        """
+        fingerprints = {
+            table: self.columnar_cache.fingerprint(table)
+            if cached and self.columnar_cache is not None else None
+            for table in ('train_data', 'ideal_functions')}
+        session.execute(delete(CacheState).where(CacheState.name.in_(
+            [table for table, sha256 in fingerprints.items()
+             if sha256 is None])))
+        for table, sha256 in fingerprints.items():
+            if sha256 is not None:
+                session.merge(CacheState(name=table, sha256=sha256))
+
+    def prepare_chunk(self, table, chunk):
+        """
+        Reshapes wide ideal function columns into (function_id, x, y) rows
+        when they are stored in the long ideal_points layout.
+
+        :return: The DataFrame in the column layout of the given table.
+        """
+        if table is not IdealPoints:
+            return chunk
+        # Melting column by column keeps the functions in CSV column order
+        melted = chunk.melt(id_vars='x', var_name='function_id',
+                            value_name='y')
+        return melted[['function_id', 'x', 'y']]
+
+    def insert_statement(self, table, columns):
+        """
+        Builds a positional INSERT statement for the given table columns.
+
+        :return: The SQL string of the INSERT statement.
+        """
+        unknown = set(columns) - set(table.__table__.columns.keys())
+        if unknown:
+            raise ValueError(f"Unknown columns for {table.__tablename__}: "
+                             f"{sorted(unknown)}")
+        placeholders = ', '.join('?' for _ in columns)
+        return (f"INSERT INTO {table.__tablename__} ({', '.join(columns)}) "
+                f"VALUES ({placeholders})")
@@ -1,6 +1,32 @@
+import logging
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped
-from sqlalchemy import Float, String, MetaData, create_engine
+from sqlalchemy import (Float, Index, Integer, String, MetaData, create_engine,
+                        event, inspect)
+
+logger = logging.getLogger(__name__)
+
+# Database file used by the application
+DATABASE_URL = "sqlite:///database.db"
+
+# SQLite pragmas applied to every new connection of an engine profile
+SQLITE_PROFILES = {
+    # WAL lets readers run during writes, NORMAL only fsyncs at checkpoints
+    'default': {'journal_mode': 'WAL',
+                'synchronous': 'NORMAL',
+                'cache_size': -64_000,
+                'mmap_size': 256 * 1024 * 1024,
+                'temp_store': 'MEMORY'},
+    # Bulk loads of reproducible CSV data skip fsyncs and use a larger cache
+    'bulk_load': {'journal_mode': 'WAL',
+                  'synchronous': 'OFF',
+                  'cache_size': -256_000,
+                  'mmap_size': 256 * 1024 * 1024,
+                  'temp_store': 'MEMORY'},
+}
+
+# Engines shared by all sessions, one per database URL and profile
+engines = {}
 
 
 class Base(DeclarativeBase):
@@ -34,6 +60,18 @@ class IdealFunctions(Base):
     # Columns range from y1 to y50
 
 
+class IdealPoints(Base):
+    """
+    Metadata for the ideal_points table in the database.
+    """
+    __tablename__ = "ideal_points"
+    function_id: Mapped[str] = mapped_column(String, primary_key=True)
+    x: Mapped[float] = mapped_column(Float, primary_key=True)
+    y: Mapped[float] = mapped_column(Float, nullable=False)
+    # Long layout of the ideal functions, one row per function and x value
+    # The composite primary key indexes reads of single functions
+
+
 class TestData(Base):
     """
     Metadata for the test_data table in the database.
@@ -46,25 +84,204 @@ class TestData(Base):
     ideal_function: Mapped[str] = mapped_column(String, nullable=True)
     # we need to add an id column to test test table as it has repeated values
     # SQLAlchemy's Declarative Mapping requires a primary key column
+    __table_args__ = (
+        # Points mapped to one ideal function or unmapped (NULL), ordered or
+        # filtered by x
+        Index('ix_test_data_ideal_function_x', 'ideal_function', 'x'),
+        # Points in an x range
+        Index('ix_test_data_x', 'x'),
+    )
+
+
+class SelectedFunctions(Base):
+    """
+    Metadata for the selected_functions table in the database.
+    """
+    __tablename__ = "selected_functions"
+    fingerprint: Mapped[str] = mapped_column(String, primary_key=True)
+    train_function: Mapped[str] = mapped_column(String, primary_key=True)
+    ideal_function: Mapped[str] = mapped_column(String, nullable=False)
+    max_deviation: Mapped[float] = mapped_column(Float, nullable=False)
+    position: Mapped[int] = mapped_column(Integer, nullable=False)
+    # position keeps the train column order, which decides mapping ties
+    # fingerprint is the content hash of the train and ideal tables the
+    # selection was computed from, so changed inputs never hit a stale entry
+
+
+class CandidateScores(Base):
+    """
+    Metadata for the candidate_scores table in the database.
+    """
+    __tablename__ = "candidate_scores"
+    fingerprint: Mapped[str] = mapped_column(String, primary_key=True)
+    train_function: Mapped[str] = mapped_column(String, primary_key=True)
+    rank: Mapped[int] = mapped_column(Integer, primary_key=True)
+    ideal_function: Mapped[str] = mapped_column(String, nullable=False)
+    sse: Mapped[float] = mapped_column(Float, nullable=False)
+    max_deviation: Mapped[float] = mapped_column(Float, nullable=False)
+    rmse: Mapped[float] = mapped_column(Float, nullable=False)
+    # Top k candidates of every train column, rank 0 is the selection
+    # Cached under the fingerprint of the selection they were ranked with
+
+
+class BatchSelectedFunctions(Base):
+    """
+    Metadata for the batch_selected_functions table in the database.
+    """
+    __tablename__ = "batch_selected_functions"
+    dataset_id: Mapped[str] = mapped_column(String, primary_key=True)
+    train_function: Mapped[str] = mapped_column(String, primary_key=True)
+    ideal_function: Mapped[str] = mapped_column(String, nullable=False)
+    max_deviation: Mapped[float] = mapped_column(Float, nullable=False)
+    position: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Selection of every data set of a batch run, in train column order
+
+
+class BatchTestData(Base):
+    """
+    Metadata for the batch_test_data table in the database.
+    """
+    __tablename__ = "batch_test_data"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    dataset_id: Mapped[str] = mapped_column(String, nullable=False)
+    x: Mapped[float] = mapped_column(Float)
+    y: Mapped[float] = mapped_column(Float)
+    delta_y: Mapped[float] = mapped_column(Float, nullable=True)
+    ideal_function: Mapped[str] = mapped_column(String, nullable=True)
+    # Mapped test points of every data set of a batch run
+    __table_args__ = (
+        # Points of one data set, optionally of one ideal function
+        Index('ix_batch_test_data_dataset_function_x', 'dataset_id',
+              'ideal_function', 'x'),
+    )
+
+
+class MappingState(Base):
+    """
+    Metadata for the mapping_state table in the database.
+    """
+    __tablename__ = "mapping_state"
+    name: Mapped[str] = mapped_column(String, primary_key=True)
+    value: Mapped[int] = mapped_column(Integer, nullable=False)
+    fingerprint: Mapped[str] = mapped_column(String, nullable=True)
+    # Stores high-water marks such as the last mapped test_data id
+    # fingerprint is the selection the rows below the mark were mapped with
+
+
+class CacheState(Base):
+    """
+    Metadata for the cache_state table in the database.
+    """
+    __tablename__ = "cache_state"
+    name: Mapped[str] = mapped_column(String, primary_key=True)
+    sha256: Mapped[str] = mapped_column(String, nullable=False)
+    # Source file hash of every columnar cache table the database rows were
+    # inserted from, readers only use a cache holding the same source
+
+
+def create_sqlite_engine(url=DATABASE_URL, profile='default', **pragmas):
+    """
+    Creates an engine that sets the pragmas of a SQLite profile on every new
+    connection.
+
+    :param profile: Name of the pragma profile in SQLITE_PROFILES
+    :param pragmas: Pragma values overriding the ones of the profile
+    :return: The SQLAlchemy Engine object.
+    """
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"Unknown SQLite profile: {profile}")
+    pragmas = {**SQLITE_PROFILES[profile], **pragmas}
+    engine = create_engine(url)
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # Runs outside of any transaction, as journal_mode requires
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return engine
+
+
+def get_engine(url=DATABASE_URL, profile='default'):
+    """
+    Returns the shared engine of a database URL and profile, creating it on
+    first use, so connections are pooled across sessions.
+
+    :return: The cached SQLAlchemy Engine object.
+    """
+    if (url, profile) not in engines:
+        engines[url, profile] = create_sqlite_engine(url, profile)
+    return engines[url, profile]
+
+
+def dispose_engines():
+    """
+    Closes the pooled connections of all shared engines and forgets them,
+    so the next session connects to the database file anew.
+    """
+    for engine in engines.values():
+        engine.dispose()
+    engines.clear()
+
+
+def create_indexes(engine, tables=None):
+    """
+    Creates the indexes defined by the models that are missing in the
+    database, e.g. after a table was replaced by pandas' to_sql.
+
+    :param tables: Names of the tables to index, all model tables if None
+    """
+    for table in Base.metadata.sorted_tables:
+        if tables is None or table.name in tables:
+            for index in table.indexes:
+                index.create(engine, checkfirst=True)
+
+
+def add_missing_columns(engine):
+    """
+    Adds the nullable model columns missing in tables created by earlier
+    versions, e.g. the fingerprint column of mapping_state.
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            present = {column['name']
+                       for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in present and column.nullable:
+                    connection.exec_driver_sql(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                        f"{column.type.compile(engine.dialect)}")
 
 
-def create_session(database_reset=False):
+def create_session(database_reset=False, profile='default', url=DATABASE_URL):
     """
     Creates and returns a session for the specified database.
 
+    :param profile: Name of the SQLite pragma profile of the engine
+    :param url: Database URL of the session
     :return: Session: An instance of SQLAlchemy's `Session` object, used for
             interacting with the database.
     """
-    engine = create_engine("sqlite:///database.db")
+    engine = get_engine(url, profile)
 
     if database_reset:
         # Finds and drops all tables from the specified database
         metadata = MetaData()
         metadata.reflect(bind=engine)
         metadata.drop_all(engine)
-        print("Database initiation was successful.")
+        logger.info("Database initiation was successful.")
     else:
         Base.metadata.create_all(engine)
+        # Adds columns and indexes missing from tables created by earlier
+        # versions
+        add_missing_columns(engine)
+        create_indexes(engine)
 
     Session = sessionmaker(bind=engine)
     return Session()
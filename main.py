@@ -1,32 +1,106 @@
+import uuid
+import logging
+import argparse
+import asyncio
 from database.models import create_session
 from database.database_setup import InsertData
 from ops_viz.data_processing import ProcessData
 from ops_viz.visualizations import VisualizeData
+from ops_viz.mapping_service import PointMapper, MappingServer
+from ops_viz.batch_runner import BatchRunner
+from monitoring.instrumentation import instrumentation, JsonLinesReport
 
+logger = logging.getLogger(__name__)
 
-def main():
+# Memory-mapped columnar copies of the train and ideal CSV files
+CACHE_DIR = "./cache"
+
+
+def serve(port, interpolation='exact'):
+    """
+    Runs the live mapping server on the existing database until interrupted.
+
+    :param port: Local TCP port the server listens on
+    :param interpolation: How test x values off the ideal grid are handled
+    """
+    session = create_session()
+    mapper = PointMapper(session=session, cache_dir=CACHE_DIR,
+                         interpolation=interpolation)
+    try:
+        asyncio.run(MappingServer(mapper, port=port).serve_forever())
+    except KeyboardInterrupt:
+        logger.info("Mapping server stopped.")
+
+
+def batch(source, workers=None, interpolation='exact'):
+    """
+    Fits every train/test data set of a directory or manifest against the
+    bundled ideal functions and stores the results per data set.
+
+    :param source: Batch directory or manifest CSV file
+    :param workers: Number of fitting processes
+    :param interpolation: How test x values off the ideal grid are handled
+    """
+    session = create_session(profile='bulk_load')
+    BatchRunner(session, ideal_path="./data/ideal.csv", cache_dir=CACHE_DIR,
+                workers=workers, interpolation=interpolation).run(source)
+    session.close()
+
+
+def main(incremental=False, interpolation='exact', render_workers=None,
+         force_render=False, compact=False):
     """
     Main function to orchestrate data loading, processing, and visualization.
+
+    :param incremental: Keeps the database and only maps the test points that
+    arrived since the last run, reusing the cached selection.
+    :param interpolation: How test x values off the ideal grid are handled,
+    'exact', 'linear' or 'cubic'
+    :param render_workers: Renders the figures whose inputs changed headless
+    in that many processes instead of displaying them
+    :param force_render: Renders headless figures even if they are unchanged
+    :param compact: Holds the tables as float32 and categorical columns
     """
-    # Resets database and create a session instance
-    session = create_session(database_reset=True)
-
-    # Inserts train, ideal and test data into the database
-    data_loader = InsertData(train_path="./data/train.csv",
-                             ideal_path="./data/ideal.csv",
-                             test_path="./data/test.csv")
-    data_loader.bulk_insert()
-
-    # Processes and analyses the data
-    data_processor = ProcessData(session=session)
-    # Assigns and ideal functions to each train Function (least square)
-    selected_functions = data_processor.select_functions()
-    # Maps individual test Data to one of the four selected ideal Functions
-    data_processor.insert_test_data()
+    if incremental:
+        # Maps only the newly arrived test data of the existing database
+        session = create_session()
+        data_processor = ProcessData(session=session, cache_dir=CACHE_DIR,
+                                     interpolation=interpolation,
+                                     compact=compact)
+        data_processor.map_new_test_data()
+        selected_functions = data_processor.selection
+    else:
+        # Resets database and create a session instance
+        session = create_session(database_reset=True)
+
+        # Inserts train, ideal and test data into the database
+        data_loader = InsertData(train_path="./data/train.csv",
+                                 ideal_path="./data/ideal.csv",
+                                 test_path="./data/test.csv",
+                                 cache_dir=CACHE_DIR)
+        data_loader.bulk_insert()
+
+        # Processes and analyses the data
+        data_processor = ProcessData(session=session, cache_dir=CACHE_DIR,
+                                     interpolation=interpolation,
+                                     compact=compact)
+        # Assigns and ideal functions to each train Function (least square),
+        # skipping hopeless candidates early with the same result
+        selected_functions = data_processor.select_functions(pruned=True)
+        # Maps individual test Data to one of the four selected ideal Functions
+        # in place, keeping the test_data ids that incremental runs rely on
+        data_processor.stream_test_data()
 
     # Visualize results
     data_visualizer = VisualizeData(functions=selected_functions,
-                                    session=session)
+                                    session=session,
+                                    cache_dir=CACHE_DIR,
+                                    compact=compact)
+    if render_workers:
+        # Renders changed figures headless, in parallel processes
+        data_visualizer.render_all(workers=render_workers,
+                                   force=force_render)
+        return
     # Compare training data with ideal functions to see how they align.
     data_visualizer.plot_train_vs_ideal()
     # Show how test data aligns or deviates from each ideal function.
@@ -38,4 +112,48 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description='Fits test data to the best matching ideal functions.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only map test points added since the last run')
+    parser.add_argument('--interpolation', default='exact',
+                        choices=['exact', 'linear', 'cubic'],
+                        help='mapping of test x values off the ideal grid')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='map live test points sent to a local TCP port')
+    parser.add_argument('--render-workers', type=int, metavar='N',
+                        help='render changed figures headless in N '
+                             'processes')
+    parser.add_argument('--force-render', action='store_true',
+                        help='render unchanged figures with --render-workers')
+    parser.add_argument('--batch', metavar='SOURCE',
+                        help='fit every data set of a directory of train.csv'
+                             '/test.csv folders or of a manifest CSV file')
+    parser.add_argument('--workers', type=int, metavar='N',
+                        help='fit the --batch data sets in N processes')
+    parser.add_argument('--compact', action='store_true',
+                        help='hold the data as float32 and categorical '
+                             'columns to save memory')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='DEBUG also logs every measured stage')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='append the stage metrics of the run to a JSON '
+                             'lines report')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level,
+                        format='%(asctime)s %(levelname)s %(name)s: '
+                               '%(message)s')
+    if args.metrics:
+        instrumentation.add_hook(JsonLinesReport(args.metrics,
+                                                 run_id=uuid.uuid4().hex))
+    if args.serve:
+        serve(args.serve, interpolation=args.interpolation)
+    elif args.batch:
+        batch(args.batch, workers=args.workers,
+              interpolation=args.interpolation)
+    else:
+        main(incremental=args.incremental, interpolation=args.interpolation,
+             render_workers=args.render_workers,
+             force_render=args.force_render, compact=args.compact)
@@ -0,0 +1,183 @@
+import sys
+import json
+import time
+import logging
+import functools
+import contextlib
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then not reported
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Number of statements sent to any database since the process started
+db_round_trips = 0
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_round_trip(connection, cursor, statement, parameters, context,
+                     executemany):
+    """
+    Counts every statement execution of every engine, an executemany
+    counts as a single round trip.
+    """
+    global db_round_trips
+    db_round_trips += 1
+
+
+def peak_rss_mb():
+    """
+    :return: The peak resident set size of the process in MB, None where
+    the platform does not report it.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+
+class Instrumentation:
+    """
+    Measures the stages of the pipeline and hands one record per finished
+    stage to the registered hooks.
+
+    Every record holds the stage name, its parent stage, start time,
+    duration, status, row count, rows/sec, the database round trips during
+    the stage and the peak RSS of the process, plus any fields the stage
+    set itself.
+    """
+
+    def __init__(self):
+        """
+        Constructs all the attributes for the Instrumentation object.
+        """
+        self.hooks = []
+        self.active = []
+
+    def add_hook(self, hook):
+        """
+        Registers a callable that receives every stage record.
+
+        :param hook: Callable taking the record dictionary
+        :return: The hook, so it can be removed again.
+        """
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        """
+        Unregisters a hook added with add_hook.
+        """
+        self.hooks.remove(hook)
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        Measures the enclosed block as one stage.
+
+        :param name: Name of the stage
+        :param fields: Fields added to the stage record
+        :return: The record dictionary, the block may set 'rows', 'status'
+        or further fields on it.
+        """
+        record = {'stage': name,
+                  'parent': self.active[-1]['stage'] if self.active else None,
+                  **fields}
+        self.active.append(record)
+        round_trips = db_round_trips
+        started = time.time()
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            yield record
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.active.pop()
+            rows = record.get('rows')
+            record.setdefault('status', status)
+            record.update(
+                started=started,
+                seconds=seconds,
+                rows=None if rows is None else int(rows),
+                rows_per_sec=None if rows is None or seconds <= 0
+                else rows / seconds,
+                db_round_trips=db_round_trips - round_trips,
+                peak_rss_mb=peak_rss_mb())
+            self.emit(record)
+
+    def current(self):
+        """
+        :return: The record of the innermost running stage, a detached
+        dictionary outside of any stage.
+        """
+        return self.active[-1] if self.active else {}
+
+    def instrument(self, name=None, rows=None):
+        """
+        Decorates a function so every call is measured as a stage. The
+        function can add fields to its record through current().
+
+        :param name: Name of the stage, the function name if None
+        :param rows: Optional callable returning the row count of a call
+        from the call arguments
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or function.__name__) as record:
+                    if rows is not None:
+                        record['rows'] = rows(*args, **kwargs)
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def emit(self, record):
+        """
+        Logs a stage record and hands it to every hook. Failing hooks are
+        logged and never break the pipeline.
+        """
+        logger.debug("%s finished in %.3fs (%s rows, %s round trips).",
+                     record['stage'], record['seconds'], record['rows'],
+                     record['db_round_trips'])
+        for hook in list(self.hooks):
+            try:
+                hook(record)
+            except Exception:
+                logger.exception("Instrumentation hook %r failed.", hook)
+
+
+class JsonLinesReport:
+    """
+    Hook appending every stage record as one JSON line to a run report.
+    """
+
+    def __init__(self, path, run_id=None):
+        """
+        Constructs all the attributes for the JsonLinesReport object.
+
+        :param path: Path of the JSON lines file, appended to
+        :param run_id: Optional identifier added to every record of the run
+        """
+        self.path = path
+        self.run_id = run_id
+
+    def __call__(self, record):
+        """
+        Appends a stage record to the report.
+        """
+        if self.run_id is not None:
+            record = {'run_id': self.run_id, **record}
+        with open(self.path, 'a', encoding='utf-8') as report:
+            report.write(json.dumps(record, default=str) + '\n')
+
+
+# Instrumentation shared by all modules of the pipeline
+instrumentation = Instrumentation()
@@ -0,0 +1,290 @@
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from database.columnar_cache import ColumnarCache
+from monitoring.instrumentation import instrumentation
+from .data_processing import MathUtils, ProcessData
+
+logger = logging.getLogger(__name__)
+
+# Ideal function library loaded once in every batch worker process
+batch_library = None
+
+
+def init_batch_worker(library):
+    """
+    Keeps the ideal function library in the worker process.
+
+    :param library: Dictionary with the sorted ideal x values, the function
+    names and the (x, function) array of ideal y values
+    """
+    global batch_library
+    batch_library = library
+
+
+def fit_dataset(dataset_id, train_path, test_path, pruned=True,
+                interpolation='exact', x_tolerance=1e-9):
+    """
+    Selects the ideal functions of one train set and maps its test set,
+    against the library of the worker process.
+
+    :return: A dictionary with the data set id, its selection, the test
+    points with their deviations and ideal functions, the fit time in
+    seconds and an error message, None on success.
+    """
+    start = time.perf_counter()
+    result = {'dataset_id': dataset_id, 'selection': {}, 'error': None}
+    try:
+        train_data = pd.read_csv(train_path)
+        test_data = pd.read_csv(test_path)
+        grid_x, functions, values = (batch_library[key]
+                                     for key in ('x', 'functions', 'values'))
+
+        processor = ProcessData(None, interpolation=interpolation,
+                                x_tolerance=x_tolerance)
+        # Aligns the train rows with the nearest library rows, under the
+        # tolerance rule of the test point mapping
+        _, _, rows, exact = processor.grid_rows(
+            grid_x, train_data['x'].to_numpy(dtype=np.float64), strict=False)
+        if not exact.all():
+            raise KeyError("train x values missing from the ideal library")
+        train_columns = train_data.columns[1:]
+        train_array = np.ascontiguousarray(
+            train_data[train_columns].to_numpy(dtype=np.float64))
+        best_fits, best_sqd, best_max_dev = (
+            MathUtils().pruned_best_fits(train_array, values[rows])
+            if pruned else MathUtils().best_fits(
+                *MathUtils().sqd_dev_matrix(train_array, values[rows])))
+
+        processor.selection = {
+            train_column: [functions[best_fits[i]], float(best_max_dev[i])]
+            for i, train_column in enumerate(train_columns)
+            if np.isfinite(best_sqd[i])}
+        selected = list(dict.fromkeys(
+            ideal_func for ideal_func, _ in processor.selection.values()))
+        ideal_data = pd.DataFrame(
+            values[:, [functions.index(name) for name in selected]],
+            columns=selected)
+        ideal_data.insert(0, 'x', grid_x)
+
+        # Points off the ideal grid stay unmapped instead of failing the set
+        x_values = test_data['x'].to_numpy(dtype=np.float64)
+        y_values = test_data['y'].to_numpy(dtype=np.float64)
+        mapped, delta_y, ideal_functions = processor.map_on_grid(
+            x_values, y_values, processor.ideal_grid(ideal_data),
+            strict=False)
+        all_delta_y = np.full(len(x_values), np.nan)
+        all_delta_y[mapped] = delta_y
+        all_functions = np.full(len(x_values), None, dtype=object)
+        all_functions[mapped] = ideal_functions
+        result.update(selection=processor.selection, train_rows=len(rows),
+                      x=x_values, y=y_values, delta_y=all_delta_y,
+                      ideal_functions=all_functions)
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+class BatchRunner:
+    """
+    Fits many independent train/test data sets against one ideal function
+    library.
+
+    The library is read once and handed to every worker process once. The
+    data sets are fitted in parallel and their selections and mapped test
+    points are stored by the calling process, keyed by data set id, in the
+    batch_selected_functions and batch_test_data tables.
+    """
+
+    def __init__(self, session, ideal_path, cache_dir=None, workers=None,
+                 pruned=True, interpolation='exact', x_tolerance=1e-9):
+        """
+        Constructs all the attributes for the BatchRunner object.
+
+        :param ideal_path: Path of the ideal function library CSV file
+        :param cache_dir: Optional directory of the columnar cache
+        :param workers: Number of fitting processes, in process if None
+        :param pruned: Uses the pruned selection search
+        :param interpolation: How test x values off the ideal grid are
+        handled, 'exact', 'linear' or 'cubic'
+        """
+        if interpolation not in ('exact', 'linear', 'cubic'):
+            raise ValueError(f"Unknown interpolation: {interpolation}")
+        self.session = session
+        self.ideal_path = ideal_path
+        self.columnar_cache = ColumnarCache(cache_dir) if cache_dir else None
+        self.workers = workers
+        self.pruned = pruned
+        self.interpolation = interpolation
+        self.x_tolerance = x_tolerance
+
+    def load_library(self):
+        """
+        Reads the ideal function library, from the columnar cache when it
+        still matches the CSV file.
+
+        :return: A dictionary with the sorted x values, the function names
+        and the (x, function) array of ideal y values.
+        """
+        # The cached table may have been read from another library file
+        ideal_data = self.columnar_cache.load(
+            'ideal_functions', source_path=self.ideal_path) \
+            if self.columnar_cache is not None else None
+        if ideal_data is None:
+            ideal_data = pd.read_csv(self.ideal_path)
+            if self.columnar_cache is not None:
+                self.columnar_cache.write('ideal_functions', [ideal_data],
+                                          self.ideal_path)
+        ideal_data = ideal_data.sort_values('x', kind='stable')
+        return {'x': ideal_data['x'].to_numpy(dtype=np.float64),
+                'functions': list(ideal_data.columns[1:]),
+                'values': np.ascontiguousarray(
+                    ideal_data.iloc[:, 1:].to_numpy(dtype=np.float64))}
+
+    def find_datasets(self, source):
+        """
+        Lists the data sets of a batch, either every sub folder of a
+        directory holding a train.csv and a test.csv file, or the rows of a
+        manifest CSV file with dataset_id, train and test columns, whose
+        relative paths start at the manifest folder.
+
+        :return: A list of (dataset_id, train path, test path) tuples.
+        """
+        if os.path.isdir(source):
+            datasets = []
+            for name in sorted(os.listdir(source)):
+                folder = os.path.join(source, name)
+                train_path = os.path.join(folder, 'train.csv')
+                test_path = os.path.join(folder, 'test.csv')
+                if os.path.isfile(train_path) and os.path.isfile(test_path):
+                    datasets.append((name, train_path, test_path))
+            return datasets
+
+        manifest = pd.read_csv(source, dtype=str)
+        missing = {'dataset_id', 'train', 'test'} - set(manifest.columns)
+        if missing:
+            raise ValueError(f"Manifest misses columns: {sorted(missing)}")
+        if manifest['dataset_id'].duplicated().any():
+            raise ValueError("Manifest has duplicate dataset ids.")
+        base = os.path.dirname(os.path.abspath(source))
+        return [(row.dataset_id, os.path.join(base, row.train),
+                 os.path.join(base, row.test))
+                for row in manifest.itertuples(index=False)]
+
+    def run(self, source):
+        """
+        Fits every data set of a directory or manifest and stores the
+        results.
+
+        :param source: Batch directory or manifest CSV file
+        :return: A dictionary with the number of data sets, train rows, test
+        points and mapped points, the failed data sets, the elapsed seconds
+        and the throughput in data sets and test points per second.
+        """
+        with instrumentation.stage('batch_run') as record:
+            datasets = self.find_datasets(source)
+            library = self.load_library()
+            arguments = [(dataset_id, train_path, test_path, self.pruned,
+                          self.interpolation, self.x_tolerance)
+                         for dataset_id, train_path, test_path in datasets]
+            report = {'datasets': len(datasets), 'train_rows': 0,
+                      'test_points': 0, 'mapped': 0, 'failed': {}}
+
+            if self.workers and self.workers > 1:
+                # Ships the library once per worker instead of per data set
+                with ProcessPoolExecutor(max_workers=self.workers,
+                                         initializer=init_batch_worker,
+                                         initargs=(library,)) as executor:
+                    futures = [executor.submit(fit_dataset, *args)
+                               for args in arguments]
+                    for future in as_completed(futures):
+                        self.collect(future.result(), report)
+            else:
+                init_batch_worker(library)
+                for args in arguments:
+                    self.collect(fit_dataset(*args), report)
+
+            record['rows'] = report['test_points']
+            record.update(datasets=report['datasets'],
+                          failed=len(report['failed']))
+        report['seconds'] = record['seconds']
+        report['datasets_per_sec'] = report['datasets'] / \
+            max(record['seconds'], 1e-9)
+        report['test_points_per_sec'] = report['test_points'] / \
+            max(record['seconds'], 1e-9)
+        logger.info("%d data sets (%d failed), %d test points fitted in "
+                    "%.2fs: %.1f data sets/sec, %.0f test points/sec.",
+                    report['datasets'], len(report['failed']),
+                    report['test_points'], report['seconds'],
+                    report['datasets_per_sec'],
+                    report['test_points_per_sec'])
+        return report
+
+    def collect(self, result, report):
+        """
+        Stores the result of one data set and adds it to the batch report.
+        """
+        dataset_id = result['dataset_id']
+        if result['error'] is not None:
+            report['failed'][dataset_id] = result['error']
+            logger.error("Data set %s failed. Error occurred: %s",
+                         dataset_id, result['error'])
+            return
+        if self.store_result(result):
+            report['train_rows'] += result['train_rows']
+            report['test_points'] += len(result['x'])
+            report['mapped'] += int(np.count_nonzero(
+                pd.notna(result['ideal_functions'])))
+            logger.info("Data set %s fitted in %.3fs.", dataset_id,
+                        result['seconds'])
+        else:
+            report['failed'][dataset_id] = "storing the results failed"
+
+    def store_result(self, result):
+        """
+        Replaces the stored selection and test points of a data set in a
+        single transaction.
+
+        :return: True if the results were stored.
+        """
+        dataset_id = result['dataset_id']
+        selections = [(dataset_id, train_column, ideal_func,
+                       float(max_dev), position)
+                      for position, (train_column, (ideal_func, max_dev))
+                      in enumerate(result['selection'].items())]
+        points = [(dataset_id, x, y, None if np.isnan(dev) else dev,
+                   ideal_func)
+                  for x, y, dev, ideal_func in zip(
+                      result['x'].tolist(), result['y'].tolist(),
+                      result['delta_y'].tolist(),
+                      result['ideal_functions'].tolist())]
+        with instrumentation.stage('batch_store', dataset_id=dataset_id,
+                                   rows=len(points)), \
+                self.session as session:
+            try:
+                connection = session.connection()
+                for table in ('batch_selected_functions', 'batch_test_data'):
+                    connection.exec_driver_sql(
+                        f"DELETE FROM {table} WHERE dataset_id = ?",
+                        (dataset_id,))
+                if selections:
+                    connection.exec_driver_sql(
+                        "INSERT INTO batch_selected_functions (dataset_id, "
+                        "train_function, ideal_function, max_deviation, "
+                        "position) VALUES (?, ?, ?, ?, ?)", selections)
+                if points:
+                    connection.exec_driver_sql(
+                        "INSERT INTO batch_test_data (dataset_id, x, y, "
+                        "delta_y, ideal_function) VALUES (?, ?, ?, ?, ?)",
+                        points)
+                session.commit()
+                return True
+            except Exception as e:
+                session.rollback()
+                logger.error("Storing data set %s failed. Error occurred: "
+                             "%s", dataset_id, e)
+                return False
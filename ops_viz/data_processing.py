@@ -1,49 +1,743 @@
+import logging
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import pandas as pd
 import numpy as np
+from sqlalchemy import delete, insert, literal_column, select, update
+from sqlalchemy import column as sql_column, table as sql_table
+from database.columnar_cache import ColumnarCache
+from database.models import (SelectedFunctions, CandidateScores,
+                             CacheState, MappingState, TestData,
+                             create_indexes)
+from monitoring.instrumentation import instrumentation
+
+logger = logging.getLogger(__name__)
 
 
 class MathUtils:
     """
     A class for mathematical functions used in data processing.
+
+    The kernels work on 2-D blocks of columns and accumulate in float64,
+    whatever the input precision. NaN values propagate unless `skipna` is
+    set, which skips the rows where either column of a pair is NaN. A row
+    `mask` restricts any kernel to the selected rows.
     """
-    def sqd_dev_sum(self, column1, column2):
+    def sqd_dev_sum(self, column1, column2, skipna=False):
         """
         Calculates the squared deviation sum for the specified columns
 
+        :param skipna: Skips rows where either column is NaN
         :return: The sum of squared deviations between the two columns.
         """
-        return sum((column1 - column2) ** 2)
+        return self.pair_stats(column1, column2, skipna)[0]
 
-    def max_deviation(self, column1, column2):
+    def max_deviation(self, column1, column2, skipna=False):
         """
         Calculates the maximum deviation for the specified columns
 
+        :param skipna: Skips rows where either column is NaN
         :return: The maximum deviation between the two columns.
 
         """
-        return max(abs(column1 - column2))
+        return self.pair_stats(column1, column2, skipna)[1]
+
+    def rmse(self, column1, column2, skipna=False):
+        """
+        Calculates the root mean squared deviation for the specified columns
+
+        :param skipna: Skips rows where either column is NaN
+        :return: The root mean squared deviation between the two columns,
+        NaN without any valid row.
+        """
+        return self.pair_stats(column1, column2, skipna)[2]
+
+    def pair_stats(self, column1, column2, skipna=False):
+        """
+        Scores a single pair of columns with the block kernels.
+
+        :return: The squared deviation sum, maximum deviation and root mean
+        squared deviation of the pair.
+        """
+        column1 = np.asarray(column1, dtype=np.float64)[:, np.newaxis]
+        column2 = np.asarray(column2, dtype=np.float64)[:, np.newaxis]
+        sqd_sums, max_devs = self.sqd_dev_matrix(column1, column2,
+                                                 skipna=skipna)
+        counts = self.valid_counts(column1, column2) if skipna \
+            else np.full((1, 1), float(len(column1)))
+        return (float(sqd_sums[0, 0]), float(max_devs[0, 0]),
+                float(self.rmse_matrix(sqd_sums, counts)[0, 0]))
+
+    def sqd_dev_matrix(self, train_array, ideal_array, chunk_size=256,
+                       out=None, skipna=False, mask=None,
+                       max_block_bytes=64 * 2 ** 20):
+        """
+        Calculates the squared deviation sum and the maximum deviation for
+        every pair of train and ideal columns in a single NumPy pass.
+
+        The pairs are processed in blocks of at most `chunk_size` ideal
+        columns in one scratch array reused by every block. The blocks are
+        narrowed to `max_block_bytes`, down to a single pair, so the
+        intermediate deviations stay bounded in memory whatever the row
+        count. Every pair is reduced over its own contiguous row vector, so
+        its sums do not depend on the other columns of the block.
+
+        Float32 inputs are widened block by block, so deviations and sums are
+        always accumulated in float64.
+
+        :param train_array: 2-D float array of shape (rows, train columns)
+        :param ideal_array: 2-D float array of shape (rows, ideal columns)
+        :param chunk_size: Maximum number of ideal columns processed per block
+        :param out: Optional pair of float64 arrays of shape (train columns,
+        ideal columns) the results are written to
+        :param skipna: Skips the rows where either column of a pair is NaN,
+        pairs without any valid row get NaN
+        :param mask: Optional boolean array of the rows to include
+        :param max_block_bytes: Size limit of the float64 scratch array
+        :return: Two arrays of shape (train columns, ideal columns) holding
+        the squared deviation sums and the maximum deviations.
+        """
+        if mask is not None:
+            train_array = train_array[mask]
+        n_rows, n_train = train_array.shape
+        n_ideal = ideal_array.shape[1]
+        if out is None:
+            out = (np.empty((n_train, n_ideal), dtype=np.float64),
+                   np.empty((n_train, n_ideal), dtype=np.float64))
+        sqd_sums, max_devs = out
+        train_columns = np.ascontiguousarray(train_array.T)
+
+        # Splits the train columns only when one ideal column exceeds the
+        # budget, a single row vector is the smallest block
+        column_bytes = max(n_rows, 1) * np.dtype(np.float64).itemsize
+        train_block = max(1, min(n_train, max_block_bytes // column_bytes))
+        ideal_block = max(1, min(chunk_size, n_ideal, max_block_bytes
+                                 // (column_bytes * train_block)))
+        # Deviations of shape (train block columns, ideal block columns, rows)
+        scratch = np.empty((train_block, ideal_block, n_rows),
+                           dtype=np.float64)
+        missing_scratch = np.empty(scratch.shape, dtype=bool) if skipna \
+            else None
+
+        for start in range(0, n_ideal, ideal_block):
+            stop = min(start + ideal_block, n_ideal)
+            block = np.ascontiguousarray(
+                (ideal_array[:, start:stop] if mask is None
+                 else ideal_array[mask, start:stop]).T)
+            for train_start in range(0, n_train, train_block):
+                train_stop = min(train_start + train_block, n_train)
+                pairs = (slice(train_start, train_stop), slice(start, stop))
+                deviations = scratch[:train_stop - train_start,
+                                     :stop - start]
+                np.subtract(train_columns[train_start:train_stop,
+                                          np.newaxis, :],
+                            block[np.newaxis, :, :], out=deviations,
+                            dtype=np.float64)
+                np.abs(deviations, out=deviations)
+                if skipna:
+                    # Missing rows add nothing to the sum and the maximum
+                    missing = np.isnan(deviations, out=missing_scratch[
+                        :train_stop - train_start, :stop - start])
+                    np.copyto(deviations, 0, where=missing)
+                max_devs[pairs] = deviations.max(axis=2)
+                np.square(deviations, out=deviations)
+                sqd_sums[pairs] = deviations.sum(axis=2)
+                if skipna:
+                    empty = missing.all(axis=2)
+                    sqd_sums[pairs][empty] = np.nan
+                    max_devs[pairs][empty] = np.nan
+        return sqd_sums, max_devs
+
+    def valid_counts(self, train_array, ideal_array, chunk_size=256,
+                     mask=None):
+        """
+        Counts the rows where both columns of a pair are not NaN, for every
+        pair of train and ideal columns.
+
+        :param mask: Optional boolean array of the rows to include
+        :return: A float64 array of shape (train columns, ideal columns).
+        """
+        train_valid = ~np.isnan(train_array)
+        if mask is not None:
+            train_valid &= np.asarray(mask, dtype=bool)[:, np.newaxis]
+        train_valid = train_valid.T.astype(np.float64)
+        counts = np.empty((train_array.shape[1], ideal_array.shape[1]))
+        for start in range(0, ideal_array.shape[1], chunk_size):
+            stop = min(start + chunk_size, ideal_array.shape[1])
+            counts[:, start:stop] = train_valid @ \
+                (~np.isnan(ideal_array[:, start:stop])).astype(np.float64)
+        return counts
+
+    def rmse_matrix(self, sqd_sums, counts):
+        """
+        Calculates root mean squared deviations from squared deviation sums.
+
+        :param counts: Number of rows of every sum, as from valid_counts
+        :return: An array shaped like `sqd_sums`, NaN where no row counted.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(counts > 0, np.sqrt(sqd_sums / counts), np.nan)
+
+    def column_sqd_sums(self, train_column, ideal_block):
+        """
+        Calculates the squared deviation sums of one train column against a
+        block of ideal columns.
+
+        :param train_column: 1-D array with the train values
+        :param ideal_block: 2-D array of shape (rows, ideal columns)
+        :return: A 1-D float64 array with one sum per ideal column.
+        """
+        deviations = np.subtract(train_column[:, np.newaxis], ideal_block,
+                                 dtype=np.float64)
+        return np.einsum('ij,ij->j', deviations, deviations)
+
+    def abs_deviations(self, y_values, ideal_values, out=None):
+        """
+        Calculates the absolute deviations of test y values from ideal
+        values in float64.
+
+        :param y_values: 1-D array with the test y values
+        :param ideal_values: Ideal values, 1-D with one value per y value or
+        2-D with one row per y value
+        :param out: Optional float64 array of the result shape to reuse
+        :return: The array of absolute deviations.
+        """
+        if np.ndim(ideal_values) == 2:
+            y_values = y_values[:, np.newaxis]
+        out = np.subtract(y_values, ideal_values, out=out, dtype=np.float64)
+        return np.abs(out, out=out)
+
+    def best_fits(self, sqd_sums, max_devs):
+        """
+        Finds the ideal column with the least squared deviation sum for every
+        train column, keeping the first one on ties.
+
+        :param sqd_sums: Squared deviation sums of shape (train, ideal)
+        :param max_devs: Maximum deviations of shape (train, ideal)
+        :return: The best ideal column index of every train column, followed
+        by its squared deviation sum and maximum deviation.
+        """
+        # NaN sums never win the strict `<` comparison of the column scan
+        sqd_sums = np.where(np.isnan(sqd_sums), np.inf, sqd_sums)
+        best = sqd_sums.argmin(axis=1)
+        rows = np.arange(len(best))
+        return best, sqd_sums[rows, best], max_devs[rows, best]
+
+    def top_fits(self, sqd_sums, max_devs, k):
+        """
+        Ranks the ideal columns of every train column by squared deviation
+        sum, keeping the first one on ties like best_fits.
+
+        :param sqd_sums: Squared deviation sums of shape (train, ideal)
+        :param max_devs: Maximum deviations of shape (train, ideal)
+        :param k: Number of candidates kept per train column
+        :return: The ideal column indices of the k best candidates of every
+        train column, followed by their squared deviation sums and maximum
+        deviations, each of shape (train, k) and ordered by rank.
+        """
+        sqd_sums = np.where(np.isnan(sqd_sums), np.inf, sqd_sums)
+        ranked = np.argsort(sqd_sums, axis=1, kind='stable')[:, :k]
+        return (ranked, np.take_along_axis(sqd_sums, ranked, axis=1),
+                np.take_along_axis(max_devs, ranked, axis=1))
+
+    def row_searchsorted(self, sorted_rows, rows, values, side='left'):
+        """
+        Finds insertion points like np.searchsorted, every value in its own
+        row of a row-wise sorted array, with one vectorized binary search
+        over all values.
+
+        :param sorted_rows: 2-D array sorted along its rows, NaN last
+        :param rows: Row index of every value
+        :param values: 1-D array of the values to insert
+        :param side: 'left' or 'right', as for np.searchsorted
+        :return: The insertion index of every value within its row.
+        """
+        last = sorted_rows.shape[1] - 1
+        before = np.less if side == 'left' else np.less_equal
+        low = np.zeros(len(values), dtype=np.intp)
+        high = np.full(len(values), last + 1, dtype=np.intp)
+        while True:
+            active = low < high
+            if not active.any():
+                return low
+            middle = (low + high) // 2
+            # Finished searches may point past the row, they are masked
+            right = active & before(
+                sorted_rows[rows, np.minimum(middle, last)], values)
+            low = np.where(right, middle + 1, low)
+            high = np.where(active & ~right, middle, high)
+
+    def pruned_best_fits(self, train_array, ideal_array, chunk_size=256,
+                         first_block=1024, sample_step=64,
+                         max_block_bytes=64 * 2 ** 20):
+        """
+        Finds the same best fits as best_fits over the full deviation
+        matrix, without scoring hopeless candidates over all rows.
+
+        :return: The best ideal column index of every train column, followed
+        by its squared deviation sum and maximum deviation.
+        """
+        return tuple(values[:, 0] for values in self.pruned_top_fits(
+            train_array, ideal_array, 1, chunk_size, first_block,
+            sample_step, max_block_bytes))
+
+    def pruned_top_fits(self, train_array, ideal_array, k=1, chunk_size=256,
+                        first_block=1024, sample_step=64,
+                        max_block_bytes=64 * 2 ** 20):
+        """
+        Finds the same top k candidates as top_fits over the full deviation
+        matrix, without scoring hopeless candidates over all rows.
+
+        Every train column gets k incumbents, the ideal columns closest on a
+        subsample of every `sample_step`-th row, and the largest of their
+        full squared deviation sums is the bound. Squared deviation sums over
+        a subset of rows are lower bounds of the full sum, so candidates
+        whose subsample sum or running sum over row blocks of doubling size
+        exceeds the bound are dropped. The bound carries a margin for the
+        rounding of both sums, so only candidates the exhaustive scan ranks
+        strictly worse than k others are dropped. The survivors are scored
+        with sqd_dev_matrix and top_fits.
+
+        The row blocks stop doubling once a single candidate column exceeds
+        `max_block_bytes`, and the candidates of every block are scored in
+        column chunks within the same budget as sqd_dev_matrix.
+
+        :param k: Number of candidates kept per train column
+        :param first_block: Number of rows of the first block, later blocks
+        double in size
+        :param sample_step: Row step of the subsample seeding the bounds
+        :param max_block_bytes: Size limit of the block temporaries
+        :return: The ideal column indices of the k best candidates of every
+        train column, followed by their squared deviation sums and maximum
+        deviations, each of shape (train, k) and ordered by rank.
+        """
+        n_rows, n_train = train_array.shape
+        n_ideal = ideal_array.shape[1]
+        # Relative rounding error bound of float64 sums over n_rows terms
+        margin = 1 + 8 * (n_rows + 2) * np.finfo(np.float64).eps
+        alive = np.ones((n_train, n_ideal), dtype=bool)
+        # Every scored cell holds a copied ideal value and its float64
+        # deviation
+        cell_bytes = ideal_array.dtype.itemsize \
+            + np.dtype(np.float64).itemsize
+        max_rows = max(1, max_block_bytes // cell_bytes)
+
+        # Scores all candidates on the coarse subsample
+        sample_sums, _ = self.sqd_dev_matrix(train_array[::sample_step],
+                                             ideal_array[::sample_step],
+                                             chunk_size,
+                                             max_block_bytes=max_block_bytes)
+        incumbents = np.argsort(np.where(np.isnan(sample_sums), np.inf,
+                                         sample_sums),
+                                axis=1, kind='stable')[:, :k]
+
+        for i in range(n_train):
+            # NaN or infinite bounds prune nothing, comparisons stay False
+            bound = self.sqd_dev_matrix(
+                train_array[:, i:i + 1], ideal_array[:, incumbents[i]],
+                chunk_size, max_block_bytes=max_block_bytes)[0].max() \
+                * margin
+            alive[i] = ~(sample_sums[i] > bound)
+
+            # Accumulates the surviving candidates over growing row blocks
+            partial_sums = np.zeros(n_ideal)
+            start, size = 0, min(first_block, max_rows)
+            while start < n_rows and np.count_nonzero(alive[i]) > k:
+                stop = min(start + size, n_rows)
+                columns = np.flatnonzero(alive[i])
+                width = max(1, max_block_bytes // ((stop - start)
+                                                   * cell_bytes))
+                for first in range(0, len(columns), width):
+                    chunk = columns[first:first + width]
+                    partial_sums[chunk] += self.column_sqd_sums(
+                        train_array[start:stop, i],
+                        ideal_array[start:stop, chunk])
+                alive[i, columns] = ~(partial_sums[columns] > bound)
+                # Scanning the other half costs as much as scoring the
+                # survivors, so weakly pruned columns go straight to it
+                if 2 * stop >= n_rows \
+                        and 2 * np.count_nonzero(alive[i]) > n_ideal:
+                    break
+                start, size = stop, min(size * 2, max_rows)
+
+        # Scores the survivors exactly like the exhaustive scan, copying
+        # them in column chunks within the budget
+        columns = np.flatnonzero(alive.any(axis=0))
+        sqd_sums = np.empty((n_train, len(columns)), dtype=np.float64)
+        max_devs = np.empty((n_train, len(columns)), dtype=np.float64)
+        width = max(1, max_block_bytes // (max(n_rows, 1) * cell_bytes))
+        for first in range(0, len(columns), width):
+            chunk = slice(first, first + width)
+            self.sqd_dev_matrix(train_array, ideal_array[:, columns[chunk]],
+                                chunk_size,
+                                out=(sqd_sums[:, chunk], max_devs[:, chunk]),
+                                max_block_bytes=max_block_bytes)
+        sqd_sums[~alive[:, columns]] = np.inf
+        ranked, top_sqd, top_max_dev = self.top_fits(sqd_sums, max_devs, k)
+        return columns[ranked], top_sqd, top_max_dev
+
+
+def select_shard(shared_arrays, start, stop, chunk_size, pruned=False, k=1):
+    """
+    Process pool worker finding the top k candidates among the ideal columns
+    `start` to `stop`, reading the arrays from shared memory.
+
+    :param shared_arrays: Maps 'train' and 'ideal' to the name, shape and
+    dtype of their shared memory block
+    :param pruned: Uses the pruned search instead of the full matrix
+    :param k: Number of candidates kept per train column
+    :return: The ideal column indices of the k best candidates, relative to
+    the whole ideal array, followed by their squared deviation sums and
+    maximum deviations, each of shape (train, k).
+    """
+    segments = {key: shared_memory.SharedMemory(name=name)
+                for key, (name, _, _) in shared_arrays.items()}
+    try:
+        train_array, ideal_array = (
+            np.ndarray(shared_arrays[key][1], dtype=shared_arrays[key][2],
+                       buffer=segments[key].buf)
+            for key in ('train', 'ideal'))
+        math = MathUtils()
+        if pruned:
+            ranked, top_sqd, top_max_dev = math.pruned_top_fits(
+                train_array, ideal_array[:, start:stop], k, chunk_size)
+        else:
+            ranked, top_sqd, top_max_dev = math.top_fits(
+                *math.sqd_dev_matrix(train_array, ideal_array[:, start:stop],
+                                     chunk_size), k)
+        # Drops the views on the shared buffers before closing them
+        del train_array, ideal_array
+        return ranked + start, top_sqd, top_max_dev
+    finally:
+        for segment in segments.values():
+            segment.close()
 
 
 class DataHandler:
     """
     Base Class for handling data loading
+
+    In `compact` mode numeric columns are held as float32 and the
+    ideal_function column of the test data as a categorical of small integer
+    codes, which halves the memory of wide ideal tables and large test sets.
     """
-    def __init__(self, session):
+    def __init__(self, session, ideal_layout='wide', cache_dir=None,
+                 compact=False):
         self.session = session
+        self.ideal_layout = ideal_layout
+        self.columnar_cache = ColumnarCache(cache_dir) if cache_dir else None
+        self.compact = compact
+        # Precision the numeric columns are held and selected in
+        self.float_dtype = np.float32 if compact else np.float64
+
+    def compact_frame(self, data):
+        """
+        Converts a loaded table to the compact representation: float columns
+        to float32 and the ideal_function column to a categorical.
+
+        :return: A new DataFrame, the integer id column is kept as is.
+        """
+        columns = {}
+        for name, values in data.items():
+            if name == 'ideal_function':
+                columns[name] = values.astype('category')
+            elif pd.api.types.is_float_dtype(values.dtype):
+                columns[name] = values.astype(np.float32)
+            else:
+                columns[name] = values
+        return pd.DataFrame(columns, index=data.index)
+
+    def cache_matches(self, table):
+        """
+        Checks that the columnar cache of a table holds the rows of the
+        database, by the source file hash recorded when they were inserted.
 
-    def get_data(self, table):
+        :return: True if the table can be read from the columnar cache.
+        """
+        if self.columnar_cache is None or self.session is None:
+            return False
+        fingerprint = self.columnar_cache.fingerprint(table)
+        if fingerprint is None:
+            return False
+        with self.session as session:
+            try:
+                state = session.get(CacheState, table)
+            except Exception as e:
+                session.rollback()
+                logger.error("Fetching the cache state failed. "
+                             "Error occurred: %s", e)
+                return False
+            return state is not None and state.sha256 == fingerprint
+
+    def get_data(self, table, columns=None, x_range=None):
         """
         Loads a database table into a DataFrame using SQLAlchemy's session.
 
+        Loaded tables are cached for the lifetime of the session, so repeated
+        reads are served from memory until the table is written to. Tables
+        of a columnar cache holding the database rows are memory mapped
+        instead of being read.
+
+        :param columns: Names of the columns to load, all if None
+        :param x_range: Optional inclusive (min, max) bounds of the x column
         :return: A Pandas DataFrame with data from the specified table
         """
+        with instrumentation.stage('get_data', table=table) as record:
+            data, record['source'] = self.load_data(table, columns, x_range)
+            if data is None:
+                record['status'] = 'error'
+            else:
+                record['rows'] = len(data)
+            return data
+
+    def load_data(self, table, columns, x_range):
+        """
+        Loads a table from the session cache, the columnar cache or the
+        database, in this order.
+
+        :return: The DataFrame, None if loading failed, and the name of the
+        source it was loaded from.
+        """
+        cache = self.table_cache()
+        # Lists of columns or bounds hash like the equal tuples
+        key = (table, None if columns is None else tuple(columns),
+               None if x_range is None else tuple(x_range))
+        # Compact tables are converted once on load and cached converted
+        convert = self.compact_frame if self.compact else (lambda data: data)
+        if key in cache:
+            return cache[key].copy(), 'session_cache'
+        if (table, None, None) in cache:
+            # Projects and filters the cached full table
+            data = cache[(table, None, None)]
+            if x_range is not None:
+                data = data[data['x'].between(*x_range)].reset_index(drop=True)
+            return (data if columns is None
+                    else data[list(columns)]).copy(), 'session_cache'
+        if self.cache_matches(table):
+            data = self.columnar_cache.load(table)
+            if data is not None:
+                # Memory mapped columns are read-only and never copied
+                if x_range is not None:
+                    data = data[data['x'].between(*x_range)]
+                    data = data.reset_index(drop=True)
+                return convert(data if columns is None
+                               else data[list(columns)]), 'columnar_cache'
+
         with self.session as session:
             try:
-                return pd.read_sql_table(table, session.bind)
+                if x_range is None:
+                    data = pd.read_sql_table(table, session.bind,
+                                             columns=columns)
+                else:
+                    selected = [sql_column(name) for name in columns] \
+                        if columns is not None else [literal_column('*')]
+                    query = select(*selected).select_from(sql_table(table)) \
+                        .where(sql_column('x').between(*x_range))
+                    data = pd.read_sql_query(query, session.bind)
             except Exception as e:
-                print(f"Fetching {table} data failed. Error occurred: {e}")
+                logger.error("Fetching %s data failed. Error occurred: %s",
+                             table, e)
+                return None, 'database'
             except pd.errors.DatabaseError as e:
-                print(f"Error retrieving {table} data: {e}")
+                logger.error("Error retrieving %s data: %s", table, e)
+                return None, 'database'
+        cache[key] = data = convert(data)
+        return data.copy(), 'database'
+
+    def table_cache(self):
+        """
+        Returns the table cache stored in the info dictionary of the session,
+        shared by every DataHandler using the same session.
+
+        Compact and full precision tables are cached separately.
+
+        :return: A dictionary mapping (table, columns, x_range) to DataFrames.
+        """
+        info = getattr(self.session, 'info', None)
+        if not isinstance(info, dict):
+            # Without a real session nothing is cached
+            return {}
+        return info.setdefault(
+            'compact_table_cache' if self.compact else 'table_cache', {})
+
+    def invalidate_cache(self, table, data=None):
+        """
+        Drops the cached reads of a table after it was written to.
+
+        :param data: Optional DataFrame holding the new full table content,
+        cached instead of being read again
+        """
+        info = getattr(self.session, 'info', None)
+        # Drops the reads of both representations
+        for name in ('table_cache', 'compact_table_cache'):
+            cache = info.get(name, {}) if isinstance(info, dict) else {}
+            for key in [key for key in cache if key[0] == table]:
+                del cache[key]
+        if data is not None:
+            self.table_cache()[(table, None, None)] = data.copy()
+
+    def test_points_query(self, ideal_function=None, unmapped=False,
+                          x_range=None):
+        """
+        Builds the query of test points on one of the indexed access paths
+        of test_data: points mapped to an ideal function, unmapped points or
+        points in an x range, each ordered by x.
+
+        :param ideal_function: Name of the ideal function the points are
+        mapped to, all points if None
+        :param unmapped: Selects only the points without ideal function
+        :param x_range: Optional inclusive (min, max) bounds of x
+        :return: The SQLAlchemy Select object.
+        """
+        query = select(TestData.id, TestData.x, TestData.y, TestData.delta_y,
+                       TestData.ideal_function)
+        if ideal_function is not None:
+            query = query.where(TestData.ideal_function == ideal_function)
+        elif unmapped:
+            query = query.where(TestData.ideal_function.is_(None))
+        if x_range is not None:
+            query = query.where(TestData.x.between(*x_range))
+        return query.order_by(TestData.x)
+
+    def get_test_points(self, ideal_function=None, unmapped=False,
+                        x_range=None):
+        """
+        Loads the test points mapped to one ideal function, the unmapped test
+        points or the test points in an x range through the test_data
+        indexes. A cached full test_data table is filtered in memory instead.
+
+        :param ideal_function: Name of the ideal function the points are
+        mapped to, all points if None
+        :param unmapped: Loads only the points without ideal function
+        :param x_range: Optional inclusive (min, max) bounds of x
+        :return: A Pandas DataFrame with the test points ordered by x
+        """
+        cache = self.table_cache()
+        if ('test_data', None, None) in cache:
+            data = cache[('test_data', None, None)]
+            if ideal_function is not None:
+                data = data[data['ideal_function'] == ideal_function]
+            elif unmapped:
+                data = data[data['ideal_function'].isna()]
+            if x_range is not None:
+                data = data[data['x'].between(*x_range)]
+            return data.sort_values('x', kind='stable') \
+                .reset_index(drop=True)
+
+        with self.session as session:
+            try:
+                data = pd.read_sql_query(
+                    self.test_points_query(ideal_function, unmapped,
+                                           x_range),
+                    session.connection())
+                return self.compact_frame(data) if self.compact else data
+            except Exception as e:
+                logger.error("Fetching test points failed. "
+                             "Error occurred: %s", e)
+                return None
+
+    def get_ideal_data(self, functions=None):
+        """
+        Loads the ideal functions as a wide DataFrame with an x column
+        followed by one column per function, from either storage layout.
+
+        :param functions: Names of the ideal functions to load, all if None
+        :return: A Pandas DataFrame with x and the requested ideal functions
+        """
+        if functions is not None:
+            # Drops duplicates, two train columns may share an ideal function
+            functions = list(dict.fromkeys(functions))
+        if self.ideal_layout == 'wide' or \
+                self.cache_matches('ideal_functions'):
+            return self.get_data('ideal_functions', columns=None
+                                 if functions is None else ['x'] + functions)
+
+        query = "SELECT function_id, x, y FROM ideal_points"
+        parameters = ()
+        if functions is not None:
+            # Only the requested functions are read, through the primary key
+            placeholders = ', '.join('?' for _ in functions)
+            query += f" WHERE function_id IN ({placeholders})"
+            parameters = tuple(functions)
+        with self.session as session:
+            try:
+                # Rowid order keeps the functions in their inserted order
+                long_data = pd.read_sql_query(query + " ORDER BY rowid",
+                                              session.connection(),
+                                              params=parameters)
+            except Exception as e:
+                logger.error("Fetching ideal_points data failed. "
+                             "Error occurred: %s", e)
+                return None
+
+        if functions is None:
+            functions = list(pd.unique(long_data['function_id']))
+        ideal_data = long_data.pivot(index='x', columns='function_id',
+                                     values='y')
+        ideal_data = ideal_data.reindex(columns=functions).reset_index()
+        ideal_data.columns.name = None
+        return self.compact_frame(ideal_data) if self.compact else ideal_data
+
+    def data_fingerprint(self, *tables):
+        """
+        Calculates a content hash of the given DataFrames, covering their
+        column names and float64 values.
+
+        :return: The hexadecimal SHA-256 digest of the tables.
+        """
+        digest = hashlib.sha256()
+        for table in tables:
+            digest.update(','.join(map(str, table.columns)).encode())
+            values = table.to_numpy(dtype=np.float64)
+            digest.update(np.ascontiguousarray(values).tobytes())
+        return digest.hexdigest()
+
+    def load_selection(self, fingerprint):
+        """
+        Loads a cached selection from the selected_functions table.
+
+        :param fingerprint: Content hash of the train and ideal tables
+        :return: A dictionary mapping training data columns to their selected
+        ideal function, empty if no selection is cached for the fingerprint.
+        """
+        with self.session as session:
+            rows = session.scalars(
+                select(SelectedFunctions)
+                .where(SelectedFunctions.fingerprint == fingerprint)
+                .order_by(SelectedFunctions.position)).all()
+            return {row.train_function: [row.ideal_function,
+                                         row.max_deviation]
+                    for row in rows}
+
+    def load_scores(self, fingerprint=None, train_function=None):
+        """
+        Loads the cached top k candidates of the selection.
+
+        :param fingerprint: Content hash of the train and ideal tables, the
+        latest cached scores if None
+        :param train_function: Name of a train column, all columns if None
+        :return: A DataFrame with train_function, rank, ideal_function, sse,
+        max_deviation and rmse columns, ordered by train column and rank,
+        None if loading failed.
+        """
+        query = select(CandidateScores.train_function, CandidateScores.rank,
+                       CandidateScores.ideal_function, CandidateScores.sse,
+                       CandidateScores.max_deviation, CandidateScores.rmse)
+        if fingerprint is not None:
+            query = query.where(CandidateScores.fingerprint == fingerprint)
+        if train_function is not None:
+            query = query.where(
+                CandidateScores.train_function == train_function)
+        query = query.order_by(CandidateScores.train_function,
+                               CandidateScores.rank)
+        with self.session as session:
+            try:
+                return pd.read_sql_query(query, session.connection())
+            except Exception as e:
+                logger.error("Fetching candidate scores failed. "
+                             "Error occurred: %s", e)
+                return None
 
 
 class ProcessData(DataHandler):
@@ -54,75 +748,657 @@ class ProcessData(DataHandler):
         - Assigns and ideal functions to each train Function (least square)
         - Maps individual test Data to one of the four selected ideal Functions
     """
-    def __init__(self, session):
-        super().__init__(session)
+    # Selections with this many functions are mapped through a band index
+    band_index_min_functions = 16
+
+    def __init__(self, session, ideal_layout='wide', cache_dir=None,
+                 interpolation='exact', x_tolerance=1e-9, compact=False):
+        """
+        Constructs all the attributes for the ProcessData object.
+
+        :param interpolation: 'exact' requires test x values on the ideal
+        grid, 'linear' or 'cubic' interpolate between grid points
+        :param x_tolerance: Distance to a grid point counted as an exact hit
+        :param compact: Holds the tables as float32 and categorical columns
+        """
+        if interpolation not in ('exact', 'linear', 'cubic'):
+            raise ValueError(f"Unknown interpolation: {interpolation}")
+        super().__init__(session, ideal_layout, cache_dir, compact)
         self.math = MathUtils()
+        self.interpolation = interpolation
+        self.x_tolerance = x_tolerance
 
-    def select_functions(self):
+    @instrumentation.instrument()
+    def select_functions(self, chunk_size=256, use_cache=True, workers=None,
+                         pruned=False, top_k=3, skipna=False):
         """
         Selects the 4 ideal functions which have the minimum sum of all
         y-deviations squared then calculates their maximum deviation.
 
+        The whole train x ideal deviation matrix is computed at once, with the
+        ideal columns processed in blocks of `chunk_size`. Selections are
+        cached in the database by the content hash of both tables. With more
+        than one of `workers` the ideal columns are sharded across processes.
+        The `pruned` search skips hopeless candidates early and selects the
+        same functions as the full matrix.
+
+        The same pass ranks the `top_k` best candidates of every train column,
+        kept in `self.scores` and cached in the candidate_scores table along
+        with the selection. The pruned search bounds candidates by the k-th
+        best score, so `top_k=1` prunes the most.
+
+        With `skipna` the rows where either column of a pair is missing are
+        skipped and candidates are ranked by their mean squared deviation,
+        so pairs with different numbers of missing rows stay comparable. It
+        always computes the full matrix in this process.
+
         :return: A dictionary mapping training data columns to their selected
         ideal function.
         """
         # loads data from database
-        ideal_data = self.get_data('ideal_functions')
+        ideal_data = self.get_ideal_data()
         train_data = self.get_data('train_data')
+        train_columns = train_data.columns[1:]
+        ideal_columns = ideal_data.columns[1:]
+
+        # Reuses the selection cached for identical train and ideal data
+        use_cache = use_cache and self.session is not None
+        self.fingerprint = self.data_fingerprint(train_data, ideal_data)
+        if skipna:
+            # Skipping missing rows scores differently, so it caches apart
+            self.fingerprint += ':skipna'
+        record = instrumentation.current()
+        record.update(rows=len(train_data), train_columns=len(train_columns),
+                      ideal_functions=len(ideal_columns), cached=False)
+        top_k = max(1, min(top_k, len(ideal_columns)))
+        if use_cache:
+            self.selection = self.load_selection(self.fingerprint)
+            self.scores = self.load_scores(self.fingerprint)
+            # Cached scores of fewer candidates than requested are recomputed
+            if self.selection and self.scores is not None and \
+                    (self.scores['rank'].max() if len(self.scores) else -1) \
+                    >= top_k - 1:
+                record['cached'] = True
+                logger.info("The cached selection was reused: %s",
+                            self.selection)
+                return self.selection
+
+        # Converts the y columns into contiguous arrays of the held precision
+        train_array = np.ascontiguousarray(
+            train_data[train_columns].to_numpy(dtype=self.float_dtype))
+        ideal_array = np.ascontiguousarray(
+            ideal_data[ideal_columns].to_numpy(dtype=self.float_dtype))
+        counts = None
+        if skipna:
+            sqd_sums, max_devs = self.math.sqd_dev_matrix(
+                train_array, ideal_array, chunk_size, skipna=True)
+            counts = self.math.valid_counts(train_array, ideal_array,
+                                            chunk_size)
+            # Ranks by the squared deviation sum scaled to all train rows
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ranked = self.math.top_fits(
+                    sqd_sums * len(train_data) / counts, max_devs, top_k)[0]
+            top_sqd, top_max_dev, counts = (
+                np.take_along_axis(matrix, ranked, axis=1)
+                for matrix in (sqd_sums, max_devs, counts))
+        elif workers and workers > 1:
+            ranked, top_sqd, top_max_dev = self.parallel_top_fits(
+                train_array, ideal_array, chunk_size, workers, pruned, top_k)
+        elif pruned:
+            ranked, top_sqd, top_max_dev = self.math.pruned_top_fits(
+                train_array, ideal_array, top_k, chunk_size)
+        else:
+            # Stable ranking keeps the first minimum, the tie-break of the scan
+            ranked, top_sqd, top_max_dev = self.math.top_fits(
+                *self.math.sqd_dev_matrix(train_array, ideal_array,
+                                          chunk_size), top_k)
 
         self.selection = {}
-        # Loops through the train_data table columns Y1,..,Y4
-        for train_column in train_data.columns[1:]:
-            least_squared = float('inf')
-
-            # Loops through the ideal_functions table columns Y1,..,Y50
-            for ideal_column in ideal_data.columns[1:]:
-                sqd_sum = self.math.sqd_dev_sum(train_data[train_column],
-                                                ideal_data[ideal_column])
-                if least_squared > sqd_sum:
-                    # Finds the function with the least squared error
-                    least_squared = sqd_sum
-                    # Finds max deviation between train data and ideal function
-                    max_dev = self.math.max_deviation(train_data[train_column],
-                                                      ideal_data[ideal_column])
-                    self.selection[train_column] = [ideal_column, max_dev]
-        print("The following functions has been selected: \n", self.selection)
+        for i, train_column in enumerate(train_columns):
+            if np.isfinite(top_sqd[i, 0]):
+                self.selection[train_column] = [
+                    ideal_columns[ranked[i, 0]], float(top_max_dev[i, 0])]
+        self.scores = self.candidate_scores(train_columns, ideal_columns,
+                                            ranked, top_sqd, top_max_dev,
+                                            len(train_data), counts)
+        logger.info("The following functions has been selected: %s",
+                    self.selection)
+        if use_cache:
+            self.save_selection()
         return self.selection
 
+    def candidate_scores(self, train_columns, ideal_columns, ranked,
+                         top_sqd, top_max_dev, n_rows, counts=None):
+        """
+        Collects the ranked candidates of every train column in a score
+        table, leaving out candidates without a finite score.
+
+        :param ranked: Ideal column indices of shape (train, k)
+        :param top_sqd: Squared deviation sums of shape (train, k)
+        :param top_max_dev: Maximum deviations of shape (train, k)
+        :param n_rows: Number of train rows, the RMSE denominator
+        :param counts: Optional rows of every score of shape (train, k),
+        replacing `n_rows` when missing rows were skipped
+        :return: A DataFrame with train_function, rank, ideal_function, sse,
+        max_deviation and rmse columns, ordered by train column and rank.
+        """
+        n_train, k = ranked.shape
+        scores = pd.DataFrame({
+            'train_function': np.repeat(np.asarray(train_columns,
+                                                   dtype=object), k),
+            'rank': np.tile(np.arange(k), n_train),
+            'ideal_function': np.asarray(ideal_columns,
+                                         dtype=object)[ranked.ravel()],
+            'sse': top_sqd.ravel(),
+            'max_deviation': top_max_dev.ravel(),
+            'rmse': self.math.rmse_matrix(
+                top_sqd, np.full(top_sqd.shape, max(n_rows, 1))
+                if counts is None else counts).ravel()})
+        return scores[np.isfinite(scores['sse'])].reset_index(drop=True)
+
+    def parallel_top_fits(self, train_array, ideal_array, chunk_size,
+                          workers, pruned=False, k=1):
+        """
+        Shards the ideal columns across a process pool and merges the local
+        top k candidates of every shard into the global top k per train
+        column.
+
+        The arrays are handed to the workers through shared memory instead of
+        being pickled.
+
+        :return: The ideal column indices of the k best candidates of every
+        train column, followed by their squared deviation sums and maximum
+        deviations, each of shape (train, k) and ordered by rank.
+        """
+        n_ideal = ideal_array.shape[1]
+        # Several contiguous shards per worker balance uneven shard runtimes
+        bounds = np.linspace(0, n_ideal, min(n_ideal, workers * 4) + 1)
+        shards = [(int(start), int(stop))
+                  for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        segments = []
+        try:
+            shared_arrays = {}
+            for key, array in (('train', train_array),
+                               ('ideal', ideal_array)):
+                segment = shared_memory.SharedMemory(
+                    create=True, size=max(array.nbytes, 1))
+                segments.append(segment)
+                np.ndarray(array.shape, dtype=array.dtype,
+                           buffer=segment.buf)[...] = array
+                shared_arrays[key] = (segment.name, array.shape,
+                                      array.dtype.str)
+
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(select_shard, shared_arrays,
+                                           start, stop, chunk_size, pruned,
+                                           k)
+                           for start, stop in shards]
+                results = [future.result() for future in futures]
+        finally:
+            for segment in segments:
+                segment.close()
+                segment.unlink()
+
+        # Shards are in column order, so a stable sort keeps the first tie
+        ranked, top_sqd, top_max_dev = (
+            np.concatenate([result[i] for result in results], axis=1)
+            for i in range(3))
+        order = np.argsort(top_sqd, axis=1, kind='stable')[:, :k]
+        return tuple(np.take_along_axis(values, order, axis=1)
+                     for values in (ranked, top_sqd, top_max_dev))
+
+    def thresholds(self):
+        """
+        :return: The deviation threshold (√2 * max_deviation) of every
+        selected function, in selection order.
+        """
+        return np.array([max_dev for _, max_dev in self.selection.values()],
+                        dtype=np.float64) * np.sqrt(2)
+
+    def ideal_grid(self, ideal_data):
+        """
+        Sorts the ideal x axis and the selected ideal functions once, so test
+        points can be located on it with a binary search.
+
+        Selections of at least `band_index_min_functions` functions also get
+        a threshold band index in 'exact' mode, see band_index.
+
+        :param ideal_data: DataFrame with x and the selected ideal functions
+        :return: A tuple of the sorted x values, the matching (x, function)
+        array of ideal y values, for cubic interpolation their slopes and the
+        band index or None.
+        """
+        functions = [ideal_func for ideal_func, _ in self.selection.values()]
+        ideal_x = ideal_data['x'].to_numpy(dtype=np.float64)
+        order = np.argsort(ideal_x, kind='stable')
+        grid_x = ideal_x[order]
+        grid_y = ideal_data[functions].to_numpy(dtype=np.float64)[order]
+
+        slopes = None
+        if self.interpolation == 'cubic' and len(grid_x) > 1:
+            # Finite difference slopes, one-sided at both ends of the grid
+            slopes = np.gradient(grid_y, grid_x, axis=0, edge_order=1)
+
+        bands = None
+        if self.interpolation == 'exact' and \
+                len(functions) >= self.band_index_min_functions:
+            bands = self.band_index(grid_y, self.thresholds())
+        return grid_x, grid_y, slopes, bands
+
+    def band_index(self, grid_y, thresholds):
+        """
+        Indexes the threshold bands [ideal_y - threshold, ideal_y + threshold]
+        of the selected functions at every grid x, so a test point only
+        evaluates the functions whose band can hold its y value.
+
+        :param grid_y: Sorted (x, function) array of ideal y values
+        :param thresholds: Deviation threshold of every selected function
+        :return: A tuple of the lower band edges sorted per grid x, the
+        function index of every sorted edge and the largest ideal y
+        magnitude per grid x, which bounds the rounding of the edges.
+        """
+        lower = grid_y - thresholds
+        # NaN edges sort last and never enter a search window
+        order = np.argsort(lower, axis=1, kind='stable')
+        sorted_lower = np.take_along_axis(lower, order, axis=1)
+        scale = np.where(np.isnan(grid_y), 0, np.abs(grid_y)).max(axis=1)
+        return sorted_lower, order.astype(np.int32), scale
+
+    def grid_rows(self, grid_x, x_values, strict=True):
+        """
+        Locates test x values on the sorted ideal x axis.
+
+        :param strict: Raises a KeyError for x values missing from the grid
+        in 'exact' mode
+        :return: The grid index left and right of every x value, the nearest
+        grid index and a mask of the exact hits within `x_tolerance`.
+        """
+        # Compact grids hold float32 x values, full precision test x values
+        # read from the database are rounded alike to be found on them
+        grid_keys = np.asarray(x_values, dtype=self.float_dtype) \
+            .astype(np.float64)
+        last = len(grid_x) - 1
+        # Index of the first grid point at or after every x value
+        right = np.searchsorted(grid_x, grid_keys)
+        left = np.clip(right - 1, 0, last)
+        right = np.clip(right, 0, last)
+
+        # Nearest grid point, an exact hit if within the tolerance
+        nearest = np.where(np.abs(grid_x[right] - grid_keys)
+                           <= np.abs(grid_keys - grid_x[left]), right, left)
+        exact = np.abs(grid_x[nearest] - grid_keys) <= self.x_tolerance
+        if strict and self.interpolation == 'exact' and not exact.all():
+            # Every test x value must exist in the ideal table
+            raise KeyError(np.unique(x_values[~exact]).tolist())
+        return left, right, nearest, exact
+
+    def ideal_values(self, grid, x_values, strict=True):
+        """
+        Looks up the selected ideal functions at the test x values. Values
+        within `x_tolerance` of a grid point are exact hits, all others are
+        interpolated unless the interpolation is 'exact'.
+
+        :param grid: Sorted ideal grid returned by `ideal_grid`
+        :param x_values: 1-D array with the test x values
+        :param strict: Raises a KeyError for x values missing from the grid
+        in 'exact' mode instead of returning NaN for them
+        :return: An array of shape (test points, selected functions), NaN for
+        x values outside the ideal x range.
+        """
+        grid_x, grid_y, slopes, _ = grid
+        left, right, nearest, exact = self.grid_rows(grid_x, x_values,
+                                                     strict)
+
+        values = np.full((len(x_values), grid_y.shape[1]), np.nan)
+        values[exact] = grid_y[nearest[exact]]
+        inside = ~exact & (x_values > grid_x[0]) & (x_values < grid_x[-1])
+        if self.interpolation == 'exact' or not inside.any():
+            return values
+
+        lower, upper = left[inside], right[inside]
+        width = (grid_x[upper] - grid_x[lower])[:, np.newaxis]
+        t = (x_values[inside, np.newaxis] - grid_x[lower, np.newaxis]) / width
+        if self.interpolation == 'linear':
+            values[inside] = (grid_y[lower]
+                              + t * (grid_y[upper] - grid_y[lower]))
+        else:
+            # Cubic Hermite basis between the two enclosing grid points
+            t2, t3 = t ** 2, t ** 3
+            values[inside] = ((2 * t3 - 3 * t2 + 1) * grid_y[lower]
+                              + (t3 - 2 * t2 + t) * width * slopes[lower]
+                              + (-2 * t3 + 3 * t2) * grid_y[upper]
+                              + (t3 - t2) * width * slopes[upper])
+        return values
+
+    def map_on_grid(self, x_values, y_values, grid, strict=True):
+        """
+        Assigns test points to the selected ideal function with the smallest
+        deviation within its threshold (√2 * max_deviation).
+
+        :param grid: Sorted ideal grid returned by `ideal_grid`
+        :param strict: Raises a KeyError for x values missing from the grid
+        in 'exact' mode instead of leaving those points unmapped
+        :return: A boolean mask of the mapped points, followed by the rounded
+        deviations and the ideal function names of those points.
+        """
+        functions = [ideal_func for ideal_func, _ in self.selection.values()]
+        thresholds = self.thresholds()
+
+        x_values = np.asarray(x_values, dtype=np.float64)
+        y_values = np.asarray(y_values, dtype=np.float64)
+        if grid[3] is not None:
+            # Evaluates only the functions whose band can hold the point
+            best, minimum_dev = self.map_on_bands(x_values, y_values, grid,
+                                                  thresholds, strict)
+        else:
+            ideal_y = self.ideal_values(grid, x_values, strict)
+
+            # Deviation matrix of shape (test points, selected functions)
+            # plus a column of inf keeping argmin defined when nothing fits
+            deviations = np.empty((len(x_values), len(thresholds) + 1))
+            deviations[:, -1] = np.inf
+            within = self.math.abs_deviations(y_values, ideal_y,
+                                              out=deviations[:, :-1])
+            within[~(within <= thresholds)] = np.inf
+            # argmin keeps the first function on ties, like the strict `<`
+            best = deviations.argmin(axis=1)
+            minimum_dev = deviations[np.arange(len(x_values)), best]
+        mapped = np.isfinite(minimum_dev)
+
+        return (mapped,
+                np.round(minimum_dev[mapped], 8),
+                np.array(functions, dtype=object)[best[mapped]])
+
+    def map_on_bands(self, x_values, y_values, grid, thresholds,
+                     strict=True):
+        """
+        Finds the function with the smallest deviation within its threshold
+        for every test point through the band index of the grid, with the
+        same result as the full deviation matrix.
+
+        A band holding y starts at most twice the largest threshold below y,
+        so a binary search on the sorted lower edges of the point's grid x
+        yields every candidate. The window is widened by the rounding error
+        of the edges and the candidates are checked exactly like the full
+        matrix.
+
+        :param grid: Sorted ideal grid with band index from `ideal_grid`
+        :param thresholds: Deviation threshold of every selected function
+        :return: The best function index of every point, the number of
+        functions for unmapped points, and its deviation, inf if unmapped.
+        """
+        grid_x, grid_y, _, (sorted_lower, order, scale) = grid
+        _, _, nearest, exact = self.grid_rows(grid_x, x_values, strict)
+        best = np.full(len(x_values), grid_y.shape[1])
+        minimum_dev = np.full(len(x_values), np.inf)
+
+        points = np.flatnonzero(exact)
+        rows = nearest[points]
+        y_points = y_values[points]
+        band_width = 2 * thresholds.max()
+        slack = 4 * np.finfo(np.float64).eps * (
+            np.abs(y_points) + scale[rows] + band_width)
+        start = self.math.row_searchsorted(
+            sorted_lower, rows, y_points - band_width - slack, 'left')
+        stop = self.math.row_searchsorted(
+            sorted_lower, rows, y_points + slack, 'right')
+
+        # One entry per candidate (point, function) pair
+        counts = stop - start
+        pair_point = np.repeat(np.arange(len(points)), counts)
+        offsets = np.cumsum(counts) - counts
+        positions = start[pair_point] + np.arange(counts.sum()) \
+            - offsets[pair_point]
+        pair_rows = rows[pair_point]
+        pair_function = order[pair_rows, positions]
+        deviations = self.math.abs_deviations(
+            y_points[pair_point], grid_y[pair_rows, pair_function])
+        within = deviations <= thresholds[pair_function]
+        pair_point, pair_function, deviations = (
+            pair_point[within], pair_function[within], deviations[within])
+
+        if not len(pair_point):
+            return best, minimum_dev
+
+        # Pairs are grouped by point, every group reduces to its smallest
+        # deviation and, on ties, its first function
+        new_point = np.diff(pair_point, prepend=-1) != 0
+        starts = np.flatnonzero(new_point)
+        group = np.cumsum(new_point) - 1
+        group_dev = np.minimum.reduceat(deviations, starts)
+        group_best = np.minimum.reduceat(
+            np.where(deviations == group_dev[group], pair_function,
+                     grid_y.shape[1]), starts)
+        best[points[pair_point[starts]]] = group_best
+        minimum_dev[points[pair_point[starts]]] = group_dev
+        return best, minimum_dev
+
+    def map_test_points(self, x_values, y_values, ideal_data):
+        """
+        Assigns test points to the selected ideal function with the smallest
+        deviation within its threshold (√2 * max_deviation).
+
+        :param x_values: 1-D array with the test x values
+        :param y_values: 1-D array with the test y values
+        :param ideal_data: DataFrame of the ideal_functions table
+        :return: A boolean mask of the mapped points, followed by the rounded
+        deviations and the ideal function names of those points.
+        """
+        return self.map_on_grid(x_values, y_values,
+                                self.ideal_grid(ideal_data))
+
+    @instrumentation.instrument()
     def insert_test_data(self):
         """
         Inserts test data into the database after assigning the best fitting
         ideal functions and calculating deviations.
         """
         test_data = self.get_data('test_data')
-        ideal_data = self.get_data('ideal_functions')
-        # Sets the 'x' column as the index of the ideal_data DataFrame
-        ideal_data.set_index('x', inplace=True)
-
-        # Check if for each (x, y) pair fits one of the four ideal functions.
-        for i in range(len(test_data)):
-            minimum_dev = float('inf')
-            x_value = test_data.iloc[i]['x']
-            y_value = test_data.iloc[i]['y']
-
-            for ideal_func, ideal_max_dev in self.selection.values():
-                ideal_y = ideal_data.loc[x_value, ideal_func]
-                existing_dev = abs(y_value - ideal_y)
-                threshold = ideal_max_dev * np.sqrt(2)
-
-                if existing_dev <= threshold and existing_dev < minimum_dev:
-                    minimum_dev = existing_dev
-                    # adds the assigned function and its deviation to DataFrame
-                    test_data.at[i, 'delta_y'] = round(minimum_dev, 8)
-                    test_data.at[i, 'ideal_function'] = ideal_func
-        print('Ideal functions were assigned to the test data:\n', test_data)
+        ideal_data = self.get_ideal_data(
+            [ideal_func for ideal_func, _ in self.selection.values()])
+
+        # Check for all (x, y) pairs at once which ideal function they fit.
+        mapped, delta_y, ideal_functions = self.map_test_points(
+            test_data['x'], test_data['y'], ideal_data)
+        # adds the assigned functions and their deviations to DataFrame
+        if self.compact:
+            # Categorical codes only take values of known categories
+            categories = test_data['ideal_function'].cat.categories
+            test_data['ideal_function'] = test_data['ideal_function'] \
+                .cat.add_categories([
+                    ideal_func for ideal_func in dict.fromkeys(
+                        ideal_func for ideal_func, _
+                        in self.selection.values())
+                    if ideal_func not in categories])
+            test_data['delta_y'] = test_data['delta_y'].astype(np.float32)
+        test_data.loc[mapped, 'delta_y'] = delta_y.astype(self.float_dtype)
+        test_data.loc[mapped, 'ideal_function'] = ideal_functions
+        instrumentation.current().update(rows=len(test_data),
+                                         mapped=int(np.sum(mapped)))
+        logger.debug('Ideal functions were assigned to the test data:\n%s',
+                     test_data)
 
         # Inserts test data into the database
         try:
-            test_data.to_sql(name='test_data',
-                             con=self.session.bind,
-                             index=False,
-                             if_exists='replace')
-            print('Mapped Test data successfully inserted into the database.')
+            if self.compact:
+                # Compact values only live in memory, so only the float64
+                # assignments are written by id and x and y stay as stored
+                self.update_assignments(test_data['id'], mapped, delta_y,
+                                        ideal_functions)
+            else:
+                test_data.to_sql(name='test_data',
+                                 con=self.session.bind,
+                                 index=False,
+                                 if_exists='replace')
+                # Replacing the table drops its indexes
+                create_indexes(self.session.bind, ['test_data'])
+            # Keeps the written table cached for the following readers
+            self.invalidate_cache('test_data', test_data)
+            logger.info('Mapped Test data successfully inserted into the '
+                        'database.')
         except Exception as e:
-            print(f"Result DataFrame insert failed. Error occurred: {e}")
+            instrumentation.current()['status'] = 'error'
+            logger.error("Result DataFrame insert failed. Error occurred: %s",
+                         e)
+
+    def update_assignments(self, ids, mapped, delta_y, ideal_functions):
+        """
+        Writes the deviation and ideal function of every given test row by
+        id in one transaction, clearing them for unmapped rows.
+
+        :param ids: The test_data ids of all rows
+        :param mapped: Boolean mask of the mapped rows
+        :param delta_y: Deviations of the mapped rows
+        :param ideal_functions: Ideal function names of the mapped rows
+        """
+        all_delta_y = np.full(len(mapped), None, dtype=object)
+        all_delta_y[mapped] = np.asarray(delta_y, dtype=np.float64).tolist()
+        all_functions = np.full(len(mapped), None, dtype=object)
+        all_functions[mapped] = ideal_functions
+        with self.session as session:
+            try:
+                session.connection().exec_driver_sql(
+                    "UPDATE test_data SET delta_y = ?, ideal_function = ? "
+                    "WHERE id = ?",
+                    list(zip(all_delta_y.tolist(), all_functions.tolist(),
+                             np.asarray(ids).tolist())))
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+
+    @instrumentation.instrument()
+    def stream_test_data(self, chunk_size=50_000, after_id=0):
+        """
+        Maps the test data in chunks of `chunk_size` rows read straight from
+        the database and writes the assigned functions and deviations back
+        with UPDATE statements keyed by id, keeping the test_data schema.
+
+        The id of the last processed row is stored in the mapping_state table
+        together with every chunk and the fingerprint of the selection, so
+        later runs can resume from it.
+
+        :param chunk_size: Number of test rows mapped per chunk
+        :param after_id: Only test rows with a larger id are mapped
+        :return: The number of test points that were mapped.
+        """
+        # Keeps only the sorted x axis and selected ideal functions in memory
+        grid = self.ideal_grid(self.get_ideal_data(
+            [ideal_func for ideal_func, _ in self.selection.values()]))
+
+        select_chunk = ("SELECT id, x, y FROM test_data WHERE id > ? "
+                        "ORDER BY id LIMIT ?")
+        update_chunk = ("UPDATE test_data SET delta_y = ?, "
+                        "ideal_function = ? WHERE id = ?")
+        last_id = after_id
+        total_rows = 0
+        total_mapped = 0
+        record = instrumentation.current()
+
+        with self.session as session:
+            try:
+                while True:
+                    # Keyset pagination, no cursor stays open during updates
+                    rows = session.connection().exec_driver_sql(
+                        select_chunk, (last_id, chunk_size)).fetchall()
+                    if not rows:
+                        break
+                    ids, x_values, y_values = np.array(rows,
+                                                       dtype=np.float64).T
+                    last_id = int(ids[-1])
+
+                    mapped, delta_y, ideal_functions = self.map_on_grid(
+                        x_values, y_values, grid)
+                    updates = zip(delta_y.tolist(), ideal_functions.tolist(),
+                                  ids[mapped].astype(int).tolist())
+                    if mapped.any():
+                        session.connection().exec_driver_sql(update_chunk,
+                                                             list(updates))
+                    # Commits the high-water mark together with the chunk
+                    session.merge(MappingState(
+                        name='test_data', value=last_id,
+                        fingerprint=getattr(self, 'fingerprint', None)))
+                    session.commit()
+                    total_rows += len(rows)
+                    total_mapped += int(mapped.sum())
+                logger.info('%d of %d test points were mapped and updated in '
+                            'the database.', total_mapped, total_rows)
+            except Exception as e:
+                session.rollback()
+                record['status'] = 'error'
+                logger.error("Streaming test data mapping failed. "
+                             "Error occurred: %s", e)
+        record.update(rows=total_rows, mapped=total_mapped)
+        self.invalidate_cache('test_data')
+        return total_mapped
+
+    def save_selection(self):
+        """
+        Caches the current selection and candidate scores in the
+        selected_functions and candidate_scores tables under the fingerprint
+        of their train and ideal data, replacing stale entries.
+        """
+        with self.session as session:
+            try:
+                session.execute(delete(SelectedFunctions))
+                session.execute(delete(CandidateScores))
+                for position, (train_column, (ideal_func, max_dev)) in \
+                        enumerate(self.selection.items()):
+                    session.add(SelectedFunctions(
+                        fingerprint=self.fingerprint,
+                        train_function=train_column,
+                        ideal_function=ideal_func,
+                        max_deviation=float(max_dev),
+                        position=position))
+                if len(self.scores):
+                    session.execute(
+                        insert(CandidateScores),
+                        self.scores.assign(fingerprint=self.fingerprint)
+                        .to_dict(orient='records'))
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                logger.error("Saving the selection failed. "
+                             "Error occurred: %s", e)
+
+    def map_new_test_data(self, chunk_size=50_000):
+        """
+        Maps only the test rows that arrived since the last mapping run,
+        reusing the cached selection when the inputs did not change.
+
+        Rows below the high-water mark were mapped with the selection of its
+        fingerprint. When the selection changed since, all assignments are
+        cleared and every row is mapped again.
+
+        :param chunk_size: Number of test rows mapped per chunk
+        :return: The number of new test points that were mapped.
+        """
+        if not getattr(self, 'selection', None):
+            self.select_functions()
+
+        fingerprint = getattr(self, 'fingerprint', None)
+        with self.session as session:
+            high_water_mark = session.get(MappingState, 'test_data')
+            after_id = high_water_mark.value if high_water_mark else 0
+            if high_water_mark is not None and \
+                    high_water_mark.fingerprint != fingerprint:
+                try:
+                    # Clears the assignments of the previous selection and
+                    # its mark in one transaction
+                    session.execute(update(TestData).values(
+                        delta_y=None, ideal_function=None))
+                    session.merge(MappingState(name='test_data', value=0,
+                                               fingerprint=fingerprint))
+                    session.commit()
+                    after_id = 0
+                    logger.info("The selection changed since the last "
+                                "mapping run, all test points are mapped "
+                                "again.")
+                except Exception as e:
+                    session.rollback()
+                    logger.error("Resetting the test data mapping failed. "
+                                 "Error occurred: %s", e)
+                    return 0
+        return self.stream_test_data(chunk_size=chunk_size,
+                                     after_id=after_id)
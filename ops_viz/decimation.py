@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class Decimator:
+    """
+    A class for reducing plotted points while keeping the visual shape.
+
+    This class provides methods to
+        - Keep the extremes of a line per x bin (min/max decimation)
+        - Draw a sample of scattered points stratified over x bins
+    """
+    def x_bins(self, x_values, bins):
+        """
+        Assigns every x value to one of `bins` equally wide x bins.
+
+        :return: An integer array with the bin of every x value.
+        """
+        x_min, x_max = np.nanmin(x_values), np.nanmax(x_values)
+        if not x_max > x_min:
+            return np.zeros(len(x_values), dtype=np.intp)
+        scaled = (x_values - x_min) / (x_max - x_min) * bins
+        return np.clip(np.nan_to_num(scaled), 0, bins - 1).astype(np.intp)
+
+    def minmax_indices(self, x_values, y_values, bins):
+        """
+        Selects the first, last, lowest and highest point of every x bin of
+        a line, so its rendered envelope stays the same.
+
+        :param bins: Number of x bins, about the pixel width of the plot
+        :return: Sorted positions of the points to keep.
+        """
+        x_values = np.asarray(x_values, dtype=np.float64)
+        y_values = np.asarray(y_values, dtype=np.float64)
+        order = np.argsort(x_values, kind='stable')
+        line_bins = self.x_bins(x_values[order], bins)
+
+        # Bins are contiguous along the sorted line
+        starts = np.flatnonzero(np.r_[True, line_bins[1:] != line_bins[:-1]])
+        ends = np.r_[starts[1:], len(order)] - 1
+        # Sorting by y within every bin puts its minimum first and maximum last
+        by_y = np.lexsort((y_values[order], line_bins))
+        keep = np.unique(np.concatenate([starts, ends,
+                                         by_y[starts], by_y[ends]]))
+        return np.sort(order[keep])
+
+    def sample_indices(self, x_values, max_points, bins, seed=0):
+        """
+        Draws a reproducible random sample of about `max_points` points with
+        the same share of points from every x bin.
+
+        :param bins: Number of x bins the sample is stratified over
+        :return: Sorted positions of the sampled points.
+        """
+        x_values = np.asarray(x_values, dtype=np.float64)
+        if len(x_values) <= max_points:
+            return np.arange(len(x_values))
+        point_bins = self.x_bins(x_values, bins)
+
+        # Shuffles the points within their bin and keeps the first of each
+        keys = np.random.default_rng(seed).random(len(x_values))
+        order = np.lexsort((keys, point_bins))
+        counts = np.bincount(point_bins, minlength=bins)
+        quotas = np.ceil(counts * max_points / len(x_values)).astype(np.intp)
+        ranks = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+        return np.sort(order[ranks < np.repeat(quotas, counts)])
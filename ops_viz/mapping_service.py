@@ -0,0 +1,296 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from sqlalchemy import func, select
+from database.models import MappingState, TestData
+from monitoring.instrumentation import instrumentation
+from .data_processing import ProcessData
+
+logger = logging.getLogger(__name__)
+
+
+class PointMapper(ProcessData):
+    """
+    Long-lived mapper for test points arriving one batch at a time.
+
+    The selection and the sorted grid of the selected ideal functions are
+    loaded once and kept in memory, so every batch is mapped without reading
+    the ideal table again.
+    """
+    def __init__(self, session, **kwargs):
+        super().__init__(session, **kwargs)
+        # Reuses the cached selection, computing it only on a cache miss
+        self.select_functions()
+        self.grid = self.ideal_grid(self.get_ideal_data(
+            [ideal_func for ideal_func, _ in self.selection.values()]))
+
+    def map_batch(self, xs, ys):
+        """
+        Maps a batch of test points to the selected ideal functions. Points
+        that cannot be located on the ideal grid stay unmapped.
+
+        :param xs: Sequence of test x values
+        :param ys: Sequence of test y values
+        :return: An array with the deviation of every point, NaN if it was
+        not mapped, and an array with its ideal function or None.
+        """
+        mapped, delta_y, ideal_functions = self.map_on_grid(
+            xs, ys, self.grid, strict=False)
+        all_delta_y = np.full(len(mapped), np.nan)
+        all_delta_y[mapped] = delta_y
+        all_functions = np.full(len(mapped), None, dtype=object)
+        all_functions[mapped] = ideal_functions
+        return all_delta_y, all_functions
+
+    @instrumentation.instrument(rows=lambda self, xs, *args: len(xs))
+    def store_batch(self, xs, ys, delta_y, ideal_functions):
+        """
+        Appends mapped test points to the test_data table in one transaction.
+
+        The mapping high-water mark is moved past the new rows when all
+        earlier rows were already mapped with the same selection, so
+        incremental runs skip them. A missing mark counts as no row mapped
+        yet.
+        """
+        rows = [(x, y, None if np.isnan(dev) else dev, ideal_func)
+                for x, y, dev, ideal_func in zip(np.asarray(xs).tolist(),
+                                                 np.asarray(ys).tolist(),
+                                                 delta_y.tolist(),
+                                                 ideal_functions.tolist())]
+        with self.session as session:
+            try:
+                last_id = session.scalar(select(func.max(TestData.id))) or 0
+                high_water_mark = session.get(MappingState, 'test_data')
+                session.connection().exec_driver_sql(
+                    "INSERT INTO test_data (x, y, delta_y, ideal_function) "
+                    "VALUES (?, ?, ?, ?)", rows)
+                # A mark of another selection does not cover earlier rows
+                mark = high_water_mark.value if high_water_mark is not None \
+                    and high_water_mark.fingerprint == self.fingerprint \
+                    else 0
+                if mark >= last_id:
+                    session.merge(MappingState(
+                        name='test_data',
+                        value=session.scalar(select(func.max(TestData.id))),
+                        fingerprint=self.fingerprint))
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                logger.error("Storing mapped test points failed. "
+                             "Error occurred: %s", e)
+        self.invalidate_cache('test_data')
+
+
+class MappingServer:
+    """
+    asyncio TCP server mapping live test points with a PointMapper.
+
+    Clients send one "x,y" line per test point and receive one
+    "ideal_function,delta_y" line per point, in order, with empty fields for
+    unmapped points and "error" for lines that cannot be parsed or mapped.
+    Points of all clients are micro-batched before mapping, and mapped points
+    are appended to test_data with batched commits on a dedicated thread, so
+    commits do not block the event loop.
+    """
+    def __init__(self, mapper, host='127.0.0.1', port=8765, max_batch=8192,
+                 max_delay=0.002, commit_rows=50_000, commit_interval=1.0):
+        """
+        Constructs all the attributes for the MappingServer object.
+
+        :param max_batch: Maximum number of points mapped at once
+        :param max_delay: Seconds a batch waits for more points
+        :param commit_rows: Number of mapped points stored per commit
+        :param commit_interval: Maximum seconds between two commits
+        """
+        self.mapper = mapper
+        self.host = host
+        self.port = port
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.commit_rows = commit_rows
+        self.commit_interval = commit_interval
+        self.pending = []
+        self.server = None
+        # A single thread keeps the commits in order and the session on one
+        # thread
+        self.store_executor = ThreadPoolExecutor(max_workers=1)
+        self.last_store = None
+
+    async def start(self):
+        """
+        Starts listening and the batching task.
+
+        :return: The asyncio Server object.
+        """
+        self.queue = asyncio.Queue()
+        self.last_commit = asyncio.get_running_loop().time()
+        self.batcher = asyncio.create_task(self.run_batcher())
+        self.server = await asyncio.start_server(self.handle_client,
+                                                 self.host, self.port)
+        logger.info("Mapping server listening on %s.",
+                    self.server.sockets[0].getsockname())
+        return self.server
+
+    async def serve_forever(self):
+        """
+        Runs the server until it is cancelled, then stores pending points.
+        """
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """
+        Stops the server and the batching task and stores pending points.
+        """
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        # Commits run in order, so the last one finishes after all others
+        last_store = self.flush()
+        if last_store is not None:
+            await last_store
+        self.store_executor.shutdown()
+
+    def parse_lines(self, lines):
+        """
+        Parses "x,y" lines into arrays, marking unparsable lines.
+
+        :return: Arrays of x and y values and a mask of the valid lines.
+        """
+        try:
+            points = np.array([line.split(b',') for line in lines],
+                              dtype=np.float64).reshape(len(lines), 2)
+            return points[:, 0], points[:, 1], np.ones(len(lines), bool)
+        except ValueError:
+            points = np.full((len(lines), 2), np.nan)
+            valid = np.zeros(len(lines), bool)
+            for i, line in enumerate(lines):
+                try:
+                    points[i] = [float(value) for value in line.split(b',')]
+                    valid[i] = True
+                except ValueError:
+                    pass
+            return points[:, 0], points[:, 1], valid
+
+    async def handle_client(self, reader, writer):
+        """
+        Reads test points of one client and writes back their mapping.
+        """
+        loop = asyncio.get_running_loop()
+        buffer = b''
+        try:
+            while data := await reader.read(1 << 16):
+                *lines, buffer = (buffer + data).split(b'\n')
+                lines = [line.strip() for line in lines if line.strip()]
+                if not lines:
+                    continue
+                xs, ys, valid = self.parse_lines(lines)
+                future = loop.create_future()
+                await self.queue.put((xs[valid], ys[valid], future))
+                try:
+                    delta_y, ideal_functions = await future
+                except Exception:
+                    # The batch failed, every line of the group is an error
+                    valid[:] = False
+                    delta_y, ideal_functions = np.empty(0), np.empty(0)
+
+                replies = iter(zip(delta_y.tolist(), ideal_functions.tolist()))
+                response = []
+                for is_valid in valid:
+                    if not is_valid:
+                        response.append('error\n')
+                        continue
+                    dev, ideal_func = next(replies)
+                    response.append(',\n' if ideal_func is None
+                                    else f'{ideal_func},{dev}\n')
+                writer.write(''.join(response).encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def run_batcher(self):
+        """
+        Collects queued points into micro-batches, maps them at once and
+        stores the results with batched commits.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                groups = [await asyncio.wait_for(self.queue.get(),
+                                                 self.commit_interval)]
+            except asyncio.TimeoutError:
+                # Stores pending points while no new points arrive
+                self.flush()
+                continue
+            count = len(groups[0][0])
+            deadline = loop.time() + self.max_delay
+            while count < self.max_batch:
+                try:
+                    group = await asyncio.wait_for(self.queue.get(),
+                                                   deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                groups.append(group)
+                count += len(group[0])
+
+            xs = np.concatenate([group[0] for group in groups])
+            ys = np.concatenate([group[1] for group in groups])
+            try:
+                delta_y, ideal_functions = self.mapper.map_batch(xs, ys)
+            except Exception as e:
+                # Fails only this micro-batch, the batcher keeps running
+                logger.error("Mapping a batch of %d test points failed. "
+                             "Error occurred: %s", len(xs), e)
+                for _, _, future in groups:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for group_xs, _, future in groups:
+                stop = start + len(group_xs)
+                if not future.done():
+                    future.set_result((delta_y[start:stop],
+                                       ideal_functions[start:stop]))
+                start = stop
+
+            self.pending.append((xs, ys, delta_y, ideal_functions))
+            if sum(len(batch[0]) for batch in self.pending) \
+                    >= self.commit_rows or \
+                    loop.time() - self.last_commit >= self.commit_interval:
+                self.flush()
+
+    def flush(self):
+        """
+        Hands all pending mapped points to the store thread, which stores
+        them in a single transaction while the event loop keeps serving.
+
+        :return: The asyncio future of the latest store, None before the
+        first one.
+        """
+        loop = asyncio.get_running_loop()
+        if self.pending:
+            batch = [np.concatenate(parts) for parts in zip(*self.pending)]
+            self.pending = []
+            self.last_store = loop.run_in_executor(self.store_executor,
+                                                   self.store, *batch)
+        self.last_commit = loop.time()
+        return self.last_store
+
+    def store(self, xs, ys, delta_y, ideal_functions):
+        """
+        Stores mapped points on the store thread. A failed store is logged
+        and its points are dropped, the server keeps running.
+        """
+        try:
+            self.mapper.store_batch(xs, ys, delta_y, ideal_functions)
+        except Exception as e:
+            logger.error("Storing %d mapped test points failed. "
+                         "Error occurred: %s", len(xs), e)
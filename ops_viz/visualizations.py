@@ -1,8 +1,25 @@
+import os
+import json
+import time
+import logging
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 from cycler import cycler
 import matplotlib.pyplot as plt
-from .data_processing import DataHandler
+from monitoring.instrumentation import instrumentation
+from .data_processing import DataHandler, ProcessData
+from .decimation import Decimator
+
+logger = logging.getLogger(__name__)
+
+
+def plotted_rows(visualizer, *args):
+    """
+    :return: The number of test points a plot of the visualizer draws from.
+    """
+    return len(visualizer.test_data)
 
 
 class VisualizeData(DataHandler):
@@ -14,19 +31,77 @@ class VisualizeData(DataHandler):
         - Show how test data aligns or deviates from each ideal function.
         - Overlay test data on ideal functions to visualize the mapping we did.
         - Create individual plots for test data against each ideal function.
+
+    Lines and scatters with more than `max_points` points are decimated, so
+    render time stays about constant for very large test sets.
+
+    render_all keeps a manifest of the inputs every saved figure was drawn
+    from and only renders figures whose inputs changed.
     """
-    def __init__(self, functions, session):
-        super().__init__(session)
+    # Plots with more points than this are decimated
+    max_points = 50_000
+    # Number of x bins used for decimation, about the pixel width of a plot
+    line_bins = 2_000
+    # Maximum number of residual lines drawn per ideal function
+    max_residuals = 5_000
+    decimator = Decimator()
+    # File in the output folder with the fingerprint of every saved figure
+    manifest_name = 'figures.json'
+
+    def __init__(self, functions, session, ideal_layout='wide',
+                 cache_dir=None, output_dir='Output', max_points=None,
+                 compact=False):
+        super().__init__(session, ideal_layout, cache_dir, compact)
+        self.output_dir = output_dir
+        if max_points is not None:
+            self.max_points = max_points
+        # Interactive display of the saved figures
+        self.show = True
+        if functions is None:
+            # Reuses the cached selection, computing it only on a cache miss
+            functions = ProcessData(session, ideal_layout, cache_dir,
+                                    compact=compact).select_functions()
         self.functions = functions
         self.train_data = self.get_data('train_data')
-        self.ideal_data = self.get_data('ideal_functions')
+        self.ideal_data = self.get_ideal_data(
+            [ideal_func for ideal_func, _ in functions.values()])
         self.test_data = self.get_data('test_data')
 
+    def line_points(self, x_values, y_values):
+        """
+        Decimates a line to the first, last, lowest and highest point per x
+        bin once it has more than `max_points` points.
+
+        :return: The x and y values to plot.
+        """
+        if len(x_values) <= self.max_points:
+            return x_values, y_values
+        keep = self.decimator.minmax_indices(x_values, y_values,
+                                             self.line_bins)
+        return x_values.iloc[keep], y_values.iloc[keep]
+
+    def scatter_points(self, data, max_points=None):
+        """
+        Samples scattered points stratified over x once there are more than
+        `max_points` of them.
+
+        :param data: DataFrame with the points to plot
+        :return: The DataFrame rows to plot.
+        """
+        max_points = max_points or self.max_points
+        if len(data) <= max_points:
+            return data
+        return data.iloc[self.decimator.sample_indices(
+            data['x'], max_points, self.line_bins)]
+
+    @instrumentation.instrument(rows=plotted_rows)
     def plot_train_vs_ideal(self):
         """
         Plots training data against ideal functions across multiple subplots.
 
         Saves the plot in output folder an PNG image file.
+
+        :return: True if the figure was saved.
         """
         # Defines layout and create figure with subplots
         layout = 'constrained'
@@ -45,12 +120,12 @@ class VisualizeData(DataHandler):
             ax.set_title(f'Train y{i+1} and Ideal {current_y}',
                          fontsize='medium')
             # Plots the training data line
-            ax.plot(self.train_data['x'],
-                    self.train_data[f'y{i+1}'],
+            ax.plot(*self.line_points(self.train_data['x'],
+                                      self.train_data[f'y{i+1}']),
                     label=f'Train y{i+1}')
             # Plots the ideal data line
-            ax.plot(self.ideal_data['x'],
-                    self.ideal_data[current_y],
+            ax.plot(*self.line_points(self.ideal_data['x'],
+                                      self.ideal_data[current_y]),
                     label=f'Ideal {current_y}')
 
             # Sets axis labels, grid, and legend
@@ -61,20 +136,26 @@ class VisualizeData(DataHandler):
 
         try:
             # Displays the plot and saves it to to output folder
-            plt.savefig('Output/train_vs_ideal.png')
-            print('figure was saved successfully to output folder.')
-            plt.show()
+            plt.savefig(os.path.join(self.output_dir, 'train_vs_ideal.png'))
+            logger.info('figure was saved successfully to output folder.')
+            if self.show:
+                plt.show()
             plt.close()
+            return True
         except PermissionError:
-            print("Error: Permission denied when trying to save the file.")
+            logger.error("Permission denied when trying to save the file.")
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+            logger.error("An unexpected error occurred: %s", e)
+        return False
 
+    @instrumentation.instrument(rows=plotted_rows)
     def plot_test_vs_ideal(self):
         """
         Plots test data against ideal functions and showcases deviation region.
 
         Saves the plot in output folder an PNG image file.
+
+        :return: True if the figure was saved.
         """
         # Defines layout and create figure with subplots
         layout = 'constrained'
@@ -90,7 +171,8 @@ class VisualizeData(DataHandler):
         for i, ax in enumerate(axs.values()):
             # Retrieves the current ideal function and its deviation
             current_y = self.functions[f'y{i+1}'][0]
-            current_y_column = self.ideal_data[current_y]
+            ideal_x, current_y_column = self.line_points(
+                self.ideal_data['x'], self.ideal_data[current_y])
             ideal_max_dev = self.functions[f'y{i+1}'][1]
 
             # Sets the title for the current subplot
@@ -98,15 +180,15 @@ class VisualizeData(DataHandler):
                          fontsize='medium')
 
             # Plots the selected ideal function line
-            ax.plot(self.ideal_data['x'],
-                    self.ideal_data[current_y],
+            ax.plot(ideal_x,
+                    current_y_column,
                     label=f'Ideal function {current_y}',
                     zorder=1.2)
 
             # Filter mapped and unmapped test values for plotting
             is_mapped = mapped_ideal_test == current_y
-            mapped_test = self.test_data[is_mapped]
-            unmapped_test = self.test_data[~is_mapped]
+            mapped_test = self.scatter_points(self.test_data[is_mapped])
+            unmapped_test = self.scatter_points(self.test_data[~is_mapped])
 
             # Plots unmapped test values corresponding to each ideal function
             ax.scatter(unmapped_test['x'],
@@ -124,7 +206,7 @@ class VisualizeData(DataHandler):
             ymin = current_y_column - ideal_max_dev * np.sqrt(2)
             ymax = current_y_column + ideal_max_dev * np.sqrt(2)
             # Plots the Root-Mean-Square Threshold region of the deviation
-            ax.fill_between(self.ideal_data['x'],
+            ax.fill_between(ideal_x,
                             ymin,
                             ymax,
                             alpha=0.25, color='grey', zorder=1,
@@ -137,20 +219,26 @@ class VisualizeData(DataHandler):
 
         try:
             # Displays the plot and saves it to to output folder
-            plt.savefig('Output/test_vs_ideal.png')
-            print('figure was saved successfully to output folder.')
-            plt.show()
+            plt.savefig(os.path.join(self.output_dir, 'test_vs_ideal.png'))
+            logger.info('figure was saved successfully to output folder.')
+            if self.show:
+                plt.show()
             plt.close()
+            return True
         except PermissionError:
-            print("Error: Permission denied when trying to save the file.")
+            logger.error("Permission denied when trying to save the file.")
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+            logger.error("An unexpected error occurred: %s", e)
+        return False
 
+    @instrumentation.instrument(rows=plotted_rows)
     def plot_test_over_ideal(self):
         """
         Plots test data against ideal functions and marks the residual errors.
 
         Saves the plot in output folder an PNG image file.
+
+        :return: True if the figure was saved.
         """
         # Retrieves ideal_function column from test data table
         mapped_ideal_test = self.test_data['ideal_function']
@@ -164,7 +252,8 @@ class VisualizeData(DataHandler):
         ax.set_prop_cycle(cycler(color=color))
 
         # Retrieves unmapped test values for plotting
-        unmapped_test = self.test_data[mapped_ideal_test.isna()]
+        unmapped_test = self.scatter_points(
+            self.test_data[mapped_ideal_test.isna()])
         # Plots Unmapped test values.
         ax.scatter(unmapped_test['x'],
                    unmapped_test['y'],
@@ -175,24 +264,28 @@ class VisualizeData(DataHandler):
         for current_y, _ in self.functions.values():
 
             # Plots the selected ideal function line
-            ax.plot(self.ideal_data['x'],
-                    self.ideal_data[current_y],
+            ax.plot(*self.line_points(self.ideal_data['x'],
+                                      self.ideal_data[current_y]),
                     label=f'Ideal function {current_y}')
 
             # Retrieves mapped test values corresponding to each ideal function
             mapped_test = self.test_data[mapped_ideal_test == current_y]
             # Plots mapped test values corresponding to each ideal function
-            ax.scatter(mapped_test['x'],
-                       mapped_test['y'],
+            scattered_test = self.scatter_points(mapped_test)
+            ax.scatter(scattered_test['x'],
+                       scattered_test['y'],
                        label='Mapped test values')
 
+            # Caps the number of residual lines drawn
+            residual_test = self.scatter_points(mapped_test,
+                                                self.max_residuals)
             # Merge DataFrame to get ideal y value for residual calculation
-            merged_df = pd.merge(mapped_test,
+            merged_df = pd.merge(residual_test,
                                  self.ideal_data[['x', current_y]],
                                  'left', on='x')
             # Plot residual error lines
-            vline = ax.vlines(mapped_test['x'],
-                              mapped_test['y'],
+            vline = ax.vlines(residual_test['x'],
+                              residual_test['y'],
                               merged_df[current_y],
                               linewidth=0.8, color='red', zorder=0.9,
                               linestyle='--')
@@ -205,77 +298,301 @@ class VisualizeData(DataHandler):
 
         try:
             # Displays the plot and saves it to to output folder
-            plt.savefig('Output/test_over_ideal.png')
-            print('figure was saved successfully to output folder.')
-            plt.show()
+            plt.savefig(os.path.join(self.output_dir, 'test_over_ideal.png'))
+            logger.info('figure was saved successfully to output folder.')
+            if self.show:
+                plt.show()
             plt.close()
+            return True
         except PermissionError:
-            print("Error: Permission denied when trying to save the file.")
+            logger.error("Permission denied when trying to save the file.")
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+            logger.error("An unexpected error occurred: %s", e)
+        return False
 
+    @instrumentation.instrument(rows=plotted_rows)
     def plot_test_vs_ideal_individual(self):
         """
         Plots test data for each ideal function and showcases deviation region.
 
         Saves the plots in output folder an PNG image file.
+
+        :return: True if every figure was saved.
+        """
+        # Loop through selected ideal functions and their maximum deviation.
+        return all([self.plot_test_vs_ideal_single(current_y, max_deviation)
+                    for current_y, max_deviation
+                    in self.functions.values()])
+
+    @instrumentation.instrument(rows=plotted_rows)
+    def plot_test_vs_ideal_single(self, current_y, max_deviation):
+        """
+        Plots test data for one ideal function and showcases deviation region.
+
+        Saves the plot in output folder an PNG image file.
+
+        :param current_y: Name of the selected ideal function
+        :param max_deviation: Maximum deviation of the ideal function
+        :return: True if the figure was saved.
         """
         # Retrieves ideal_function column from test data table
         mapped_ideal_test = self.test_data['ideal_function']
 
-        # Loop through selected ideal functions and their maximum deviation.
-        for current_y, max_deviation in self.functions.values():
+        # Creates a new figure axis for plotting
+        fig, ax = plt.subplots(layout='constrained', figsize=(9, 9))
+        ax.set_title(f'Test Data vs. Ideal Function {current_y} Deviation')
+
+        # Plots the selected ideal function line
+        ideal_x, current_y_column = self.line_points(
+            self.ideal_data['x'], self.ideal_data[current_y])
+        ax.plot(ideal_x,
+                current_y_column,
+                label=f'Ideal function {current_y}',
+                zorder=1.1)
+
+        # Filter mapped and unmapped test values for plotting
+        is_mapped = mapped_ideal_test == current_y
+        mapped_test = self.scatter_points(self.test_data[is_mapped])
+        unmapped_test = self.scatter_points(self.test_data[~is_mapped])
+
+        # Plots unmapped test values corresponding to the ideal function
+        ax.scatter(unmapped_test['x'],
+                   unmapped_test['y'],
+                   label='Unmapped test values',
+                   color='grey', s=20, zorder=1.2)
+
+        # Plots mapped test values corresponding to the ideal function
+        ax.scatter(mapped_test['x'],
+                   mapped_test['y'],
+                   label='Mapped test values',
+                   color='red', s=20, zorder=1.2)
+
+        # Retrieves Deviation threshold Intervals
+        ymin = current_y_column - max_deviation * np.sqrt(2)
+        ymax = current_y_column + max_deviation * np.sqrt(2)
+        # Plots the Root-Mean-Square Threshold region of the deviation
+        ax.fill_between(ideal_x,
+                        ymin,
+                        ymax,
+                        alpha=0.25, color='grey', zorder=1,
+                        label='Threshold region')
+
+        # Sets axis labels, grid and legend
+        ax.set_xlabel('X value')
+        ax.set_ylabel('Y value')
+        ax.grid(alpha=0.2)
+        ax.legend(fontsize='x-small')
 
-            # Creates a new figure axis for plotting
-            fig, ax = plt.subplots(layout='constrained', figsize=(9, 9))
-            ax.set_title(f'Test Data vs. Ideal Function {current_y} Deviation')
+        try:
+            # Saves the plot for the ideal function to to output folder
+            plt.savefig(os.path.join(self.output_dir,
+                                     f'plot_test_vs_ideal_{current_y}.png'))
+            logger.info('figure %s is successfully saved.', current_y)
+            plt.close()
+            return True
+        except PermissionError:
+            logger.error("Permission denied when trying to save the file.")
+        except Exception as e:
+            logger.error("saving figure %s failed: %s", current_y, e)
+        return False
 
-            # Plots the selected ideal function line
-            ax.plot(self.ideal_data['x'],
-                    self.ideal_data[current_y],
-                    label=f'Ideal function {current_y}',
-                    zorder=1.1)
+    def figure_file(self, method, args):
+        """
+        :return: The file name a plot method saves its figure to.
+        """
+        if method == 'plot_test_vs_ideal_single':
+            return f'plot_test_vs_ideal_{args[0]}.png'
+        return method.removeprefix('plot_') + '.png'
 
-            # Filter mapped and unmapped test values for plotting
-            is_mapped = mapped_ideal_test == current_y
-            mapped_test = self.test_data[is_mapped]
-            unmapped_test = self.test_data[~is_mapped]
+    def figure_fingerprint(self, method, args):
+        """
+        Calculates a content hash of everything a figure is drawn from: the
+        plot settings, the selection and the plotted slices of the tables.
+        A single ideal function figure only covers its own ideal function
+        and the test points with whether they are mapped to it, so remapping
+        points between other ideal functions leaves it unchanged.
+
+        :param method: Name of the VisualizeData plot method
+        :param args: Positional arguments of the plot method
+        :return: The hexadecimal SHA-256 digest of the figure inputs.
+        """
+        digest = hashlib.sha256()
+        settings = [method, list(args), self.max_points, self.line_bins,
+                    self.max_residuals]
+        # Missing mappings hash the same whether stored as None or NaN
+        mapped_ideal_test = self.test_data['ideal_function']
+        test_data = pd.DataFrame({
+            'x': self.test_data['x'].to_numpy(dtype=np.float64),
+            'y': self.test_data['y'].to_numpy(dtype=np.float64),
+            'ideal_function': mapped_ideal_test.astype(object).fillna('')
+            .to_numpy(dtype=object)})
+
+        # Collects the table slices the figure is drawn from
+        if method == 'plot_test_vs_ideal_single':
+            tables = [self.ideal_data[['x', args[0]]],
+                      test_data[['x', 'y']].assign(
+                          mapped=(mapped_ideal_test == args[0]).to_numpy())]
+        else:
+            # Computed and cached selections hash alike, whatever their
+            # float types
+            settings.append([[train_column, ideal_func, float(max_dev)]
+                             for train_column, (ideal_func, max_dev)
+                             in sorted(self.functions.items())])
+            ideal_columns = ['x'] + sorted({ideal_func for ideal_func, _
+                                            in self.functions.values()})
+            tables = [self.ideal_data[ideal_columns]]
+            if method == 'plot_train_vs_ideal':
+                tables.append(self.train_data)
+            else:
+                tables.append(test_data)
+
+        digest.update(json.dumps(settings).encode())
+        for table in tables:
+            digest.update(','.join(map(str, table.columns)).encode())
+            digest.update(pd.util.hash_pandas_object(
+                table, index=False).to_numpy().tobytes())
+        return digest.hexdigest()
+
+    def read_manifest(self):
+        """
+        :return: A dictionary mapping saved figure files to the fingerprint
+        of their inputs, empty if there is no manifest.
+        """
+        try:
+            with open(os.path.join(self.output_dir, self.manifest_name),
+                      encoding='utf-8') as manifest:
+                return json.load(manifest)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
 
-            # Plots unmapped test values corresponding to the ideal function
-            ax.scatter(unmapped_test['x'],
-                       unmapped_test['y'],
-                       label='Unmapped test values',
-                       color='grey', s=20, zorder=1.2)
+    def write_manifest(self, manifest):
+        """
+        Replaces the figure manifest in the output folder.
 
-            # Plots mapped test values corresponding to the ideal function
-            ax.scatter(mapped_test['x'],
-                       mapped_test['y'],
-                       label='Mapped test values',
-                       color='red', s=20, zorder=1.2)
+        :param manifest: Dictionary mapping figure files to fingerprints
+        """
+        manifest_path = os.path.join(self.output_dir, self.manifest_name)
+        try:
+            with open(manifest_path + '.tmp', 'w',
+                      encoding='utf-8') as output:
+                json.dump(manifest, output, indent=2, sort_keys=True)
+            os.replace(manifest_path + '.tmp', manifest_path)
+        except Exception as e:
+            logger.error("Writing the figure manifest failed. "
+                         "Error occurred: %s", e)
 
-            # Retrieves Deviation threshold Intervals
-            current_y_column = self.ideal_data[current_y]
-            ymin = current_y_column - max_deviation * np.sqrt(2)
-            ymax = current_y_column + max_deviation * np.sqrt(2)
-            # Plots the Root-Mean-Square Threshold region of the deviation
-            ax.fill_between(self.ideal_data['x'],
-                            ymin,
-                            ymax,
-                            alpha=0.25, color='grey', zorder=1,
-                            label='Threshold region')
+    def render_all(self, workers=None, force=False):
+        """
+        Renders every figure whose inputs changed since it was last saved on
+        the non-interactive Agg backend, in a process pool when more than one
+        of `workers` is requested.
 
-            # Sets axis labels, grid and legend
-            ax.set_xlabel('X value')
-            ax.set_ylabel('Y value')
-            ax.grid(alpha=0.2)
-            ax.legend(fontsize='x-small')
-
-            try:
-                # Saves the plot for each ideal function to to output folder
-                plt.savefig(f'Output/plot_test_vs_ideal_{current_y}.png')
-                print(f'figure {current_y} is successfully saved.')
-                plt.close()
-            except PermissionError:
-                print("Error: Permission denied when trying to save the file.")
-            except Exception as e:
-                print(f"saving figure {current_y} failed: {e}")
+        :param force: Renders all figures, even unchanged ones
+        :return: A dictionary mapping every rendered figure to its render
+        time in seconds.
+        """
+        figures = [('plot_train_vs_ideal', ()),
+                   ('plot_test_vs_ideal', ()),
+                   ('plot_test_over_ideal', ())]
+        # Train functions sharing an ideal function share its figure
+        figures += [('plot_test_vs_ideal_single',
+                     (current_y, float(max_deviation)))
+                    for current_y, max_deviation in dict.fromkeys(
+                        map(tuple, self.functions.values()))]
+
+        # Skips figures that were saved from the same inputs before
+        manifest = self.read_manifest()
+        fingerprints = {self.figure_file(method, args):
+                        self.figure_fingerprint(method, args)
+                        for method, args in figures}
+        if not force:
+            figures = [
+                (method, args) for method, args in figures
+                if manifest.get(self.figure_file(method, args)) !=
+                fingerprints[self.figure_file(method, args)] or
+                not os.path.exists(os.path.join(
+                    self.output_dir, self.figure_file(method, args)))]
+        if not figures:
+            logger.info('All figures are up to date.')
+            return {}
+
+        state = {'functions': self.functions,
+                 'train_data': self.train_data,
+                 'ideal_data': self.ideal_data,
+                 'test_data': self.test_data,
+                 'output_dir': self.output_dir,
+                 'max_points': self.max_points,
+                 'line_bins': self.line_bins,
+                 'max_residuals': self.max_residuals}
+
+        if workers and workers > 1:
+            # Ships the plotted data once per worker instead of per figure
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=init_render_worker,
+                                     initargs=(state,)) as executor:
+                futures = [executor.submit(render_figure, method, args)
+                           for method, args in figures]
+                results = []
+                for future in futures:
+                    elapsed, saved, records = future.result()
+                    results.append((elapsed, saved))
+                    # Hands the stage records of the workers to local hooks
+                    for record in records:
+                        instrumentation.emit(record)
+        else:
+            init_render_worker(state)
+            results = [render_figure(method, args)[:2]
+                       for method, args in figures]
+
+        render_times = {}
+        for (method, args), (elapsed, saved) in zip(figures, results):
+            name = '_'.join([method] + [str(arg) for arg in args[:1]])
+            render_times[name] = elapsed
+            logger.info('%s rendered in %.3fs.', name, elapsed)
+            # Records only figures that were saved during this run
+            figure_file = self.figure_file(method, args)
+            if saved:
+                manifest[figure_file] = fingerprints[figure_file]
+            else:
+                manifest.pop(figure_file, None)
+        self.write_manifest(manifest)
+        return render_times
+
+
+# Visualizer rebuilt from plain data in every render worker process
+render_worker = None
+
+
+def init_render_worker(state):
+    """
+    Prepares a render worker: forces the Agg backend and rebuilds a
+    VisualizeData object without a database session.
+
+    :param state: Dictionary with the selection, data and output folder
+    """
+    global render_worker
+    plt.switch_backend('Agg')
+    render_worker = VisualizeData.__new__(VisualizeData)
+    render_worker.session = None
+    render_worker.show = False
+    for name, value in state.items():
+        setattr(render_worker, name, value)
+
+
+def render_figure(method, args):
+    """
+    Renders one figure with the worker's visualizer.
+
+    :param method: Name of the VisualizeData plot method
+    :param args: Positional arguments of the plot method
+    :return: The render time in seconds, whether the figure was saved and
+    the instrumentation records of the plot stages.
+    """
+    records = []
+    hook = instrumentation.add_hook(records.append)
+    start = time.perf_counter()
+    try:
+        saved = getattr(render_worker, method)(*args)
+    finally:
+        instrumentation.remove_hook(hook)
+    return time.perf_counter() - start, saved, records
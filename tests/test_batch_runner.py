@@ -0,0 +1,169 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from parameterized import parameterized
+from database import models
+from benchmarks.data_generator import DataGenerator
+from ops_viz.batch_runner import BatchRunner
+from ops_viz.data_processing import MathUtils, ProcessData
+
+
+class TestBatchRunner(unittest.TestCase):
+    """
+    Unit tests for the BatchRunner class.
+    """
+    def setUp(self):
+        """
+        Set up three data sets sharing one ideal library, in folders and in
+        a manifest, and an empty database.
+        """
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.batch_dir = os.path.join(self.tmp_dir.name, 'batch')
+        # The seed alone fixes the ideal functions, the noise varies
+        for i, noise in enumerate((0.1, 0.3, 0.5)):
+            paths = DataGenerator(samples=200, test_points=60, noise=noise,
+                                  seed=7).write(os.path.join(self.batch_dir,
+                                                             f'set{i}'))
+        self.ideal_path = os.path.join(self.tmp_dir.name, 'ideal.csv')
+        os.replace(paths['ideal'], self.ideal_path)
+        self.manifest_path = os.path.join(self.tmp_dir.name, 'manifest.csv')
+        pd.DataFrame({'dataset_id': ['a', 'b'],
+                      'train': ['batch/set0/train.csv',
+                                'batch/set1/train.csv'],
+                      'test': ['batch/set0/test.csv',
+                               'batch/set1/test.csv']}).to_csv(
+            self.manifest_path, index=False)
+        self.url = f"sqlite:///{os.path.join(self.tmp_dir.name, 'test.db')}"
+        self.session = models.create_session(url=self.url)
+
+    def tearDown(self):
+        """
+        Closes the database and removes the temporary files.
+        """
+        self.session.close()
+        models.dispose_engines()
+        self.tmp_dir.cleanup()
+
+    def stored(self, table):
+        """
+        :return: A sorted DataFrame of a batch table.
+        """
+        data = pd.read_sql_table(table, self.session.connection())
+        self.session.rollback()
+        return data.drop(columns='id', errors='ignore').sort_values(
+            list(data.columns.drop('id', errors='ignore'))).reset_index(
+            drop=True)
+
+    def test_find_datasets(self):
+        """
+        Tests that data sets are found in folders and in manifests.
+        """
+        runner = BatchRunner(self.session, self.ideal_path)
+        self.assertEqual([dataset_id for dataset_id, _, _
+                          in runner.find_datasets(self.batch_dir)],
+                         ['set0', 'set1', 'set2'])
+        datasets = runner.find_datasets(self.manifest_path)
+        self.assertEqual([dataset_id for dataset_id, _, _ in datasets],
+                         ['a', 'b'])
+        self.assertTrue(all(os.path.isfile(train) and os.path.isfile(test)
+                            for _, train, test in datasets))
+
+    @parameterized.expand([
+        # Fits in the current process and in a process pool
+        (None,), (2,),
+        ])
+    def test_run(self, workers):
+        """
+        Tests that every data set gets the selection and mapping of the
+        single data set pipeline.
+
+        :param workers: Number of fitting processes
+        """
+        report = BatchRunner(self.session, self.ideal_path,
+                             workers=workers).run(self.batch_dir)
+        self.assertEqual((report['datasets'], report['failed']), (3, {}))
+        self.assertEqual(report['test_points'], 180)
+        self.assertGreater(report['test_points_per_sec'], 0)
+
+        ideal_data = pd.read_csv(self.ideal_path)
+        selections = self.stored('batch_selected_functions')
+        points = self.stored('batch_test_data')
+        for i in range(3):
+            dataset_id = f'set{i}'
+            folder = os.path.join(self.batch_dir, dataset_id)
+            train_data = pd.read_csv(os.path.join(folder, 'train.csv'))
+            test_data = pd.read_csv(os.path.join(folder, 'test.csv'))
+
+            # Full search of the single data set pipeline
+            best_fits, _, best_max_dev = MathUtils().best_fits(
+                *MathUtils().sqd_dev_matrix(
+                    train_data.iloc[:, 1:].to_numpy(),
+                    ideal_data.iloc[:, 1:].to_numpy()))
+            selection = selections[selections['dataset_id'] == dataset_id] \
+                .sort_values('position')
+            np.testing.assert_array_equal(
+                selection['ideal_function'],
+                ideal_data.columns[1:][best_fits])
+            np.testing.assert_array_equal(selection['max_deviation'],
+                                          best_max_dev)
+
+            processor = ProcessData(None)
+            processor.selection = {
+                row.train_function: [row.ideal_function, row.max_deviation]
+                for row in selection.itertuples()}
+            mapped, delta_y, functions = processor.map_test_points(
+                test_data['x'], test_data['y'], ideal_data)
+            stored = points[points['dataset_id'] == dataset_id]
+            self.assertEqual(len(stored), len(test_data))
+            self.assertEqual(stored['ideal_function'].notna().sum(),
+                             mapped.sum())
+            np.testing.assert_allclose(np.sort(stored['delta_y'].dropna()),
+                                       np.sort(delta_y))
+
+    def test_train_x_tolerance(self):
+        """
+        Tests that train x values within the tolerance on either side of a
+        library x value are aligned with it.
+        """
+        train_path = os.path.join(self.batch_dir, 'set0', 'train.csv')
+        train_data = pd.read_csv(train_path)
+        expected = BatchRunner(self.session, self.ideal_path).run(
+            self.batch_dir)
+        train_data.loc[::2, 'x'] += 5e-10
+        train_data.loc[1::2, 'x'] -= 5e-10
+        train_data.to_csv(train_path, index=False)
+        selections = self.stored('batch_selected_functions')
+
+        report = BatchRunner(self.session, self.ideal_path).run(
+            self.batch_dir)
+        self.assertEqual(report['failed'], {})
+        self.assertEqual(report['mapped'], expected['mapped'])
+        pd.testing.assert_frame_equal(
+            self.stored('batch_selected_functions'), selections)
+
+    def test_rerun_and_failure(self):
+        """
+        Tests that a rerun replaces the rows of its data sets and that a
+        failing data set leaves the others stored.
+        """
+        runner = BatchRunner(self.session, self.ideal_path)
+        runner.run(self.manifest_path)
+        first = self.stored('batch_test_data')
+
+        # Shifts the train x values of set1 off the ideal grid
+        train_path = os.path.join(self.batch_dir, 'set1', 'train.csv')
+        train_data = pd.read_csv(train_path)
+        train_data['x'] += 0.01
+        train_data.to_csv(train_path, index=False)
+        report = runner.run(self.manifest_path)
+
+        self.assertEqual(list(report['failed']), ['b'])
+        self.assertIn('KeyError', report['failed']['b'])
+        pd.testing.assert_frame_equal(self.stored('batch_test_data'), first)
+        self.assertEqual(len(self.stored('batch_selected_functions')), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+import numpy as np
+from parameterized import parameterized
+from benchmarks.data_generator import DataGenerator
+from benchmarks.run_benchmarks import BenchmarkRunner, compare
+from benchmarks.precision_check import PrecisionCheck
+from benchmarks.kernel_benchmarks import KernelBenchmark
+
+
+class TestDataGenerator(unittest.TestCase):
+    """
+    Unit tests for the DataGenerator class.
+    """
+    @parameterized.expand([
+        # Defines data set sizes
+        (400, 50, 4, 100), (1_000, 8, 3, 2_000),
+        ])
+    def test_generate(self, samples, ideal_functions, train_columns,
+                      test_points):
+        """
+        Tests the shape and reproducibility of the generated data sets.
+        """
+        generator = DataGenerator(samples, ideal_functions, train_columns,
+                                  test_points)
+        train_data, ideal_data, test_data = generator.generate()
+
+        self.assertEqual(train_data.shape, (samples, train_columns + 1))
+        self.assertEqual(ideal_data.shape, (samples, ideal_functions + 1))
+        self.assertEqual(test_data.shape, (test_points, 2))
+        self.assertEqual(list(train_data.columns)[:2], ['x', 'y1'])
+        np.testing.assert_array_equal(train_data['x'], ideal_data['x'])
+        self.assertTrue(test_data['x'].isin(ideal_data['x']).all())
+        for generated, again in zip((train_data, ideal_data, test_data),
+                                    generator.generate()):
+            self.assertTrue(generated.equals(again))
+
+
+class TestBenchmarkRunner(unittest.TestCase):
+    """
+    Unit tests for the BenchmarkRunner class.
+    """
+    def test_run(self):
+        """
+        Tests that every stage is timed and compared on a tiny data set.
+        """
+        scale = {'samples': 40, 'ideal_functions': 50, 'train_columns': 4,
+                 'test_points': 20}
+        report = BenchmarkRunner({'tiny': scale}, trace_memory=False).run()
+
+        self.assertEqual([record['stage'] for record in report['results']],
+                         ['bulk_insert', 'select_functions',
+                          'insert_test_data', 'plot_train_vs_ideal',
+                          'plot_test_vs_ideal', 'plot_test_over_ideal',
+                          'plot_test_vs_ideal_individual'])
+        self.assertTrue(all(record['seconds'] > 0
+                            for record in report['results']))
+        comparison = compare(report, report)
+        self.assertEqual(len(comparison), 7)
+        self.assertTrue(all(row['seconds_ratio'] == 1 for row in comparison))
+
+    def test_unsupported_scale(self):
+        """
+        Tests that scales the wide tables cannot hold are rejected.
+        """
+        with self.assertRaises(ValueError):
+            BenchmarkRunner({'wide': {'samples': 40, 'ideal_functions': 80,
+                                      'train_columns': 4,
+                                      'test_points': 20}})
+
+
+class TestPrecisionCheck(unittest.TestCase):
+    """
+    Unit tests for the PrecisionCheck class.
+    """
+    def test_run(self):
+        """
+        Tests that compact tables select and map like float64 ones in about
+        half the memory.
+        """
+        report = PrecisionCheck(*DataGenerator(
+            samples=2_000, test_points=500).generate()).run()
+
+        self.assertEqual(report['equal_selections'], 4)
+        self.assertLess(report['max_deviation_max_rel_error'], 1e-5)
+        self.assertEqual(report['equal_assignments'], 500)
+        self.assertLess(report['delta_y_max_abs_error'], 1e-4)
+        self.assertLess(report['memory_ratio'], 0.6)
+
+
+class TestKernelBenchmark(unittest.TestCase):
+    """
+    Unit tests for the KernelBenchmark class.
+    """
+    def test_run(self):
+        """
+        Tests that every case is timed and its old and new calculations
+        agree.
+        """
+        results = KernelBenchmark(rows=300, ideal_functions=6, nan_share=0.1,
+                                  repeat=1).run()
+
+        self.assertEqual([result['case'] for result in results],
+                         ['sse_max', 'sse_max_skipna', 'abs_deviations'])
+        for result in results:
+            self.assertTrue(result['agree'])
+            self.assertGreater(result['old_seconds'], 0)
+            self.assertGreater(result['speedup'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from database.columnar_cache import ColumnarCache
+
+
+class TestColumnarCache(unittest.TestCase):
+    """
+    Unit tests for the ColumnarCache class.
+    """
+    def setUp(self):
+        """
+        Set up a temporary source CSV file and cache directory.
+        """
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.source_path = os.path.join(self.tmp_dir.name, 'train.csv')
+        self.mock_train_data = pd.DataFrame({
+            'x': [-0.1, 0, 0.1, 0.2], 'y1': [1.5, 2, 3, 4]})
+        self.mock_train_data.to_csv(self.source_path, index=False)
+        self.cache = ColumnarCache(os.path.join(self.tmp_dir.name, 'cache'))
+
+    def tearDown(self):
+        """
+        Removes the temporary files.
+        """
+        self.tmp_dir.cleanup()
+
+    def test_write_and_load(self):
+        """
+        Tests that chunked writes load back as memory-mapped columns.
+        """
+        self.assertIsNone(self.cache.load('train_data'))
+        self.cache.write('train_data',
+                         [self.mock_train_data.iloc[:3],
+                          self.mock_train_data.iloc[3:]],
+                         self.source_path)
+
+        loaded = self.cache.load('train_data')
+        pd.testing.assert_frame_equal(loaded, self.mock_train_data)
+        self.assertIsInstance(loaded['y1'].values, np.memmap)
+        pd.testing.assert_frame_equal(self.cache.load('train_data', ['y1']),
+                                      self.mock_train_data[['y1']])
+
+    def test_invalidation(self):
+        """
+        Tests that a touched but unchanged source keeps the cache valid while
+        changed content invalidates it.
+        """
+        self.cache.write('train_data', [self.mock_train_data],
+                         self.source_path)
+        stat = os.stat(self.source_path)
+        os.utime(self.source_path, ns=(stat.st_atime_ns,
+                                       stat.st_mtime_ns + 10**9))
+        self.assertTrue(self.cache.is_valid('train_data'))
+
+        # Same size, different content
+        self.mock_train_data.loc[0, 'y1'] = 9.5
+        self.mock_train_data.to_csv(self.source_path, index=False)
+        os.utime(self.source_path, ns=(stat.st_atime_ns,
+                                       stat.st_mtime_ns + 2 * 10**9))
+        self.assertFalse(self.cache.is_valid('train_data'))
+        self.assertIsNone(self.cache.load('train_data'))
+
+    def test_source_path(self):
+        """
+        Tests that a table cached from one source file is not loaded for
+        another and that its fingerprint is the source content hash.
+        """
+        self.cache.write('train_data', [self.mock_train_data],
+                         self.source_path)
+        other_path = os.path.join(self.tmp_dir.name, 'other.csv')
+        self.mock_train_data.to_csv(other_path, index=False)
+
+        self.assertIsNone(self.cache.load('train_data',
+                                          source_path=other_path))
+        pd.testing.assert_frame_equal(
+            self.cache.load('train_data', source_path=self.source_path),
+            self.mock_train_data)
+        self.assertEqual(
+            self.cache.fingerprint('train_data'),
+            self.cache.source_signature(self.source_path)['sha256'])
+        os.remove(self.source_path)
+        self.assertIsNone(self.cache.fingerprint('train_data'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,15 @@
+import os
+import tempfile
 import unittest
+import tracemalloc
+import numpy as np
 import pandas as pd
 from unittest.mock import patch, MagicMock
 from parameterized import parameterized
-from ops_viz.data_processing import MathUtils, ProcessData
+from sqlalchemy import create_engine, insert, inspect, update
+from sqlalchemy.orm import sessionmaker
+from database import models
+from ops_viz.data_processing import MathUtils, DataHandler, ProcessData
 
 
 class TestMathUtils(unittest.TestCase):
@@ -39,6 +46,362 @@ class TestMathUtils(unittest.TestCase):
         math_utils = MathUtils()
         self.assertEqual(math_utils.max_deviation(column1, column2), max_dev)
 
+    @parameterized.expand([
+        # Defines different block sizes, including a partial last block
+        (1,), (2,), (256,),
+        ])
+    def test_sqd_dev_matrix(self, chunk_size):
+        """
+        Tests that the batched matrix matches the pairwise calculations.
+
+        :param chunk_size: Number of ideal columns processed per block
+        """
+        math_utils = MathUtils()
+        train = pd.DataFrame({'y1': [1, 2, 3], 'y2': [-1, 0.5, 4]})
+        ideal = pd.DataFrame({'y1': [1, 2, 4], 'y2': [0, 0, 0],
+                              'y3': [-1, 1, 3]})
+        sqd_sums, max_devs = math_utils.sqd_dev_matrix(
+            train.to_numpy(dtype=float), ideal.to_numpy(dtype=float),
+            chunk_size)
+
+        for i, train_column in enumerate(train.columns):
+            for j, ideal_column in enumerate(ideal.columns):
+                self.assertAlmostEqual(
+                    sqd_sums[i, j],
+                    math_utils.sqd_dev_sum(train[train_column],
+                                           ideal[ideal_column]))
+                self.assertAlmostEqual(
+                    max_devs[i, j],
+                    math_utils.max_deviation(train[train_column],
+                                             ideal[ideal_column]))
+
+    @parameterized.expand([
+        # Defines scratch budgets of one pair, one train column and more
+        (8 * 20_000,), (8 * 20_000 * 3,), (2 ** 20,),
+        ])
+    def test_sqd_dev_matrix_block_budget(self, max_block_bytes):
+        """
+        Tests that the scratch array stays within its byte budget and that
+        narrower blocks give bitwise identical results.
+
+        :param max_block_bytes: Size limit of the scratch array
+        """
+        math_utils = MathUtils()
+        rng = np.random.default_rng(4)
+        train = rng.normal(size=(20_000, 4))
+        ideal = rng.normal(size=(20_000, 50))
+        expected = math_utils.sqd_dev_matrix(train, ideal)
+
+        tracemalloc.start()
+        try:
+            result = math_utils.sqd_dev_matrix(
+                train, ideal, max_block_bytes=max_block_bytes)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # Contiguous train columns, the deviations and the ideal block with
+        # its temporaries, far below the 32 MB of an unbounded block
+        self.assertLess(peak, train.nbytes + 3 * max_block_bytes + 2 ** 16)
+        for expected_values, values in zip(expected, result):
+            np.testing.assert_array_equal(values, expected_values)
+
+    @parameterized.expand([
+        # Defines block sizes, with and without a row mask
+        (1, None), (2, [True, False, True, True, True]), (256, None),
+        ])
+    def test_sqd_dev_matrix_skipna(self, chunk_size, mask):
+        """
+        Tests that skipna scores every pair over the rows where both columns
+        are present, like the pairwise calculation of those rows, and that
+        the results are written to a given output buffer.
+
+        :param chunk_size: Number of ideal columns processed per block
+        :param mask: Optional boolean row selection
+        """
+        math_utils = MathUtils()
+        train = np.array([[1, np.nan], [2, 0.5], [3, 4], [np.nan, 1],
+                          [5, 2]])
+        ideal = np.array([[1, 0, np.nan], [2, np.nan, 1], [4, 0, np.nan],
+                          [1, 0, np.nan], [4, 1, np.nan]], dtype=np.float32)
+        out = (np.empty((2, 3)), np.empty((2, 3)))
+        sqd_sums, max_devs = math_utils.sqd_dev_matrix(
+            train, ideal, chunk_size, out=out, skipna=True, mask=mask)
+        self.assertIs(sqd_sums, out[0])
+        self.assertIs(max_devs, out[1])
+        counts = math_utils.valid_counts(train, ideal, chunk_size, mask)
+
+        rows = np.ones(5, dtype=bool) if mask is None else np.array(mask)
+        for i in range(2):
+            for j in range(3):
+                valid = rows & ~np.isnan(train[:, i]) & ~np.isnan(ideal[:, j])
+                self.assertEqual(counts[i, j], valid.sum())
+                if not valid.any():
+                    self.assertTrue(np.isnan(sqd_sums[i, j]))
+                    self.assertTrue(np.isnan(max_devs[i, j]))
+                    continue
+                column1 = train[valid, i]
+                column2 = ideal[valid, j].astype(np.float64)
+                self.assertEqual(sqd_sums[i, j],
+                                 math_utils.sqd_dev_sum(column1, column2))
+                self.assertEqual(max_devs[i, j],
+                                 math_utils.max_deviation(column1, column2))
+                self.assertAlmostEqual(
+                    math_utils.rmse(train[rows, i], ideal[rows, j],
+                                    skipna=True),
+                    np.sqrt(np.mean((column1 - column2) ** 2)))
+        # Without skipna a missing row makes the whole pair missing
+        self.assertTrue(np.isnan(math_utils.sqd_dev_sum(train[:, 0],
+                                                        ideal[:, 0])))
+        self.assertEqual(math_utils.sqd_dev_sum(train[:, 0], ideal[:, 0],
+                                                skipna=True), 2)
+
+    @parameterized.expand([
+        # Defines noise levels, block sizes and subsample steps
+        (0.3, 1024, 64), (0.0, 1, 1), (1e-9, 7, 5), (5.0, 100, 3),
+        ])
+    def test_pruned_best_fits(self, noise, first_block, sample_step):
+        """
+        Tests that the pruned search returns exactly the exhaustive result,
+        including exact ties, near ties and NaN values.
+
+        :param noise: Standard deviation of the train noise
+        :param first_block: Number of rows of the first pruning block
+        :param sample_step: Row step of the subsample seeding the bounds
+        """
+        math_utils = MathUtils()
+        rng = np.random.default_rng(1)
+        ideal = np.cumsum(rng.normal(size=(2_000, 60)), axis=0)
+        # Exact tie between y2 and y3, near tie between y1 and y4
+        ideal[:, 2] = ideal[:, 1]
+        ideal[:, 3] = ideal[:, 0] + 1e-13
+        ideal[5, 59] = np.nan
+        train = ideal[:, [0, 2, 30, 59]] + rng.normal(0, noise, (2_000, 4))
+
+        expected = math_utils.best_fits(
+            *math_utils.sqd_dev_matrix(train, ideal, 16))
+        result = math_utils.pruned_best_fits(train, ideal, 16, first_block,
+                                             sample_step)
+        for expected_values, values in zip(expected, result):
+            np.testing.assert_array_equal(values, expected_values)
+
+        # The top k candidates match the exhaustive ranking as well
+        expected = math_utils.top_fits(
+            *math_utils.sqd_dev_matrix(train, ideal, 16), 4)
+        result = math_utils.pruned_top_fits(train, ideal, 4, 16, first_block,
+                                            sample_step)
+        for expected_values, values in zip(expected, result):
+            np.testing.assert_array_equal(values, expected_values)
+
+    @parameterized.expand([
+        # Defines budgets of one column, one column with its copy and more
+        (8 * 20_000,), (8 * 20_000 * 2,), (2 ** 20,),
+        ])
+    def test_pruned_top_fits_block_budget(self, max_block_bytes):
+        """
+        Tests that the pruned search stays within the scratch budget when
+        almost nothing is pruned and returns the exhaustive ranking.
+
+        :param max_block_bytes: Size limit of the block temporaries
+        """
+        math_utils = MathUtils()
+        rng = np.random.default_rng(5)
+        train = rng.normal(size=(20_000, 4))
+        ideal = rng.normal(size=(20_000, 50))
+        expected = math_utils.top_fits(
+            *math_utils.sqd_dev_matrix(train, ideal), 3)
+
+        tracemalloc.start()
+        try:
+            result = math_utils.pruned_top_fits(
+                train, ideal, 3, max_block_bytes=max_block_bytes)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # Far below the 8 MB copy of all surviving columns
+        self.assertLess(peak, train.nbytes + 3 * max_block_bytes + 2 ** 17)
+        for expected_values, values in zip(expected, result):
+            np.testing.assert_array_equal(values, expected_values)
+
+    def test_top_fits(self):
+        """
+        Tests that candidates are ranked by squared deviation sum, first
+        column first on ties and NaN last, with the best fit at rank 0.
+        """
+        math_utils = MathUtils()
+        sqd_sums = np.array([[3.0, 1.0, np.nan, 1.0, 2.0],
+                             [0.5, 4.0, 0.2, 9.0, np.nan]])
+        max_devs = sqd_sums / 2
+        ranked, top_sqd, top_max_dev = math_utils.top_fits(sqd_sums,
+                                                           max_devs, 3)
+        np.testing.assert_array_equal(ranked, [[1, 3, 4], [2, 0, 1]])
+        np.testing.assert_array_equal(top_sqd, [[1, 1, 2], [0.2, 0.5, 4]])
+        np.testing.assert_array_equal(top_max_dev, top_sqd / 2)
+        for expected_values, values in zip(
+                math_utils.best_fits(sqd_sums, max_devs),
+                (ranked, top_sqd, top_max_dev)):
+            np.testing.assert_array_equal(values[:, 0], expected_values)
+
+    @parameterized.expand([
+        # Defines left and right insertion sides
+        ('left',), ('right',),
+        ])
+    def test_row_searchsorted(self, side):
+        """
+        Tests that every value is inserted into its own row like
+        np.searchsorted, with duplicates, NaN padding and one column rows.
+
+        :param side: Insertion side of values equal to row entries
+        """
+        math_utils = MathUtils()
+        rng = np.random.default_rng(2)
+        for n_columns in (1, 2, 7):
+            sorted_rows = np.sort(rng.integers(0, 5, (20, n_columns))
+                                  .astype(float), axis=1)
+            sorted_rows[3, -1] = np.nan
+            rows = rng.integers(0, 20, 200)
+            values = rng.integers(-1, 7, 200).astype(float)
+            expected = [np.searchsorted(sorted_rows[row], value, side)
+                        for row, value in zip(rows, values)]
+            np.testing.assert_array_equal(
+                math_utils.row_searchsorted(sorted_rows, rows, values, side),
+                expected)
+
+
+class TestDataHandler(unittest.TestCase):
+    """
+    Unit tests for the DataHandler class.
+    """
+    def setUp(self):
+        """
+        Set up an in-memory database holding a mock train table.
+        """
+        self.engine = create_engine("sqlite://")
+        self.mock_train_data = pd.DataFrame({
+            'x': [-0.1, 0, 0.1, 0.2],
+            'y1': [1.0, 2.0, 3.0, 4.0],
+            'y2': [-10.0, -20.0, -30.0, -40.0],
+        })
+        self.mock_train_data.to_sql('train_data', self.engine, index=False)
+        self.session = sessionmaker(bind=self.engine)()
+
+    @parameterized.expand([
+        # Defines projections and x ranges with their expected rows
+        (None, None, [0, 1, 2, 3]),
+        (['x', 'y2'], None, [0, 1, 2, 3]),
+        (['y2'], (0, 0.1), [1, 2]),
+        (None, (0.15, 1), [3]),
+        (['x', 'y1'], [0, 0.1], [1, 2]),
+        ])
+    def test_get_data(self, columns, x_range, rows):
+        """
+        Tests column projection and x range filtering, from the database and
+        from the cached full table.
+
+        :param rows: Expected row positions of the mock train table
+        """
+        expected = self.mock_train_data.iloc[rows].reset_index(drop=True)
+        expected = expected if columns is None else expected[columns]
+        # Reads once from the database, then from the cached full table
+        for data_handler in (DataHandler(self.session),
+                             DataHandler(self.session)):
+            pd.testing.assert_frame_equal(
+                data_handler.get_data('train_data', columns, x_range),
+                expected)
+            data_handler.get_data('train_data')
+
+    @patch('pandas.read_sql_table', wraps=pd.read_sql_table)
+    def test_get_data_cache(self, mock_read_sql_table):
+        """
+        Tests that tables are read once per session until invalidated.
+        """
+        first_handler = DataHandler(self.session)
+        second_handler = DataHandler(self.session)
+        train_data = first_handler.get_data('train_data')
+        train_data['y1'] = 0
+        pd.testing.assert_frame_equal(second_handler.get_data('train_data'),
+                                      self.mock_train_data)
+        second_handler.get_data('train_data', columns=['x', 'y1'])
+        self.assertEqual(mock_read_sql_table.call_count, 1)
+
+        second_handler.invalidate_cache('train_data')
+        first_handler.get_data('train_data')
+        self.assertEqual(mock_read_sql_table.call_count, 2)
+
+    def test_get_data_columnar_cache(self):
+        """
+        Tests that the columnar cache is only read while it holds the source
+        recorded for the database rows.
+        """
+        models.Base.metadata.create_all(self.engine)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            source_path = os.path.join(tmp_dir, 'train.csv')
+            cached_data = self.mock_train_data.assign(y1=0.0)
+            cached_data.to_csv(source_path, index=False)
+            data_handler = DataHandler(self.session,
+                                       cache_dir=os.path.join(tmp_dir,
+                                                              'cache'))
+            data_handler.columnar_cache.write('train_data', [cached_data],
+                                              source_path)
+
+            # No source recorded, then another one, then the cached one
+            for sha256, source, expected in [
+                    (None, 'database', self.mock_train_data),
+                    ('0' * 64, 'database', self.mock_train_data),
+                    (data_handler.columnar_cache.fingerprint('train_data'),
+                     'columnar_cache', cached_data)]:
+                if sha256 is not None:
+                    self.session.merge(models.CacheState(name='train_data',
+                                                         sha256=sha256))
+                    self.session.commit()
+                data, loaded_from = data_handler.load_data('train_data',
+                                                           None, None)
+                self.assertEqual(loaded_from, source)
+                pd.testing.assert_frame_equal(data, expected)
+                data_handler.invalidate_cache('train_data')
+
+    @parameterized.expand([
+        # Defines access paths with their expected ids and used index
+        ('y11', False, None, [3, 1], 'ix_test_data_ideal_function_x'),
+        ('y11', False, (0, 1), [1], 'ix_test_data_ideal_function_x'),
+        (None, True, None, [2, 4], 'ix_test_data_ideal_function_x'),
+        (None, False, (-0.05, 0.05), [1, 2], 'ix_test_data_x'),
+        ])
+    def test_get_test_points(self, ideal_function, unmapped, x_range, ids,
+                             index):
+        """
+        Tests that test points are read through the test_data indexes, from
+        the database and from the cached full table.
+
+        :param ids: Expected test_data ids, ordered by x
+        :param index: Name of the index the query plan has to use
+        """
+        models.Base.metadata.create_all(self.engine)
+        with self.session as session:
+            session.execute(insert(models.TestData), [
+                {'x': 0, 'y': 2, 'delta_y': 1, 'ideal_function': 'y11'},
+                {'x': 0, 'y': -19, 'delta_y': None, 'ideal_function': None},
+                {'x': -0.1, 'y': 1, 'delta_y': 1, 'ideal_function': 'y11'},
+                {'x': 0.2, 'y': -39, 'delta_y': None, 'ideal_function': None},
+            ])
+            session.commit()
+        data_handler = DataHandler(self.session)
+
+        query = data_handler.test_points_query(ideal_function, unmapped,
+                                               x_range)
+        with self.engine.connect() as connection:
+            plan = connection.exec_driver_sql(
+                f"EXPLAIN QUERY PLAN {query.compile(self.engine)}",
+                tuple(query.compile(self.engine).params.values())).all()
+        self.assertIn(index, ' '.join(row[-1] for row in plan))
+
+        # Reads from the database, then from the cached full table
+        self.assertEqual(data_handler.get_test_points(
+            ideal_function, unmapped, x_range)['id'].tolist(), ids)
+        data_handler.invalidate_cache('test_data',
+                                      data_handler.get_data('test_data'))
+        self.assertEqual(data_handler.get_test_points(
+            ideal_function, unmapped, x_range)['id'].tolist(), ids)
+
 
 class TestProcessData(unittest.TestCase):
     """
@@ -68,6 +431,23 @@ class TestProcessData(unittest.TestCase):
         # Defines the expected selected function for the test
         self.mock_selection = {'y1': ['y11', 1], 'y2': ['y12', 9]}
 
+    def mock_table(self, table, columns=None, x_range=None):
+        """
+        Returns the mock DataFrame of the given table name.
+        """
+        data = {'train_data': self.mock_train_data,
+                'ideal_functions': self.mock_ideal_data,
+                'test_data': self.mock_test_data}[table]
+        return data if columns is None else data[columns]
+
+    def mock_database_session(self):
+        """
+        Creates a session bound to an empty in-memory database.
+        """
+        engine = create_engine("sqlite://")
+        models.Base.metadata.create_all(engine)
+        return sessionmaker(bind=engine)()
+
     @patch('ops_viz.data_processing.DataHandler.get_data')
     def test_select_functions(self, mock_get_data):
         """
@@ -83,6 +463,32 @@ class TestProcessData(unittest.TestCase):
         # Verifies the result
         self.assertEqual(result, self.mock_selection)
 
+    @patch('ops_viz.data_processing.DataHandler.get_data')
+    def test_select_functions_tie_break(self, mock_get_data):
+        """
+        tests that the first of two equally fitting ideal functions is kept.
+        """
+        self.mock_ideal_data['y13'] = self.mock_ideal_data['y11']
+        mock_get_data.side_effect = [self.mock_ideal_data,
+                                     self.mock_train_data]
+        data_processor = ProcessData(session=None)
+        result = data_processor.select_functions(chunk_size=1)
+        self.assertEqual(result, self.mock_selection)
+
+    @patch('ops_viz.data_processing.DataHandler.get_data')
+    def test_select_functions_pruned(self, mock_get_data):
+        """
+        tests that the pruned search selects the same functions as the full
+        matrix, serially and sharded across processes.
+        """
+        self.mock_ideal_data['y13'] = self.mock_ideal_data['y11']
+        mock_get_data.side_effect = [self.mock_ideal_data,
+                                     self.mock_train_data] * 2
+        for workers in (None, 2):
+            result = ProcessData(session=None).select_functions(
+                chunk_size=2, workers=workers, pruned=True)
+            self.assertEqual(result, self.mock_selection)
+
     @patch('pandas.DataFrame.to_sql')
     @patch('ops_viz.data_processing.DataHandler.get_data')
     def test_insert_test_data(self, mock_get_data, mock_to_sql):
@@ -113,6 +519,386 @@ class TestProcessData(unittest.TestCase):
         # Verifies if the database insertion was attempted
         mock_to_sql.assert_called_once()
 
+    @patch('ops_viz.data_processing.DataHandler.get_data')
+    def test_select_functions_parallel(self, mock_get_data):
+        """
+        tests that sharding the ideal columns across processes selects the
+        same functions as the serial scan, including ties across shards.
+        """
+        rng = np.random.default_rng(0)
+        ideal_data = pd.DataFrame(rng.normal(size=(50, 40)),
+                                  columns=[f'y{i}' for i in range(1, 41)])
+        ideal_data.insert(0, 'x', np.arange(50) / 10)
+        # Duplicates a column into a later shard to check the tie-break
+        ideal_data['y41'] = ideal_data['y3']
+        train_data = ideal_data[['x', 'y3', 'y17', 'y30']].copy()
+        train_data.columns = ['x', 'y1', 'y2', 'y3']
+        train_data.iloc[:, 1:] += rng.normal(scale=0.1, size=(50, 3))
+
+        mock_get_data.side_effect = [ideal_data, train_data] * 2
+        serial = ProcessData(session=None).select_functions()
+        parallel = ProcessData(session=None).select_functions(chunk_size=3,
+                                                              workers=3)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(parallel['y1'][0], 'y3')
+
+    @patch('ops_viz.data_processing.DataHandler.get_data')
+    def test_select_functions_cache(self, mock_get_data):
+        """
+        tests that a cached selection is reused until the train data changes.
+        """
+        mock_get_data.side_effect = self.mock_table
+        session = self.mock_database_session()
+        self.assertEqual(ProcessData(session).select_functions(),
+                         self.mock_selection)
+
+        with patch.object(MathUtils, 'sqd_dev_matrix') as mock_matrix:
+            self.assertEqual(ProcessData(session).select_functions(),
+                             self.mock_selection)
+            mock_matrix.assert_not_called()
+
+        # Changed train data invalidates the cached selection
+        self.mock_train_data['y2'] = [100, 200, 300, 400]
+        self.assertEqual(ProcessData(session).select_functions(),
+                         {'y1': ['y11', 1], 'y2': ['y9', 0]})
+
+    @patch('ops_viz.data_processing.DataHandler.get_data')
+    def test_select_functions_scores(self, mock_get_data):
+        """
+        tests that the top k candidates are ranked alike by every search,
+        cached with the selection and loaded without recomputing them.
+        """
+        mock_get_data.side_effect = self.mock_table
+        expected = pd.DataFrame({
+            'train_function': ['y1'] * 3 + ['y2'] * 3,
+            'rank': [0, 1, 2] * 2,
+            'ideal_function': ['y11', 'y12', 'y9', 'y12', 'y11', 'y10'],
+            'sse': [4.0, 3274.0, 294030.0, 84.0, 3854.0, 243000.0],
+            'max_deviation': [1.0, 45.0, 396.0, 9.0, 45.0, 360.0]})
+        expected['rmse'] = np.sqrt(expected['sse'] / 4)
+        for workers, pruned in ((None, False), (None, True), (2, True)):
+            data_processor = ProcessData(session=None)
+            data_processor.select_functions(chunk_size=2, workers=workers,
+                                            pruned=pruned, top_k=3)
+            pd.testing.assert_frame_equal(data_processor.scores, expected)
+
+        session = self.mock_database_session()
+        ProcessData(session).select_functions(top_k=3)
+        pd.testing.assert_frame_equal(
+            ProcessData(session).load_scores(train_function='y2'),
+            expected[3:].reset_index(drop=True))
+        with patch.object(MathUtils, 'sqd_dev_matrix') as mock_matrix:
+            data_processor = ProcessData(session)
+            data_processor.select_functions(top_k=2)
+            mock_matrix.assert_not_called()
+        pd.testing.assert_frame_equal(data_processor.scores, expected)
+
+        # More candidates than cached are ranked again
+        data_processor = ProcessData(session)
+        data_processor.select_functions(top_k=10)
+        self.assertEqual(data_processor.scores['rank'].max(), 3)
+        self.assertEqual(len(ProcessData(session).load_scores()), 8)
+
+    @patch('ops_viz.data_processing.DataHandler.get_data')
+    def test_select_functions_skipna(self, mock_get_data):
+        """
+        tests that skipna selects and scores candidates over the rows both
+        columns hold, and that missing rows drop a column otherwise.
+        """
+        mock_get_data.side_effect = self.mock_table
+        self.mock_train_data['y1'] = [1, np.nan, 3, 4]
+        self.mock_ideal_data['y12'] = [-11, -21, np.nan, -41]
+        self.assertEqual(ProcessData(session=None).select_functions(),
+                         {'y2': ['y11', 45]})
+
+        data_processor = ProcessData(session=None)
+        result = data_processor.select_functions(top_k=1, skipna=True)
+        self.assertEqual(result, {'y1': ['y11', 1], 'y2': ['y12', 1]})
+        self.assertTrue(data_processor.fingerprint.endswith(':skipna'))
+        np.testing.assert_array_equal(data_processor.scores['sse'], [3, 3])
+        np.testing.assert_array_equal(data_processor.scores['rmse'], [1, 1])
+
+    def test_compact_mode(self):
+        """
+        Tests that compact tables are held as float32 and categorical
+        columns, select the same functions and are mapped and stored like
+        full precision tables.
+        """
+        session = self.mock_database_session()
+        self.mock_train_data.to_sql('train_data', session.bind, index=False,
+                                    if_exists='replace')
+        self.mock_ideal_data.to_sql('ideal_functions', session.bind,
+                                    index=False, if_exists='replace')
+        session.execute(insert(models.TestData),
+                        self.mock_test_data.to_dict(orient='records'))
+        session.commit()
+
+        data_processor = ProcessData(session, compact=True)
+        self.assertEqual(data_processor.select_functions(),
+                         self.mock_selection)
+        data_processor.insert_test_data()
+        test_data = data_processor.get_data('test_data')
+        self.assertEqual(test_data['x'].dtype, np.float32)
+        self.assertEqual(test_data['delta_y'].dtype, np.float32)
+        self.assertIsInstance(test_data['ideal_function'].dtype,
+                              pd.CategoricalDtype)
+        self.assertEqual(test_data['ideal_function'].tolist(),
+                         ['y11', 'y12', 'y11', 'y12'])
+
+        # Full precision readers of the session see the original float64 rows
+        stored = ProcessData(session).get_data('test_data')
+        self.assertEqual(stored['x'].dtype, np.float64)
+        self.assertEqual(stored['x'].tolist(),
+                         self.mock_test_data['x'].tolist())
+        self.assertEqual(stored['y'].tolist(),
+                         self.mock_test_data['y'].tolist())
+        self.assertEqual(stored['delta_y'].tolist(), [1, 2, 1, 2])
+        self.assertEqual(stored['ideal_function'].tolist(),
+                         ['y11', 'y12', 'y11', 'y12'])
+
+    @patch('ops_viz.data_processing.DataHandler.get_data')
+    def test_stream_test_data(self, mock_get_data):
+        """
+        Ensures that streamed chunks are updated in place by id and that the
+        test_data schema is kept.
+        """
+        mock_get_data.return_value = self.mock_ideal_data
+        # Uses an in-memory database holding the mock test table
+        engine = create_engine("sqlite://")
+        models.Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.execute(insert(models.TestData),
+                        self.mock_test_data.to_dict(orient='records'))
+        session.commit()
+
+        data_processor = ProcessData(session=session)
+        data_processor.selection = self.mock_selection
+        total_mapped = data_processor.stream_test_data(chunk_size=3)
+
+        stored = pd.read_sql_table('test_data', engine)
+        self.assertEqual(total_mapped, 4)
+        self.assertEqual(stored['id'].tolist(), [1, 2, 3, 4])
+        self.assertEqual(stored['delta_y'].tolist(), [1, 2, 1, 2])
+        self.assertEqual(stored['ideal_function'].tolist(),
+                         ['y11', 'y12', 'y11', 'y12'])
+        primary_key = inspect(engine).get_pk_constraint('test_data')
+        self.assertEqual(primary_key['constrained_columns'], ['id'])
+
+    def test_stream_test_data_compact(self):
+        """
+        Ensures that float64 test x values read from the database are found
+        on the float32 ideal grid of the compact mode.
+        """
+        session = self.mock_database_session()
+        self.mock_ideal_data.to_sql('ideal_functions', session.bind,
+                                    index=False, if_exists='replace')
+        session.execute(insert(models.TestData),
+                        self.mock_test_data.to_dict(orient='records'))
+        session.commit()
+
+        data_processor = ProcessData(session, compact=True)
+        data_processor.selection = self.mock_selection
+        self.assertEqual(data_processor.stream_test_data(chunk_size=3), 4)
+        stored = pd.read_sql_table('test_data', session.connection())
+        self.assertEqual(stored['delta_y'].tolist(), [1, 2, 1, 2])
+        self.assertEqual(stored['ideal_function'].tolist(),
+                         ['y11', 'y12', 'y11', 'y12'])
+
+    @patch('ops_viz.data_processing.DataHandler.get_data')
+    def test_map_new_test_data(self, mock_get_data):
+        """
+        Ensures that incremental runs reuse the persisted selection and only
+        map the test rows added since the previous run.
+        """
+        mock_get_data.side_effect = self.mock_table
+        session = self.mock_database_session()
+        records = self.mock_test_data.to_dict(orient='records')
+        session.execute(insert(models.TestData), records[:2])
+        session.commit()
+
+        data_processor = ProcessData(session=session)
+        self.assertEqual(data_processor.map_new_test_data(), 2)
+
+        # Alters an already mapped row, which the next run must not touch
+        session.execute(update(models.TestData).where(
+            models.TestData.id == 1).values(ideal_function='y99'))
+        session.execute(insert(models.TestData), records[2:])
+        session.commit()
+
+        new_processor = ProcessData(session=session)
+        with patch.object(MathUtils, 'sqd_dev_matrix') as mock_matrix:
+            self.assertEqual(new_processor.map_new_test_data(chunk_size=1), 2)
+            mock_matrix.assert_not_called()
+        self.assertEqual(new_processor.selection, self.mock_selection)
+        stored = pd.read_sql_table('test_data', session.bind)
+        self.assertEqual(stored['ideal_function'].tolist(),
+                         ['y99', 'y12', 'y11', 'y12'])
+
+    @patch('ops_viz.data_processing.DataHandler.get_data')
+    def test_map_new_test_data_selection_change(self, mock_get_data):
+        """
+        Ensures that all test rows are mapped again once the selection
+        changed, clearing assignments of the previous selection.
+        """
+        mock_get_data.side_effect = self.mock_table
+        session = self.mock_database_session()
+        session.execute(insert(models.TestData),
+                        self.mock_test_data.to_dict(orient='records'))
+        session.commit()
+        self.assertEqual(ProcessData(session).map_new_test_data(), 4)
+
+        # New train data select y9 for y2, which no test point fits
+        self.mock_train_data['y2'] = [100, 200, 300, 400]
+        data_processor = ProcessData(session)
+        self.assertEqual(data_processor.map_new_test_data(), 2)
+        stored = pd.read_sql_table('test_data', session.bind)
+        self.assertEqual(stored['ideal_function'].fillna('').tolist(),
+                         ['y11', '', 'y11', ''])
+        mapping_state = session.get(models.MappingState, 'test_data')
+        self.assertEqual((mapping_state.value, mapping_state.fingerprint),
+                         (4, data_processor.fingerprint))
+        self.assertEqual(ProcessData(session).map_new_test_data(), 0)
+
+    def test_get_ideal_data_long_layout(self):
+        """
+        Ensures that ideal functions stored as (function_id, x, y) rows are
+        loaded back in the wide layout, fully or for selected functions.
+        """
+        session = self.mock_database_session()
+        long_data = self.mock_ideal_data.melt(id_vars='x',
+                                              var_name='function_id',
+                                              value_name='y')
+        session.execute(insert(models.IdealPoints),
+                        long_data.to_dict(orient='records'))
+        session.commit()
+
+        data_handler = ProcessData(session=session, ideal_layout='long')
+        pd.testing.assert_frame_equal(data_handler.get_ideal_data(),
+                                      self.mock_ideal_data,
+                                      check_dtype=False)
+        pd.testing.assert_frame_equal(
+            data_handler.get_ideal_data(['y12', 'y9', 'y12']),
+            self.mock_ideal_data[['x', 'y12', 'y9']],
+            check_dtype=False)
+
+    def test_map_test_points(self):
+        """
+        Ensures that points outside every threshold stay unmapped and that
+        the ideal table does not need to be sorted by x.
+        """
+        data_processor = ProcessData(session=None)
+        data_processor.selection = self.mock_selection
+        shuffled_ideal = self.mock_ideal_data.iloc[[3, 1, 0, 2]]
+
+        mapped, delta_y, ideal_functions = data_processor.map_test_points(
+            [0.2, 0.1, -0.1], [5, 100, -30], shuffled_ideal)
+
+        self.assertEqual(mapped.tolist(), [True, False, False])
+        self.assertEqual(delta_y.tolist(), [0])
+        self.assertEqual(ideal_functions.tolist(), ['y11'])
+
+    @parameterized.expand([
+        # Defines off-grid points, one within the tolerance of x = 0.1
+        ('linear', [0.05, 0.1 + 1e-12, 0.25], [True, True, False],
+         [0.5, 0]),
+        ('cubic', [0.05, 0.1 + 1e-12, 0.25], [True, True, False],
+         [0.5, 0]),
+        ])
+    def test_map_test_points_interpolated(self, interpolation, x_values,
+                                          mapped_res, delta_y_res):
+        """
+        Ensures that off-grid test points are interpolated and points
+        outside of the ideal x range stay unmapped.
+
+        :param mapped_res: Expected mask of mapped points
+        :param delta_y_res: Expected deviations of the mapped points
+        """
+        data_processor = ProcessData(session=None,
+                                     interpolation=interpolation)
+        data_processor.selection = {'y1': ['y11', 1]}
+
+        mapped, delta_y, _ = data_processor.map_test_points(
+            x_values, [4, 4, 5], self.mock_ideal_data)
+        self.assertEqual(mapped.tolist(), mapped_res)
+        np.testing.assert_allclose(delta_y, delta_y_res)
+
+    def test_cubic_interpolation_accuracy(self):
+        """
+        Ensures that cubic interpolation follows a smooth ideal function
+        closer than linear interpolation.
+        """
+        grid_x = np.linspace(0, 3, 31)
+        ideal_data = pd.DataFrame({'x': grid_x, 'y1': np.sin(grid_x)})
+        x_values = np.linspace(0.05, 2.95, 30)
+
+        errors = {}
+        for interpolation in ('linear', 'cubic'):
+            data_processor = ProcessData(session=None,
+                                         interpolation=interpolation)
+            data_processor.selection = {'y1': ['y1', 1]}
+            grid = data_processor.ideal_grid(ideal_data)
+            values = data_processor.ideal_values(grid, x_values)[:, 0]
+            errors[interpolation] = np.abs(values - np.sin(x_values)).max()
+        self.assertLess(errors['cubic'], errors['linear'] / 5)
+
+    @parameterized.expand([
+        # Defines seeds, number of functions and value scales
+        (0, 20, 1.0), (1, 40, 1e6), (2, 3, 0.1),
+        ])
+    def test_map_on_bands(self, seed, n_functions, scale):
+        """
+        Ensures that the band index assigns exactly like the full deviation
+        matrix, including shared functions, ties, points on the band edges
+        and NaN values.
+
+        :param n_functions: Number of selected functions
+        :param scale: Magnitude of the ideal y values
+        """
+        rng = np.random.default_rng(seed)
+        names = [f'y{i}' for i in range(n_functions)]
+        ideal_data = pd.DataFrame(np.round(rng.normal(
+            0, scale, (30, n_functions)), 2), columns=names)
+        ideal_data[names[1 % n_functions]] = ideal_data[names[0]]
+        ideal_data.iloc[4, 0] = np.nan
+        ideal_data.insert(0, 'x', np.arange(30) / 10)
+        # Two train columns share y0 with different thresholds
+        selection = {f't{i}': [names[i], max_dev] for i, max_dev in
+                     enumerate(np.round(rng.uniform(0, 2, n_functions), 1))}
+        selection['t0'][0] = names[-1]
+
+        rows = rng.integers(0, 30, 2_000)
+        picked = rng.integers(0, n_functions, 2_000)
+        selected = ideal_data[[name for name, _ in selection.values()]] \
+            .to_numpy()
+        thresholds = np.array([max_dev for _, max_dev
+                               in selection.values()]) * np.sqrt(2)
+        y_values = selected[rows, picked] + rng.choice(
+            [-1, 0, 1], 2_000) * thresholds[picked] \
+            + rng.normal(0, 0.5, 2_000) * (rng.random(2_000) < 0.5)
+        y_values[:10] = np.nan
+
+        results = []
+        for min_functions in (n_functions + 1, 1):
+            data_processor = ProcessData(session=None)
+            data_processor.selection = selection
+            data_processor.band_index_min_functions = min_functions
+            grid = data_processor.ideal_grid(ideal_data)
+            self.assertEqual(grid[3] is None, min_functions > n_functions)
+            results.append(data_processor.map_on_grid(rows / 10, y_values,
+                                                      grid))
+        for expected, values in zip(*results):
+            np.testing.assert_array_equal(values, expected)
+        self.assertGreater(results[0][0].sum(), 0)
+
+    def test_map_test_points_unknown_x(self):
+        """
+        Ensures that a test x value missing from the ideal table is reported.
+        """
+        data_processor = ProcessData(session=None)
+        data_processor.selection = self.mock_selection
+        with self.assertRaises(KeyError):
+            data_processor.map_test_points([0.3], [1], self.mock_ideal_data)
+
 
 if __name__ == '__main__':
     unittest.main()
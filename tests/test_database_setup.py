@@ -1,7 +1,16 @@
+import os
+import tempfile
 import unittest
 import pandas as pd
 from unittest.mock import patch, MagicMock
+from parameterized import parameterized
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from database.columnar_cache import ColumnarCache
 from database.database_setup import InsertData
+from database.models import (Base, MappingState, create_session,
+                             create_sqlite_engine, dispose_engines,
+                             get_engine)
 
 
 class TestInsertData(unittest.TestCase):
@@ -52,8 +61,169 @@ class TestInsertData(unittest.TestCase):
         self.assertTrue(mock_read_csv.called)
         self.assertEqual(mock_read_csv.call_count, 3)
 
-        # Verify that session execute was called for each table
-        self.assertEqual(mock_session.execute.call_count, 3)
+        # Verify that session execute was called for each table and once to
+        # clear the recorded cache state
+        self.assertEqual(mock_session.execute.call_count, 4)
+
+    @parameterized.expand([
+        # Defines both transaction strategies with a partial last chunk
+        ('chunk',), ('single',),
+        ])
+    @patch('database.database_setup.create_session')
+    def test_stream_insert(self, transaction, mock_create_session):
+        """
+        Tests that the streamed chunks end up complete in the database.
+
+        :param transaction: Transaction strategy used for the insert
+        """
+        # Uses an in-memory database instead of database.db
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        mock_create_session.return_value = sessionmaker(bind=engine)()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = {}
+            for name, data in [('train', self.mock_train_data),
+                               ('ideal', self.mock_ideal_data),
+                               ('test', self.mock_test_data)]:
+                paths[name] = os.path.join(tmp_dir, f'{name}.csv')
+                pd.concat([data] * 3).to_csv(paths[name], index=False)
+
+            # x is a primary key for train and ideal data
+            for name in ('train', 'ideal'):
+                data = pd.read_csv(paths[name])
+                data['x'] = range(len(data))
+                data.to_csv(paths[name], index=False)
+
+            data_loader = InsertData(train_path=paths['train'],
+                                     ideal_path=paths['ideal'],
+                                     test_path=paths['test'])
+            row_counts = data_loader.stream_insert(chunk_size=4,
+                                                   transaction=transaction)
+
+        self.assertEqual(row_counts, {'train_data': 6,
+                                      'ideal_functions': 6,
+                                      'test_data': 6})
+        stored = pd.read_sql_table('test_data', engine)
+        self.assertEqual(stored['y'].tolist(), [10, 20] * 3)
+        self.assertEqual(stored['id'].tolist(), list(range(1, 7)))
+
+    @patch('database.database_setup.create_session')
+    def test_bulk_insert_long_layout(self, mock_create_session):
+        """
+        Tests that ideal functions are stored as one row per function and x.
+        """
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        mock_create_session.return_value = sessionmaker(bind=engine)()
+
+        with patch('pandas.read_csv') as mock_read_csv:
+            mock_read_csv.side_effect = [self.mock_train_data,
+                                         self.mock_ideal_data,
+                                         self.mock_test_data]
+            InsertData(train_path='train.csv',
+                       ideal_path='ideal.csv',
+                       test_path='test.csv',
+                       ideal_layout='long').bulk_insert()
+
+        stored = pd.read_sql_table('ideal_points', engine)
+        self.assertEqual(len(stored), 100)
+        self.assertEqual(stored['function_id'].tolist()[:3],
+                         ['y1', 'y1', 'y2'])
+        self.assertTrue(pd.read_sql_table('ideal_functions', engine).empty)
+
+    @patch('database.database_setup.create_session')
+    def test_bulk_insert_cache_source(self, mock_create_session):
+        """
+        Tests that a columnar cache written from one train file is not
+        inserted for another and that the inserted source is recorded.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            paths = {}
+            for name, data in [('ideal', self.mock_ideal_data),
+                               ('test', self.mock_test_data),
+                               ('a', self.mock_train_data),
+                               ('b', self.mock_train_data.assign(y1=[7, 8]))]:
+                paths[name] = os.path.join(tmp_dir, f'{name}.csv')
+                data.to_csv(paths[name], index=False)
+
+            for train in ('a', 'b'):
+                engine = create_engine("sqlite://")
+                Base.metadata.create_all(engine)
+                mock_create_session.return_value = \
+                    sessionmaker(bind=engine)()
+                InsertData(train_path=paths[train],
+                           ideal_path=paths['ideal'],
+                           test_path=paths['test'],
+                           cache_dir=cache_dir).bulk_insert()
+
+            stored = pd.read_sql_table('train_data', engine)
+            self.assertEqual(stored['y1'].tolist(), [7, 8])
+            cache = ColumnarCache(cache_dir)
+            states = pd.read_sql_table('cache_state', engine)
+            self.assertEqual(
+                dict(zip(states['name'], states['sha256'])),
+                {'train_data': cache.fingerprint('train_data'),
+                 'ideal_functions': cache.fingerprint('ideal_functions')})
+
+
+class TestSQLiteEngine(unittest.TestCase):
+    """
+    Unit tests for the SQLite engine factory.
+    """
+    @parameterized.expand([
+        # Profile, expected synchronous level (1 = NORMAL, 0 = OFF)
+        ('default', 1), ('bulk_load', 0),
+        ])
+    def test_engine_profiles(self, profile, synchronous):
+        """
+        Tests that every connection gets the pragmas of its profile and that
+        engines are shared per database URL and profile.
+
+        :param profile: Name of the SQLite pragma profile
+        :param synchronous: Expected value of the synchronous pragma
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            url = f"sqlite:///{os.path.join(tmp_dir, 'test.db')}"
+            engine = get_engine(url, profile)
+            self.assertIs(get_engine(url, profile), engine)
+            with engine.connect() as connection:
+                pragma = connection.exec_driver_sql
+                self.assertEqual(pragma("PRAGMA journal_mode").scalar(),
+                                 'wal')
+                self.assertEqual(pragma("PRAGMA synchronous").scalar(),
+                                 synchronous)
+                self.assertEqual(pragma("PRAGMA temp_store").scalar(), 2)
+            engine.dispose()
+
+    def test_add_missing_columns(self):
+        """
+        Tests that a mapping_state table of an earlier version gets the
+        fingerprint column, keeping its rows.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            url = f"sqlite:///{os.path.join(tmp_dir, 'test.db')}"
+            engine = get_engine(url)
+            with engine.begin() as connection:
+                connection.exec_driver_sql(
+                    "CREATE TABLE mapping_state (name VARCHAR PRIMARY KEY, "
+                    "value INTEGER NOT NULL)")
+                connection.exec_driver_sql(
+                    "INSERT INTO mapping_state VALUES ('test_data', 4)")
+
+            session = create_session(url=url)
+            state = session.get(MappingState, 'test_data')
+            self.assertEqual((state.value, state.fingerprint), (4, None))
+            session.close()
+            dispose_engines()
+
+    def test_unknown_profile(self):
+        """
+        Tests that unknown profiles are rejected.
+        """
+        with self.assertRaises(ValueError):
+            create_sqlite_engine("sqlite://", profile='fast')
 
 
 if __name__ == '__main__':
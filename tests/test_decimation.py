@@ -0,0 +1,62 @@
+import unittest
+import numpy as np
+from parameterized import parameterized
+from ops_viz.decimation import Decimator
+
+
+class TestDecimator(unittest.TestCase):
+    """
+    Unit tests for the Decimator class.
+    """
+    def setUp(self):
+        """
+        Set up a decimator and a noisy line with shuffled x values.
+        """
+        self.decimator = Decimator()
+        rng = np.random.default_rng(1)
+        self.x = rng.permutation(np.linspace(-20, 20, 100_000))
+        self.y = np.sin(self.x) + rng.normal(0, 0.1, len(self.x))
+
+    def test_minmax_indices(self):
+        """
+        Tests that the decimated line keeps the extremes of every x bin.
+        """
+        bins = 500
+        keep = self.decimator.minmax_indices(self.x, self.y, bins)
+
+        self.assertLessEqual(len(keep), 4 * bins)
+        self.assertTrue(np.all(np.diff(keep) > 0))
+        all_bins = self.decimator.x_bins(self.x, bins)
+        kept_bins = self.decimator.x_bins(self.x[keep], bins)
+        for i in (0, 123, bins - 1):
+            self.assertEqual(self.y[keep][kept_bins == i].min(),
+                             self.y[all_bins == i].min())
+            self.assertEqual(self.y[keep][kept_bins == i].max(),
+                             self.y[all_bins == i].max())
+
+    @parameterized.expand([
+        # Sample smaller than the data, data smaller than the sample
+        (5_000, 5_000), (200_000, 100_000),
+        ])
+    def test_sample_indices(self, max_points, expected_max):
+        """
+        Tests that the stratified sample has the requested size, covers all
+        x bins and is reproducible.
+
+        :param max_points: Requested sample size
+        :param expected_max: Maximum size of the returned sample
+        """
+        bins = 100
+        sample = self.decimator.sample_indices(self.x, max_points, bins)
+
+        self.assertLessEqual(len(sample), expected_max + bins)
+        self.assertGreaterEqual(len(sample), min(max_points, len(self.x)))
+        self.assertEqual(len(np.unique(sample)), len(sample))
+        self.assertEqual(len(np.unique(
+            self.decimator.x_bins(self.x[sample], bins))), bins)
+        np.testing.assert_array_equal(
+            sample, self.decimator.sample_indices(self.x, max_points, bins))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import json
+import tempfile
+import unittest
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from monitoring.instrumentation import Instrumentation, JsonLinesReport
+from monitoring.instrumentation import instrumentation
+from ops_viz.data_processing import DataHandler
+
+
+class TestInstrumentation(unittest.TestCase):
+    """
+    Unit tests for the Instrumentation class.
+    """
+    def setUp(self):
+        """
+        Set up an instrumentation collecting its records.
+        """
+        self.instrumentation = Instrumentation()
+        self.records = []
+        self.instrumentation.add_hook(self.records.append)
+
+    def test_stage(self):
+        """
+        Tests the record of nested stages, the inner one finishing first.
+        """
+        with self.instrumentation.stage('outer', table='t') as outer:
+            with self.instrumentation.stage('inner') as inner:
+                inner['rows'] = 10
+            outer['rows'] = 0
+
+        self.assertEqual([record['stage'] for record in self.records],
+                         ['inner', 'outer'])
+        inner, outer = self.records
+        self.assertEqual(inner['parent'], 'outer')
+        self.assertIsNone(outer['parent'])
+        self.assertEqual(outer['table'], 't')
+        self.assertEqual((inner['status'], inner['rows']), ('ok', 10))
+        self.assertGreater(inner['rows_per_sec'], 0)
+        self.assertEqual(outer['db_round_trips'], 0)
+        for field in ('started', 'seconds', 'peak_rss_mb'):
+            self.assertIn(field, outer)
+
+    def test_error_and_failing_hook(self):
+        """
+        Tests that failed stages are recorded and failing hooks are ignored.
+        """
+        def failing_hook(record):
+            raise RuntimeError('hook failed')
+
+        self.instrumentation.add_hook(failing_hook)
+        with self.assertRaises(ValueError):
+            with self.assertLogs('monitoring.instrumentation', 'ERROR'):
+                with self.instrumentation.stage('failing'):
+                    raise ValueError('stage failed')
+        self.assertEqual(self.records[0]['status'], 'error')
+
+    def test_instrument(self):
+        """
+        Tests the decorator with a row count and fields set by the function.
+        """
+        @self.instrumentation.instrument(rows=lambda values: len(values))
+        def total(values):
+            self.instrumentation.current()['kind'] = 'sum'
+            return sum(values)
+
+        self.assertEqual(total([1, 2, 3]), 6)
+        self.assertEqual(self.records[0]['stage'], 'total')
+        self.assertEqual(self.records[0]['rows'], 3)
+        self.assertEqual(self.records[0]['kind'], 'sum')
+        self.assertEqual(self.instrumentation.current(), {})
+
+    def test_get_data_round_trips(self):
+        """
+        Tests that database reads are counted and cached reads are not.
+        """
+        engine = create_engine("sqlite://")
+        pd.DataFrame({'x': [1.0, 2.0]}).to_sql('train_data', engine,
+                                               index=False)
+        data_handler = DataHandler(sessionmaker(bind=engine)())
+        records = []
+        hook = instrumentation.add_hook(records.append)
+        try:
+            data_handler.get_data('train_data')
+            data_handler.get_data('train_data')
+        finally:
+            instrumentation.remove_hook(hook)
+
+        self.assertEqual([record['source'] for record in records],
+                         ['database', 'session_cache'])
+        self.assertEqual([record['rows'] for record in records], [2, 2])
+        self.assertGreater(records[0]['db_round_trips'], 0)
+        self.assertEqual(records[1]['db_round_trips'], 0)
+
+    def test_json_lines_report(self):
+        """
+        Tests that every record is appended as one JSON line.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'metrics.jsonl')
+            self.instrumentation.add_hook(JsonLinesReport(path, run_id='r1'))
+            for name in ('first', 'second'):
+                with self.instrumentation.stage(name):
+                    pass
+            with open(path, encoding='utf-8') as report:
+                lines = [json.loads(line) for line in report]
+
+        self.assertEqual([line['stage'] for line in lines],
+                         ['first', 'second'])
+        self.assertTrue(all(line['run_id'] == 'r1' for line in lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import unittest
+import numpy as np
+import pandas as pd
+from unittest.mock import patch
+from parameterized import parameterized
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from database import models
+from ops_viz import mapping_service
+
+
+class TestMappingService(unittest.TestCase):
+    """
+    Unit tests for the PointMapper and MappingServer classes.
+    """
+    def setUp(self):
+        """
+        Set up an in-memory database and a mapper over mock tables.
+        """
+        self.mock_train_data = pd.DataFrame({
+            'x': [-0.1, 0, 0.1, 0.2],
+            'y1': [1, 2, 3, 4],
+            'y2': [-10, -20, -30, -40],
+        })
+        self.mock_ideal_data = pd.DataFrame({
+            'x': [-0.1, 0, 0.1, 0.2],
+            'y11': [2, 3, 4, 5],
+            'y12': [-11, -21, -21, -41],
+        })
+        # Shares the in-memory database with the store thread of the server
+        engine = create_engine("sqlite://", poolclass=StaticPool,
+                               connect_args={'check_same_thread': False})
+        models.Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.mapper = self.create_mapper()
+
+    def create_mapper(self, compact=False):
+        """
+        Creates a mapper over the mock tables, held as float32 tables in the
+        compact mode.
+        """
+        dtype = np.float32 if compact else np.float64
+        tables = {'train_data': self.mock_train_data.astype(dtype),
+                  'ideal_functions': self.mock_ideal_data.astype(dtype)}
+        with patch('ops_viz.data_processing.DataHandler.get_data',
+                   side_effect=lambda table, columns=None:
+                   tables[table] if columns is None
+                   else tables[table][columns]):
+            return mapping_service.PointMapper(session=self.session,
+                                               compact=compact)
+
+    @parameterized.expand([
+        # Maps against full precision and float32 ideal grids
+        (False,), (True,),
+        ])
+    def test_map_batch(self, compact):
+        """
+        Tests that a batch is mapped, leaving off-grid points unmapped.
+
+        :param compact: Holds the ideal grid in float32
+        """
+        delta_y, ideal_functions = self.create_mapper(compact).map_batch(
+            [-0.1, 0, 0.05, 0.2], [1, -19, 3, 100])
+        np.testing.assert_allclose(delta_y, [1, 2, np.nan, np.nan],
+                                   rtol=1e-6)
+        self.assertEqual(ideal_functions.tolist(), ['y11', 'y12', None, None])
+
+    def test_store_batch_keeps_unmapped_rows(self):
+        """
+        Tests that storing a batch after unmapped test rows leaves the
+        high-water mark before them, so they are still mapped later.
+        """
+        self.mock_ideal_data.to_sql('ideal_functions', self.session.bind,
+                                    index=False, if_exists='replace')
+        self.session.execute(insert(models.TestData),
+                             [{'x': -0.1, 'y': 1}, {'x': 0.2, 'y': -39}])
+        self.session.commit()
+
+        delta_y, ideal_functions = self.mapper.map_batch([0], [-19])
+        self.mapper.store_batch([0], [-19], delta_y, ideal_functions)
+        self.assertIsNone(self.session.get(models.MappingState, 'test_data'))
+        self.assertEqual(self.mapper.map_new_test_data(), 3)
+        stored = pd.read_sql_table('test_data', self.session.bind)
+        self.assertEqual(stored['ideal_function'].tolist(),
+                         ['y11', 'y12', 'y12'])
+
+    def test_server_round_trip(self):
+        """
+        Tests that points sent to the server are answered in order and
+        stored in the test_data table.
+        """
+        async def round_trip():
+            server = mapping_service.MappingServer(self.mapper, port=0)
+            await server.start()
+            port = server.server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'-0.1,1\n0,-19\nbad line\n0.2,100\n')
+            await writer.drain()
+            lines = [await reader.readline() for _ in range(4)]
+            writer.close()
+            await server.close()
+            return lines
+
+        lines = asyncio.run(round_trip())
+        self.assertEqual(lines, [b'y11,1.0\n', b'y12,2.0\n', b'error\n',
+                                 b',\n'])
+        stored = pd.read_sql_table('test_data', self.session.bind)
+        self.assertEqual(stored['y'].tolist(), [1, -19, 100])
+        self.assertEqual(stored['ideal_function'].fillna('').tolist(),
+                         ['y11', 'y12', ''])
+        mapping_state = self.session.get(models.MappingState, 'test_data')
+        self.assertEqual(mapping_state.value, 3)
+
+    def test_server_survives_failed_batches(self):
+        """
+        Tests that a failing micro-batch is answered with errors and a
+        failing store is logged, while the server keeps mapping and stores
+        its points off the event loop thread.
+        """
+        map_batch = self.mapper.map_batch
+        map_calls = []
+        store_threads = []
+
+        def fail_first_batch(xs, ys):
+            map_calls.append(len(xs))
+            if len(map_calls) == 1:
+                raise ValueError('bad grid')
+            return map_batch(xs, ys)
+
+        def store_batch(*args):
+            store_threads.append(threading.get_ident())
+            raise RuntimeError('database is locked')
+
+        async def serve():
+            server = mapping_service.MappingServer(self.mapper, port=0)
+            await server.start()
+            replies = []
+            for request in (b'-0.1,1\n0,-19\n', b'0.2,-39\n'):
+                port = server.server.sockets[0].getsockname()[1]
+                reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                               port)
+                writer.write(request)
+                await writer.drain()
+                replies.append([await reader.readline()
+                                for _ in range(request.count(b'\n'))])
+                writer.close()
+            await server.close()
+            return replies
+
+        with patch.object(self.mapper, 'map_batch',
+                          side_effect=fail_first_batch), \
+                patch.object(self.mapper, 'store_batch',
+                             side_effect=store_batch), \
+                self.assertLogs(mapping_service.logger, 'ERROR') as logs:
+            replies = asyncio.run(serve())
+        self.assertEqual(replies, [[b'error\n', b'error\n'],
+                                   [b'y12,2.0\n']])
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(len(store_threads), 1)
+        self.assertNotEqual(store_threads[0], threading.get_ident())
+
+
+if __name__ == '__main__':
+    unittest.main()
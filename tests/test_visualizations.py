@@ -0,0 +1,162 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from unittest.mock import patch
+from parameterized import parameterized
+from monitoring.instrumentation import instrumentation
+from ops_viz.visualizations import VisualizeData
+
+
+class TestVisualizeData(unittest.TestCase):
+    """
+    Unit tests for the VisualizeData class.
+    """
+    def setUp(self):
+        """
+        Set up a visualizer over mock tables without a database session.
+        """
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.visualizer = VisualizeData.__new__(VisualizeData)
+        self.visualizer.session = None
+        self.visualizer.show = False
+        self.visualizer.output_dir = self.tmp_dir.name
+        self.visualizer.functions = {'y1': ['y11', 1], 'y2': ['y12', 9],
+                                     'y3': ['y11', 1], 'y4': ['y12', 9]}
+        self.visualizer.train_data = pd.DataFrame({
+            'x': [-0.1, 0, 0.1, 0.2],
+            'y1': [1, 2, 3, 4], 'y2': [-10, -20, -30, -40],
+            'y3': [1, 2, 3, 4], 'y4': [-10, -20, -30, -40],
+        })
+        self.visualizer.ideal_data = pd.DataFrame({
+            'x': [-0.1, 0, 0.1, 0.2],
+            'y11': [2, 3, 4, 5],
+            'y12': [-11, -21, -21, -41],
+        })
+        self.visualizer.test_data = pd.DataFrame({
+            'x': [-0.1, 0, 0, 0.2], 'y': [1, -19, 2, -39],
+            'delta_y': [1, 2, 1, 2],
+            'ideal_function': ['y11', 'y12', 'y11', None],
+        })
+
+    def tearDown(self):
+        """
+        Removes the rendered figures.
+        """
+        self.tmp_dir.cleanup()
+
+    @parameterized.expand([
+        # Renders in the current process and in a process pool
+        (None,), (2,),
+        ])
+    def test_render_all(self, workers):
+        """
+        Tests that every figure is rendered headless and timed.
+
+        :param workers: Number of render processes
+        """
+        records = []
+        hook = instrumentation.add_hook(records.append)
+        try:
+            render_times = self.visualizer.render_all(workers=workers)
+        finally:
+            instrumentation.remove_hook(hook)
+
+        self.assertEqual(len(render_times), 5)
+        # Plot stages of worker processes reach the local hooks too
+        self.assertEqual(sorted(record['stage'] for record in records),
+                         ['plot_test_over_ideal', 'plot_test_vs_ideal',
+                          'plot_test_vs_ideal_single',
+                          'plot_test_vs_ideal_single',
+                          'plot_train_vs_ideal'])
+        self.assertTrue(all(record['rows'] == 4 for record in records))
+        self.assertEqual(sorted(name for name in os.listdir(self.tmp_dir.name)
+                                if name.endswith('.png')),
+                         ['plot_test_vs_ideal_y11.png',
+                          'plot_test_vs_ideal_y12.png',
+                          'test_over_ideal.png',
+                          'test_vs_ideal.png',
+                          'train_vs_ideal.png'])
+
+    def test_render_all_incremental(self):
+        """
+        Tests that only figures whose inputs changed are rendered again.
+        """
+        self.visualizer.render_all()
+        self.assertEqual(self.visualizer.render_all(), {})
+
+        # Adds a test point mapped to y11, drawn unmapped in the y12 figure
+        self.visualizer.test_data = pd.concat([
+            self.visualizer.test_data,
+            pd.DataFrame({'x': [0.1], 'y': [4.5], 'delta_y': [0.5],
+                          'ideal_function': ['y11']})], ignore_index=True)
+        self.assertEqual(sorted(self.visualizer.render_all()),
+                         ['plot_test_over_ideal', 'plot_test_vs_ideal',
+                          'plot_test_vs_ideal_single_y11',
+                          'plot_test_vs_ideal_single_y12'])
+
+        # Unmapping a y12 point leaves the y11 figure unchanged
+        self.visualizer.test_data.loc[1, 'ideal_function'] = None
+        self.assertEqual(sorted(self.visualizer.render_all()),
+                         ['plot_test_over_ideal', 'plot_test_vs_ideal',
+                          'plot_test_vs_ideal_single_y12'])
+
+        # A selection of NumPy floats hashes like the cached plain floats
+        self.visualizer.functions = {
+            train_column: [ideal_func, np.float64(max_dev)]
+            for train_column, (ideal_func, max_dev)
+            in self.visualizer.functions.items()}
+        self.assertEqual(self.visualizer.render_all(), {})
+
+        # Renders a deleted figure and every figure when forced
+        os.remove(os.path.join(self.tmp_dir.name, 'train_vs_ideal.png'))
+        self.assertEqual(list(self.visualizer.render_all()),
+                         ['plot_train_vs_ideal'])
+        self.assertEqual(len(self.visualizer.render_all(force=True)), 5)
+
+    def test_render_all_failed_save(self):
+        """
+        Tests that figures whose saving failed stay out of the manifest and
+        are rendered again on the next run.
+        """
+        with patch('ops_viz.visualizations.plt.savefig',
+                   side_effect=PermissionError):
+            self.assertEqual(len(self.visualizer.render_all()), 5)
+        self.assertEqual(self.visualizer.read_manifest(), {})
+        self.assertEqual(len(self.visualizer.render_all()), 5)
+        self.assertEqual(len(self.visualizer.read_manifest()), 5)
+
+    def test_render_all_compact(self):
+        """
+        Tests that compact tables with a categorical ideal_function column
+        render every figure and are fingerprinted for incremental renders.
+        """
+        for name in ('train_data', 'ideal_data', 'test_data'):
+            setattr(self.visualizer, name, self.visualizer.compact_frame(
+                getattr(self.visualizer, name)))
+        self.assertEqual(len(self.visualizer.render_all()), 5)
+        self.assertEqual(self.visualizer.render_all(), {})
+
+    def test_decimated_points(self):
+        """
+        Tests that lines and scatters above max_points are decimated, while
+        smaller plots keep all points.
+        """
+        x = pd.Series(np.linspace(-20, 20, 10_000))
+        y = np.sin(x)
+        self.visualizer.max_points = 1_000
+        self.visualizer.line_bins = 100
+
+        line_x, line_y = self.visualizer.line_points(x, y)
+        self.assertLessEqual(len(line_x), 400)
+        self.assertEqual((line_y.min(), line_y.max()), (y.min(), y.max()))
+        scatter = self.visualizer.scatter_points(pd.DataFrame({'x': x,
+                                                               'y': y}))
+        self.assertLessEqual(len(scatter), 1_100)
+        self.assertEqual(len(self.visualizer.scatter_points(
+            self.visualizer.test_data)), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()